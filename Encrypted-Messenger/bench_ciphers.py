@@ -0,0 +1,68 @@
+"""
+Micro-benchmark for the message cipher suites.
+
+Measures per-message encrypt and decrypt time and the bytes each message
+costs on the wire, as a JSON frame and as a binary frame.
+
+    python bench_ciphers.py [--sizes 16,256,4096] [--count 20000]
+"""
+
+import argparse
+import base64
+import json
+import time
+from ciphers import Keyring, available_suites
+from framing import encode_frame
+import wire
+
+KEY = base64.urlsafe_b64encode(bytes(range(32)))
+
+def measure(keyring, size, count):
+    plaintext = b"x" * size
+    tokens = []
+
+    start = time.perf_counter()
+    for _ in range(count):
+        tokens.append(keyring.encrypt(plaintext))
+    encrypt_us = (time.perf_counter() - start) / count * 1e6
+
+    start = time.perf_counter()
+    for token in tokens:
+        keyring.decrypt(token)
+    decrypt_us = (time.perf_counter() - start) / count * 1e6
+
+    token = tokens[0]
+    payload = {"from": "benchmark", "room": "lobby", "data": base64.urlsafe_b64encode(token).decode()}
+    return {
+        "encrypt_us": round(encrypt_us, 2),
+        "decrypt_us": round(decrypt_us, 2),
+        "token_bytes": len(token),
+        "json_frame_bytes": len(encode_frame(json.dumps(payload).encode())),
+        "binary_frame_bytes": len(wire.pack(wire.MESSAGE, 1, 2, 3, token)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare message cipher suites")
+    parser.add_argument("--sizes", default="16,256,4096", help="plaintext sizes in bytes")
+    parser.add_argument("--count", type=int, default=20000, help="messages per measurement")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = []
+    for name in available_suites():
+        keyring = Keyring(KEY, name)
+        for size in sizes:
+            results.append({"suite": name, "plaintext_bytes": size, **measure(keyring, size, args.count)})
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'suite':<18} {'size':>6} {'enc us':>8} {'dec us':>8} {'token':>7} {'json':>7} {'binary':>7}")
+    for r in results:
+        print(f"{r['suite']:<18} {r['plaintext_bytes']:>6} {r['encrypt_us']:>8} {r['decrypt_us']:>8} "
+              f"{r['token_bytes']:>7} {r['json_frame_bytes']:>7} {r['binary_frame_bytes']:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+Load generator and latency benchmark for server.py.
+
+Starts a server locally, connects thousands of headless clients that do
+the normal handshake, has some of them send encrypted messages at a fixed
+rate and measures what comes back out:
+
+  - throughput, messages sent and delivered per second
+  - fan-out latency from send to each delivery, p50/p99/p999
+  - server RSS and CPU (Linux, includes worker processes)
+  - messages that were never delivered
+
+The clients parse every frame they get, so with big rooms a single client
+process saturates before the server does; spread them with --procs and
+check the bench isn't the bottleneck before reading the latencies.
+
+Results go to stdout as JSON, so runs against different server versions
+can be compared.
+
+    python bench_server.py --clients 5000 --senders 50 --rate 10 --size 256
+    python bench_server.py --server-args "--workers 4" --procs 4
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from ciphers import Keyring
+from framing import FrameDecoder, encode_frame
+import wire
+
+KEY = b"SXGguPKB6mbAFrfEKLE6uJko4Xu2DkLkPe2VJ8cAFeA="
+CONNECT_CONCURRENCY = 200  # Handshakes in flight at once per process
+
+def room_of(index, rooms):
+    return f"bench-{index % rooms}"
+
+class BenchClient:
+    """One simulated user, counts and times what it receives"""
+
+    def __init__(self, index, options, stats):
+        self.index = index
+        self.username = f"bench-{index}"
+        self.room = room_of(index, options.rooms)
+        self.options = options
+        self.stats = stats
+        self.writer = None
+        self.wire = "json"
+
+    async def connect(self, host, port):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        hello = {"username": self.username, "room": self.room,
+                 "ciphers": [self.options.cipher], "formats": [self.options.format]}
+        self.writer.write(encode_frame(json.dumps(hello).encode()))
+        await self.writer.drain()
+        asyncio.get_running_loop().create_task(self.read(reader))
+
+    async def read(self, reader):
+        decoder = FrameDecoder()
+        sent = self.stats["sent_at"]
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                now = time.perf_counter()
+                decoder.feed(data)
+                for frame in decoder.frames():
+                    if wire.is_binary(frame):
+                        key = bytes(wire.unpack(frame)[4])
+                    else:
+                        msg = json.loads(str(frame, "utf-8"))
+                        if msg.get("type") == "welcome":
+                            self.wire = msg["format"]
+                            continue
+                        if msg.get("type") == "skipped":
+                            self.stats["skipped"] += msg["count"]
+                            continue
+                        key = msg.get("data")
+                        if key is None:
+                            continue
+                    self.stats["received"] += 1
+                    self.stats["received_bytes"] += len(frame)
+                    # Only messages sent from this process can be timed
+                    sent_at = sent.get(key)
+                    if sent_at is not None:
+                        self.stats["latencies"].append(now - sent_at)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.stats["disconnected"] += 1
+
+    async def send_loop(self, keyring, stop_at):
+        interval = 1 / self.options.rate
+        padding = b"x" * max(0, self.options.size - 32)
+        room_id = wire.name_id(self.room)
+        sender_id = wire.name_id(self.username)
+        sent = self.stats["sent_at"]
+        sequence = 0
+        next_send = time.perf_counter()
+        while next_send < stop_at:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sequence += 1
+            token = keyring.encrypt(f"{self.username}:{sequence}:".encode() + padding)
+            if self.wire == "binary":
+                key = token
+                frame = wire.pack(wire.MESSAGE, sender_id, room_id, 0, token)
+            else:
+                key = base64.urlsafe_b64encode(token).decode()
+                frame = encode_frame(json.dumps({"from": self.username, "room": self.room, "data": key}).encode())
+            sent[key] = time.perf_counter()
+            self.writer.write(frame)
+            self.stats["sent"] += 1
+            self.stats["sent_per_room"][self.room] = self.stats["sent_per_room"].get(self.room, 0) + 1
+            next_send += interval
+            if self.writer.transport.get_write_buffer_size() > 1 << 20:
+                await self.writer.drain()
+
+async def run_clients(indices, options, barrier):
+    stats = {"sent": 0, "received": 0, "received_bytes": 0, "skipped": 0, "disconnected": 0,
+             "connect_errors": 0, "latencies": [], "sent_at": {}, "sent_per_room": {},
+             "connected_per_room": {}}
+    clients = [BenchClient(i, options, stats) for i in indices]
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client):
+        async with limit:
+            try:
+                await client.connect(options.host, options.port)
+            except OSError:
+                stats["connect_errors"] += 1
+                return None
+        room = client.room
+        stats["connected_per_room"][room] = stats["connected_per_room"].get(room, 0) + 1
+        return client
+
+    connected = [c for c in await asyncio.gather(*(connect(c) for c in clients)) if c is not None]
+
+    # Every process starts sending together, once all of them are connected
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, barrier.wait)
+    await asyncio.sleep(options.warmup)
+
+    keyring = Keyring(KEY, options.cipher)
+    start = time.perf_counter()
+    stop_at = start + options.duration
+    senders = [c for c in connected if c.index < options.senders]
+    await asyncio.gather(*(c.send_loop(keyring, stop_at) for c in senders))
+    # Give in-flight deliveries time to land
+    await asyncio.sleep(options.drain)
+
+    for client in connected:
+        client.writer.close()
+    del stats["sent_at"]
+    return stats
+
+def client_process(indices, options, barrier, results):
+    try:
+        results.put(asyncio.run(run_clients(indices, options, barrier)))
+    except Exception as e:
+        barrier.abort()
+        results.put({"error": repr(e)})
+
+def process_tree(pid):
+    """pid and all of its descendants, from /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+def sample_usage(pid):
+    """Returns (rss bytes, cpu seconds) summed over the server's processes, or None"""
+    if not os.path.exists("/proc"):
+        return None
+    rss = cpu = 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/statm") as f:
+                rss += int(f.read().split()[1]) * page
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+    return rss, cpu
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark server.py under load")
+    parser.add_argument("--clients", type=int, default=1000, help="connected clients")
+    parser.add_argument("--senders", type=int, default=10, help="how many of them send")
+    parser.add_argument("--rate", type=float, default=10, help="messages per second per sender")
+    parser.add_argument("--size", type=int, default=128, help="plaintext bytes per message")
+    parser.add_argument("--rooms", type=int, default=1, help="clients are spread over this many rooms")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds between connecting and sending")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for late deliveries")
+    parser.add_argument("--cipher", default="fernet", help="cipher suite the clients encrypt with")
+    parser.add_argument("--format", default="json", choices=wire.FORMATS, help="wire format to ask for")
+    parser.add_argument("--procs", type=int, default=1, help="client processes, for loads one core can't drive")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5599)
+    parser.add_argument("--server-args", default="", help="extra arguments for server.py")
+    parser.add_argument("--no-server", action="store_true", help="benchmark a server that is already running")
+    options = parser.parse_args()
+
+    server = None
+    if not options.no_server:
+        here = os.path.dirname(os.path.abspath(__file__))
+        command = [sys.executable, os.path.join(here, "server.py"), "--host", options.host,
+                   "--port", str(options.port)] + shlex.split(options.server_args)
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    if not wait_for_port(options.host, options.port):
+        sys.exit("server didn't come up")
+
+    # Sample the server while the benchmark runs
+    usage = []
+    done = threading.Event()
+
+    def sampler():
+        while server is not None and not done.is_set():
+            sample = sample_usage(server.pid)
+            if sample is not None:
+                usage.append((time.monotonic(), *sample))
+            done.wait(0.25)
+    threading.Thread(target=sampler, daemon=True).start()
+
+    barrier = multiprocessing.Barrier(options.procs)
+    results = multiprocessing.Queue()
+    procs = []
+    for n in range(options.procs):
+        indices = range(n, options.clients, options.procs)
+        proc = multiprocessing.Process(target=client_process, args=(indices, options, barrier, results))
+        proc.start()
+        procs.append(proc)
+    stats = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    done.set()
+    if server is not None:
+        # Same as Ctrl-C, so a --workers server stops its children too
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+    errors = [s["error"] for s in stats if "error" in s]
+    if errors:
+        sys.exit(f"benchmark failed: {errors[0]}")
+
+    connected = {}
+    sent_per_room = {}
+    for s in stats:
+        for room, count in s["connected_per_room"].items():
+            connected[room] = connected.get(room, 0) + count
+        for room, count in s["sent_per_room"].items():
+            sent_per_room[room] = sent_per_room.get(room, 0) + count
+    expected = sum(count * (connected.get(room, 1) - 1) for room, count in sent_per_room.items())
+    sent = sum(s["sent"] for s in stats)
+    received = sum(s["received"] for s in stats)
+    latencies = sorted(l for s in stats for l in s["latencies"])
+
+    report = {
+        "config": {k: v for k, v in vars(options).items()},
+        "connected": sum(connected.values()),
+        "connect_errors": sum(s["connect_errors"] for s in stats),
+        "throughput": {
+            "sent_per_s": round(sent / options.duration, 1),
+            "delivered_per_s": round(received / options.duration, 1),
+            "delivered_bytes_per_s": round(sum(s["received_bytes"] for s in stats) / options.duration),
+        },
+        "latency_ms": {
+            "samples": len(latencies),
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] if latencies else None,
+        },
+        "messages": {
+            "sent": sent,
+            "expected_deliveries": expected,
+            "delivered": received,
+            "dropped": max(0, expected - received),
+            "skipped_by_server": sum(s["skipped"] for s in stats),
+        },
+        "server": None,
+    }
+    for name, value in report["latency_ms"].items():
+        if name != "samples" and value is not None:
+            report["latency_ms"][name] = round(value * 1000, 3)
+    if usage:
+        elapsed = usage[-1][0] - usage[0][0]
+        report["server"] = {
+            "rss_mb_peak": round(max(rss for _, rss, _ in usage) / (1 << 20), 1),
+            "rss_mb_end": round(usage[-1][1] / (1 << 20), 1),
+            "cpu_percent": round((usage[-1][2] - usage[0][2]) / elapsed * 100, 1) if elapsed else None,
+        }
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
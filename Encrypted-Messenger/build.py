@@ -1,6 +1,9 @@
 """
 Build script for Secure Messenger Application
 Creates a standalone executable using PyInstaller
+
+Before building, checks how long the client takes to import up to its
+login screen and fails if that is over the startup budget.
 """
 
 import os
@@ -8,8 +11,91 @@ import sys
 import shutil
 import subprocess
 import platform
+import argparse
+
+STARTUP_BUDGET_MS = 1000  # Import time of the client up to the login screen
+# Imported only after login. Not PIL: customtkinter loads it itself, for CTkImage
+DEFERRED_MODULES = ["asyncio", "cryptography", "sqlite3"]
+IMPORT_RUNS = 3  # The fastest run counts, the first may have a cold disk cache
+
+def measure_startup(main_script):
+    """
+    Imports main_script the way the app starts up, under -X importtime.
+    Returns its total import time in ms, {module it imports directly: ms}
+    and the names of every module loaded along the way.
+    """
+    directory = os.path.dirname(os.path.abspath(main_script))
+    module = os.path.splitext(os.path.basename(main_script))[0]
+    best = None
+    for _ in range(IMPORT_RUNS):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=directory, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        total = 0
+        imports = {}
+        loaded = set()
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package, indented by depth
+            if not line.startswith("import time:"):
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if not cumulative.strip().isdigit():
+                continue  # Column headings
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            name = name.strip()
+            # A module is listed after everything it imports, so what came
+            # since the last top-level line belongs to this one
+            if depth > 0:
+                loaded.add(name)
+                if depth == 1:
+                    imports[name] = int(cumulative) / 1000
+            elif name == module:
+                total = int(cumulative) / 1000
+                loaded.add(name)
+                break
+            else:
+                imports = {}
+                loaded = set()
+        if best is None or total < best[0]:
+            best = (total, imports, loaded)
+    return best
+
+def check_startup(main_script, budget_ms):
+    print("\nMeasuring startup imports...")
+    try:
+        total, imports, loaded = measure_startup(main_script)
+    except RuntimeError as e:
+        print(f"[✗] Could not import {main_script}: {e}")
+        return False
+    for name, ms in sorted(imports.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {ms:8.1f} ms  {name}")
+    print(f"  {total:8.1f} ms  total, budget {budget_ms} ms")
+    
+    ok = True
+    for name in DEFERRED_MODULES:
+        if name in loaded:
+            print(f"[✗] {name} is imported before login, import it in import_session_modules()")
+            ok = False
+    if total > budget_ms:
+        print(f"[✗] Startup imports take {total:.0f} ms, over the budget of {budget_ms} ms")
+        ok = False
+    if ok:
+        print("[✓] Startup imports are within budget")
+    return ok
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
 
 def main():
+    parser = argparse.ArgumentParser(description="Build the Secure Messenger executable")
+    parser.add_argument("--onedir", action="store_true",
+                        help="Build a folder instead of a single file, starts faster as nothing is unpacked on launch")
+    parser.add_argument("--startup-budget-ms", type=int, default=STARTUP_BUDGET_MS,
+                        help=f"Longest the client may take to import up to the login screen (default: {STARTUP_BUDGET_MS})")
+    args = parser.parse_args()
+    
     # Print welcome message
     print("=" * 60)
     print("Secure Messenger - Build Script")
@@ -42,6 +128,13 @@ def main():
             subprocess.check_call([sys.executable, "-m", "pip", "install", lib])
             print(f"[✓] {lib} installed successfully")
     
+    # PyInstaller command
+    app_name = "SecureMessenger"
+    main_script = "client.py"  # Your main script file
+    
+    if not check_startup(main_script, args.startup_budget_ms):
+        return 1
+    
     print("\nPreparing to build executable...")
     
     # Create build directory if it doesn't exist
@@ -62,14 +155,11 @@ def main():
             icon_option = ["--icon", icon_path]
             print(f"[✓] Using icon: {icon_path}")
     
-    # PyInstaller command
-    app_name = "SecureMessenger"
-    main_script = "app.py"  # Your main script file
-    
     # Basic PyInstaller options
     pyinstaller_options = [
         "--name", app_name,
-        "--onefile",  # Create a single executable
+        # A single executable unpacks itself to a temporary folder on every launch
+        "--onedir" if args.onedir else "--onefile",
         "--windowed",  # Don't show console window
         "--clean",  # Clean PyInstaller cache
         "--noconfirm",  # Replace output directory without confirmation
@@ -112,7 +202,11 @@ def main():
         
         # Get output paths
         dist_path = os.path.abspath("dist")
-        executable_path = os.path.join(dist_path, app_name + (".exe" if platform.system() == "Windows" else ""))
+        executable_name = app_name + (".exe" if platform.system() == "Windows" else "")
+        if args.onedir:
+            executable_path = os.path.join(dist_path, app_name, executable_name)
+        else:
+            executable_path = os.path.join(dist_path, executable_name)
         
         print(f"\nExecutable created at: {executable_path}")
         print("\nBuild Information:")
@@ -120,7 +214,10 @@ def main():
         print(f"  - Python: {platform.python_version()}")
         
         # Get file size
-        size_bytes = os.path.getsize(executable_path)
+        if args.onedir:
+            size_bytes = directory_size(os.path.join(dist_path, app_name))
+        else:
+            size_bytes = os.path.getsize(executable_path)
         size_mb = size_bytes / (1024 * 1024)
         print(f"  - File Size: {size_mb:.2f} MB")
         
@@ -0,0 +1,723 @@
+"""
+Headless asyncio client.
+
+Everything the GUI does on the network, without the GUI: the handshake and
+cipher/format/compression negotiation, rooms, sending, decrypting, and
+reconnecting with history catch-up. Bots and integrations use it directly,
+MessageApp runs one on a background event loop.
+
+    async with ChatClient("127.0.0.1", 5555, "bot", KEY) as client:
+        await client.send("hello")
+        async for message in client:
+            print(message.room, message.sender, message.text)
+
+The client sends heartbeats once the server says it takes them, and treats
+a server that stays silent for HEARTBEAT_MISSES intervals as gone. Who is
+online comes as a snapshot followed by join/leave diffs, kept in .online.
+
+Files go through the server's spool with send_file(); a FILE message
+announces them and download() fetches them (see filetransfer.py). Both
+carry on by themselves across reconnects.
+
+The hello sets up session keys for the connection (see session.py), and
+the client waits for the welcome before sending anything else, as from
+then on every frame is sealed. A reconnect resumes the last session with
+its ticket, skipping the key exchange.
+
+Sessions are cheap: by default messages are decrypted on the event loop, so
+one process can run hundreds of them without a thread each. Pass workers
+(None for the default count) to decrypt in a DecryptPool instead.
+"""
+
+import asyncio
+import json
+import traceback
+from collections import namedtuple
+from ciphers import Keyring, available_suites
+from decryptpool import DecryptPool
+from filetransfer import (Download, TransferError, Upload, DOWNLOAD_WINDOW, UPLOAD_WINDOW,
+                          decode_info, encode_info)
+from framing import FrameDecoder, FrameError, encode_frame
+import msgcompress
+import session
+import wire
+
+# Message kinds
+MESSAGE = "message"
+DIRECT = "direct"  # Sent to us alone, room is None
+NOTICE = "notice"  # From the server or about the connection, sender is None
+FILE = "file"  # A file shared in a room, text is its name and file its FileInfo
+
+Message = namedtuple("Message", "kind room sender text seq file", defaults=(None,))
+
+READ_SIZE = 64 * 1024  # Receive buffer, grows only while a large frame is in flight
+RETRY_DELAY = 1         # Seconds before the first reconnect attempt
+MAX_RETRY_DELAY = 30    # Backoff doubles up to this
+HEARTBEAT_INTERVAL = 15  # Seconds between pings
+HEARTBEAT_MISSES = 3    # Silent intervals before the connection counts as dead
+HANDSHAKE_TIMEOUT = 10  # Seconds to wait for the welcome
+NAME_TIMEOUT = 5  # Seconds to wait for the names of senders before asking again
+PING = encode_frame(json.dumps({"type": "ping"}).encode())
+
+class ServerConnection(asyncio.BufferedProtocol):
+    """
+    The socket to the server. Received bytes land straight in a
+    FrameDecoder's buffer and the client handles the frames right there,
+    before the buffer is reused. Stands in for a StreamWriter on the
+    sending side; lost is done once the connection goes, with the error if
+    there was one.
+    """
+
+    def __init__(self, client, loop):
+        self.client = client
+        self.decoder = FrameDecoder(READ_SIZE)
+        self.transport = None
+        self.lost = loop.create_future()
+        self._loop = loop
+        self._error = None
+        self._paused = False
+        self._drain_waiters = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        try:
+            self.client._received(self.decoder.frames())
+        except FrameError as e:
+            self._error = e
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        if not self.lost.done():
+            self.lost.set_result(self._error or exc)
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError("connection lost"))
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        """Waits while the transport's buffer is full, like StreamWriter.drain()"""
+        if self.transport.is_closing():
+            raise ConnectionResetError("connection lost")
+        if not self._paused:
+            return
+        waiter = self._loop.create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self._drain_waiters.remove(waiter)
+
+    def close(self):
+        self.transport.close()
+
+class ChatClient:
+    """
+    One session with the server. on_message, if given, is called on the
+    event loop for every incoming Message; otherwise they are queued for
+    async iteration, which ends once the client is closed or gives up.
+    on_presence(joined, left) is called on the event loop whenever .online
+    changes.
+    """
+
+    def __init__(self, host, port, username, key, room="lobby", reconnect=True,
+                 workers=0, on_message=None, on_presence=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.room = room  # Where send() goes by default
+        self.rooms = {room}
+        self.reconnect = reconnect
+        self.connected = False
+        self.cipher = Keyring(key)  # Fernet until the server picks a suite
+        self.wire = "json"  # Message format, the server may switch us to binary
+        self.compressor = msgcompress.Compressor()  # Off until negotiated
+        self.last_seq = {}  # Room -> newest history sequence number seen
+        self.names = {}  # Sender id -> username, learnt from the server
+        self.pending_names = {}  # Sender id -> messages waiting for that name
+        self.recipients = {}  # Recipient id -> username, of direct messages we sent
+        self.failed = 0  # Messages dropped because they didn't parse or verify
+        self.online = set()  # Usernames the server says are online
+        self.transfers = {}  # Transfer id -> Upload or Download in progress
+        self.on_message = on_message
+        self.on_presence = on_presence
+        self._workers = workers
+        self._pool = None
+        self._incoming = asyncio.Queue()
+        self._writer = None  # ServerConnection of the current connection
+        self._handshake = None  # ClientHandshake, until the welcome answers it
+        self._welcome = None  # Future of the welcome, its result an error or None
+        self._task = None
+        self._heartbeat = None
+        self._online = asyncio.Event()  # Set while connected, and for good once closed
+        self._lost = None  # Future of the current connection, done once the reader sees it go
+        self._link = None  # LinkCipher of the connection's session, if it has one
+        self._resumption = None  # The session's resumption secret, waiting for its ticket
+        self._ticket = None  # (ticket, resumption secret, expiry) to resume with next time
+        self._own_id = wire.name_id(username)
+        self._last_received = 0
+        self._closing = False
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self._incoming.get()
+        if message is None:
+            self._incoming.put_nowait(None)  # Later iterations end too
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self):
+        """Connects and handshakes, raises OSError if the server can't be reached"""
+        self._loop = asyncio.get_running_loop()
+        connection = await self._open()
+        # Only once connected, a failed connect leaves no worker threads behind. Whatever
+        # came with the welcome was decrypted inline, ahead of anything the pool gets
+        if self._workers != 0 and self._pool is None:
+            self._pool = DecryptPool(self._decrypt_token, self._pool_done, self._workers)
+        self._task = self._loop.create_task(self._run(connection))
+
+    async def close(self):
+        self._closing = True
+        self._online.set()  # Transfers waiting for a connection give up
+        self._connection_lost()
+        self._stop_heartbeat()
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            # Also stops a reconnect that is waiting out its backoff
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._incoming.put_nowait(None)
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    # Sending
+
+    async def send(self, text, room=None):
+        await self.send_many([text], room)
+
+    async def send_many(self, texts, room=None):
+        """Sends several messages with one write, the server reads them back to back"""
+        writer = self._require_connection()
+        writer.write(b"".join(self._seal(self._message_frame(text, room or self.room)) for text in texts))
+        await writer.drain()
+
+    async def send_direct(self, username, text):
+        """Sends a message to one user, the server holds it for them if they are offline"""
+        plaintext = self.compressor.compress(text.encode())
+        if self.wire == "binary":
+            self.recipients[wire.name_id(username)] = username
+            frame = wire.pack(wire.DIRECT, wire.name_id(self.username), wire.name_id(username), 0,
+                              self.cipher.encrypt(plaintext))
+        else:
+            message = {"type": "direct", "to": username, "data": self.cipher.encrypt_text(plaintext)}
+            frame = encode_frame(json.dumps(message).encode())
+        writer = self._require_connection()
+        writer.write(self._seal(frame))
+        await writer.drain()
+
+    async def send_file(self, path, room=None, name=None):
+        """
+        Uploads a file and announces it to room, returns its FileInfo. Rides
+        out disconnects, raises TransferError if the server won't take it.
+        """
+        upload = Upload(path, name)
+        self.transfers[upload.id] = upload
+        try:
+            with open(path, "rb") as file:
+                return await self._transfer(upload, lambda: self._upload(upload, file, room or self.room))
+        finally:
+            del self.transfers[upload.id]
+
+    async def download(self, info, directory):
+        """
+        Fetches the file a FILE message announced into directory, returns the
+        path it was saved under. Rides out disconnects, raises TransferError
+        if the server no longer has it or it doesn't match its checksum.
+        """
+        if info.id in self.transfers:
+            raise TransferError("already being transferred")
+        download = Download(info, directory)
+        self.transfers[info.id] = download
+        try:
+            await self._transfer(download, lambda: self._download(download))
+            return download.finish()
+        finally:
+            download.close()
+            del self.transfers[info.id]
+
+    async def _transfer(self, transfer, attempt):
+        """Runs attempt() once per connection until one gets to the end"""
+        while True:
+            await self._online.wait()
+            if self._closing:
+                raise ConnectionError("client closed")
+            lost = self._lost
+            transfer.restart()
+            try:
+                return await attempt()
+            except asyncio.TimeoutError:
+                continue  # The server went quiet on this transfer, ask it again
+            except ConnectionError:
+                if not self.reconnect:
+                    raise
+                # A write can fail before the reader notices, wait for it to start over
+                await lost
+
+    async def _upload(self, upload, file, room):
+        await self._send_json(upload.request())
+        while not upload.ready:
+            await upload.wait()
+        while upload.done < upload.chunks:
+            if upload.sent < upload.chunks and upload.sent - upload.done < UPLOAD_WINDOW:
+                token = self.cipher.encrypt(upload.read(file, upload.sent))
+                frame = wire.pack(wire.CHUNK, wire.name_id(self.username), upload.id, upload.sent, token)
+                upload.sent += 1
+                await self._send_frame(frame)
+            else:
+                await upload.wait()
+        info = upload.info(file)
+        await self._send_frame(self._message_frame(encode_info(info), room, wire.FILE))
+        return info
+
+    async def _download(self, download):
+        await self._send_json(download.request())
+        acked = download.done
+        while download.done < download.chunks:
+            await download.wait()
+            # Half a window at a time, the server never runs dry
+            if download.done - acked >= DOWNLOAD_WINDOW // 2:
+                acked = download.done
+                await self._send_json({"type": "download-ack", "id": download.id, "chunks": acked})
+
+    async def join(self, room):
+        join = {"type": "join", "room": room}
+        if room in self.last_seq:
+            # Catch up on what was said since we were last here
+            join["since"] = self.last_seq[room]
+        await self._send_json(join)
+        self.rooms.add(room)
+
+    async def leave(self, room):
+        await self._send_json({"type": "leave", "room": room})
+        self.rooms.discard(room)
+
+    async def switch_room(self, room):
+        """Leaves the default room and makes room the new one"""
+        if room == self.room:
+            return
+        await self.leave(self.room)
+        await self.join(room)
+        self.room = room
+
+    def _message_frame(self, text, room, kind=wire.MESSAGE):
+        plaintext = self.compressor.compress(text.encode())
+        if self.wire == "binary":
+            return wire.pack(kind, wire.name_id(self.username), wire.name_id(room), 0,
+                             self.cipher.encrypt(plaintext))
+        message = {"from": self.username, "room": room, "data": self.cipher.encrypt_text(plaintext)}
+        if kind == wire.FILE:
+            message["type"] = "file"
+        return encode_frame(json.dumps(message).encode())
+
+    async def _send_json(self, message):
+        await self._send_frame(encode_frame(json.dumps(message).encode()))
+
+    async def _send_frame(self, frame):
+        writer = self._require_connection()
+        writer.write(self._seal(frame))
+        await writer.drain()
+
+    def _seal(self, frame):
+        # Seal right before writing, the session's counters follow the write order
+        return frame if self._link is None else self._link.seal(frame)
+
+    def _require_connection(self):
+        if not self.connected:
+            raise ConnectionError("not connected to the server")
+        return self._writer
+
+    # Connection
+
+    async def _open(self):
+        # Everything is renegotiated on a new connection
+        self.wire = "json"
+        self.compressor = msgcompress.Compressor()
+        self._link = self._resumption = None
+        self._handshake = session.ClientHandshake(self._take_ticket())
+        self._welcome = self._loop.create_future()
+        _, connection = await self._loop.create_connection(lambda: ServerConnection(self, self._loop),
+                                                           self.host, self.port)
+        self._writer = connection
+        self._lost = self._loop.create_future()
+        hello = {"username": self.username, "room": self.room, "ciphers": available_suites(),
+                 "formats": list(wire.FORMATS), "compression": msgcompress.available_codecs(),
+                 "heartbeat": HEARTBEAT_INTERVAL, "presence": True, "session": self._handshake.offer()}
+        if self.room in self.last_seq:
+            hello["since"] = self.last_seq[self.room]
+        self.connected = True
+        try:
+            await self._send_json(hello)
+            await self._wait_for_welcome(connection)
+        except BaseException:
+            self.connected = False
+            connection.close()
+            raise
+        for room in self.rooms - {self.room}:
+            await self.join(room)
+        self._online.set()
+        return connection
+
+    def _take_ticket(self):
+        ticket, self._ticket = self._ticket, None  # Good for one resumption
+        if ticket is None or ticket[2] < self._loop.time():
+            return None
+        return ticket[:2]
+
+    async def _wait_for_welcome(self, connection):
+        """Raises ConnectionError if the welcome doesn't come or makes no sense"""
+        await asyncio.wait((self._welcome, connection.lost), timeout=HANDSHAKE_TIMEOUT,
+                           return_when=asyncio.FIRST_COMPLETED)
+        if self._welcome.done():
+            error = self._welcome.result()
+        elif connection.lost.done():
+            error = "server closed the connection during the handshake"
+        else:
+            error = "no welcome from the server"
+        if error is not None:
+            raise ConnectionError(error)
+
+    def _welcome_received(self, frame):
+        """
+        Takes the welcome, the first frame of a connection. Runs as it comes
+        in, the frames right behind it may be sealed with the keys it brings.
+        """
+        try:
+            welcome = json.loads(str(frame, "utf-8"))
+            if welcome.get("type") != "welcome":
+                raise ValueError("expected a welcome")
+            self._parse_json(welcome)
+            keys = self._handshake.finish(welcome.get("session"))
+        except (ValueError, KeyError, FrameError) as e:
+            self._welcome.set_result(f"bad welcome: {e}")
+            raise FrameError("bad welcome") from None
+        if keys is not None:
+            self._link, self._resumption = keys
+        self._welcome.set_result(None)
+
+    async def _run(self, connection):
+        while True:
+            error = await connection.lost
+            error = "Disconnected from server" if error is None else f"Connection error: {error}"
+            self.connected = False
+            self._online.clear()
+            self._connection_lost()
+            self._stop_heartbeat()
+            self._writer.close()
+            if self._closing:
+                break
+            self._notice(error)
+            if not self.reconnect:
+                break
+            connection = await self._reopen()
+            if connection is None:
+                break
+        self._closing = True
+        self._online.set()
+        self._incoming.put_nowait(None)
+
+    def _connection_lost(self):
+        if self._lost is not None and not self._lost.done():
+            self._lost.set_result(None)
+        for transfer in self.transfers.values():
+            transfer.interrupt()
+
+    async def _reopen(self):
+        """Retries with backoff until connected, returns None if closed meanwhile"""
+        delay = RETRY_DELAY
+        while not self._closing:
+            await asyncio.sleep(delay)
+            try:
+                connection = await self._open()
+            except OSError:
+                self.connected = False
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            self._notice("Reconnected")
+            return connection
+        return None
+
+    def _received(self, frames):
+        """
+        Handles the frames of one read. They are views into the receive
+        buffer, valid only until this returns, so whatever is kept is copied.
+        Raises FrameError if the connection can't go on.
+        """
+        self._last_received = self._loop.time()
+        batch = []
+        for frame in frames:
+            if not self._welcome.done():
+                self._welcome_received(frame)
+                continue
+            if self._link is not None:
+                frame = self._link.open(frame)
+            try:
+                if wire.is_binary(frame):
+                    msg = self._parse_binary(frame)
+                else:
+                    msg = self._parse_json(json.loads(str(frame, "utf-8")))
+            except Exception:
+                # Whatever doesn't parse costs that frame, not the connection
+                self._decrypted([], 1)
+                continue
+            if msg is None:
+                continue
+
+            if "seq" in msg:
+                if msg["seq"] <= self.last_seq.get(msg["room"], 0):
+                    continue
+                self.last_seq[msg["room"]] = msg["seq"]
+                # History has what we said too, we have it already
+                if msg["from"] == self.username or msg.get("sender_id") == self._own_id:
+                    continue
+
+            if msg["from"] is None:
+                self._wait_for_name(msg)
+                continue
+            batch.append(msg)
+
+        if batch:
+            self._decrypt(batch)
+
+    def _parse_binary(self, frame):
+        """Returns a chat message from a binary frame, or None if it isn't for us"""
+        kind, sender_id, room_id, seq, body = wire.unpack(frame)
+        if kind == wire.CHUNK:
+            download = self.transfers.get(room_id)
+            if isinstance(download, Download):
+                download.chunk_received(seq, body, self.cipher)
+            return None
+        if kind == wire.DIRECT:
+            return {"from": self.names.get(sender_id), "sender_id": sender_id, "room": None,
+                    "direct": True, "data": bytes(body)}
+        if kind != wire.MESSAGE and kind != wire.FILE:
+            return None
+        for room in self.rooms:
+            if wire.name_id(room) == room_id:
+                break
+        else:
+            return None  # Still in flight from a room we just left
+        msg = {"from": self.names.get(sender_id), "sender_id": sender_id, "room": room,
+               "data": bytes(body), "file": kind == wire.FILE}
+        if seq:
+            msg["seq"] = seq
+        return msg
+
+    def _parse_json(self, msg):
+        """Handles control messages, returns chat messages"""
+        kind = msg.get("type")
+        if kind == "welcome":
+            self.cipher.select(msg["cipher"])
+            self.wire = msg.get("format", "json")
+            self.compressor = msgcompress.Compressor(msg.get("compression"))
+            self._notice(f"Encrypting with {msg['cipher']}")
+            if msg.get("heartbeat"):
+                # Older servers would take a ping for a chat message
+                self._stop_heartbeat()
+                self._heartbeat = self._loop.create_task(self._send_heartbeats(msg["heartbeat"]))
+            return None
+
+        if kind == "pong":
+            return None
+
+        if kind == "session-ticket":
+            if self._resumption is not None:
+                ticket = session.decode(msg["ticket"], session.TICKET_SIZE)
+                self._ticket = (ticket, self._resumption, self._loop.time() + msg["lifetime"])
+            return None
+
+        if kind == "presence":
+            self._update_presence(msg)
+            return None
+
+        if kind == "skipped":
+            # The server dropped our backlog because we fell behind
+            self._notice(f"{msg['count']} messages skipped while catching up")
+            return None
+
+        if kind == "names":
+            for sender_id, name in msg["users"].items():
+                sender_id = int(sender_id)
+                self.names[sender_id] = name or f"user-{sender_id:016x}"
+                waiting = self.pending_names.pop(sender_id, [])
+                for pending in waiting:
+                    pending["from"] = self.names[sender_id]
+                if waiting:
+                    self._decrypt(waiting)
+            return None
+
+        if kind in ("upload-ready", "upload-ack", "upload-error", "download-ready", "download-error"):
+            transfer = self.transfers.get(msg.get("id"))
+            if transfer is not None:
+                transfer.update(msg)
+            return None
+
+        if kind == "undeliverable":
+            recipient = self.recipients.get(msg.get("id"), msg["to"])
+            self._notice(f"Couldn't deliver to {recipient}: {msg.get('reason', 'unknown reason')}")
+            return None
+
+        if kind == "direct":
+            if not isinstance(msg.get("from"), str) or not isinstance(msg.get("data"), str):
+                raise ValueError("malformed message")
+            msg["room"] = None
+            msg["direct"] = True
+            return msg
+
+        msg["file"] = kind == "file"
+        msg.setdefault("room", self.room)
+        # Still in flight from a room we just left
+        if msg["room"] not in self.rooms:
+            return None
+        if not isinstance(msg.get("from"), str) or not isinstance(msg.get("data"), str):
+            raise ValueError("malformed message")
+        return msg
+
+    def _wait_for_name(self, msg):
+        """Holds a message until the server tells us who sent it"""
+        waiting = self.pending_names.setdefault(msg["sender_id"], [])
+        waiting.append(msg)
+        if len(waiting) == 1:
+            self._ask_for_name(msg["sender_id"])
+
+    def _ask_for_name(self, sender_id):
+        """Asks who sender_id is, and again every NAME_TIMEOUT until the answer comes"""
+        if self._closing or sender_id not in self.pending_names:
+            return
+        if self.connected:
+            self._writer.write(self._seal(encode_frame(json.dumps({"type": "who", "ids": [sender_id]}).encode())))
+        self._loop.call_later(NAME_TIMEOUT, self._ask_for_name, sender_id)
+
+    async def _send_heartbeats(self, interval):
+        self._last_received = self._loop.time()
+        while True:
+            await asyncio.sleep(interval)
+            if self._loop.time() - self._last_received > interval * HEARTBEAT_MISSES:
+                # Half-open, reading would wait forever; the reader reconnects
+                self._writer.transport.abort()
+                return
+            try:
+                self._writer.write(self._seal(PING))
+            except (OSError, RuntimeError):
+                return
+
+    def _stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+
+    def _update_presence(self, msg):
+        if "online" in msg:
+            # A snapshot, after connecting; reported as a diff against what we had
+            online = set(msg["online"])
+            joined = sorted(online - self.online)
+            left = sorted(self.online - online)
+            self.online = online
+        else:
+            joined = msg.get("joined", [])
+            left = msg.get("left", [])
+            self.online.update(joined)
+            self.online.difference_update(left)
+        if (joined or left) and self.on_presence is not None:
+            self._callback(self.on_presence, joined, left)
+
+    # Decryption
+
+    def _decrypt(self, batch):
+        if self._pool is not None:
+            self._pool.submit(batch)
+            return
+        results = []
+        failed = 0
+        for msg in batch:
+            try:
+                results.append((msg, self._decrypt_token(msg["data"])))
+            except Exception:
+                failed += 1
+        self._decrypted(results, failed)
+
+    def _decrypt_token(self, token):
+        """Verifies and decrypts one message, may run on a decrypt worker"""
+        if isinstance(token, str):
+            plaintext = self.cipher.decrypt_text(token)
+        else:
+            plaintext = self.cipher.decrypt(token)
+        return msgcompress.decompress(plaintext).decode()
+
+    def _pool_done(self, results, failed):
+        """Called from the decrypt workers, hands results back to the event loop"""
+        self._loop.call_soon_threadsafe(self._decrypted, results, failed)
+
+    def _decrypted(self, results, failed):
+        for msg, text in results:
+            if msg.get("file"):
+                try:
+                    info = decode_info(text)
+                except ValueError:
+                    failed += 1
+                    continue
+                self._emit(Message(FILE, msg["room"], msg["from"], info.name, msg.get("seq"), info))
+            elif msg["from"] == "SYSTEM":
+                self._emit(Message(NOTICE, msg["room"], None, text, msg.get("seq")))
+            elif msg.get("direct"):
+                self._emit(Message(DIRECT, None, msg["from"], text, None))
+            else:
+                self._emit(Message(MESSAGE, msg["room"], msg["from"], text, msg.get("seq")))
+        if failed:
+            self.failed += failed
+            self._notice(f"Dropped {failed} message(s) that failed verification ({self.failed} so far)")
+
+    def _notice(self, text):
+        self._emit(Message(NOTICE, self.room, None, text, None))
+
+    def _emit(self, message):
+        if self.on_message is not None:
+            self._callback(self.on_message, message)
+        else:
+            self._incoming.put_nowait(message)
+
+    def _callback(self, callback, *args):
+        # A bug in the callback costs that one message, not the connection
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
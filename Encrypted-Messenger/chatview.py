@@ -0,0 +1,229 @@
+"""
+Virtualized chat view for the client.
+
+Messages are kept in a plain list and only the slice that fits on screen
+is drawn. A fixed pool of bubble widgets is stacked from the bottom up and
+reconfigured as the view scrolls, so widget count, fonts and redraw cost
+stay the same whether the conversation has ten messages or 100k.
+"""
+
+import customtkinter as ctk
+
+POOL_SIZE = 24   # Bubbles in the pool, enough to cover a tall window with short messages
+WHEEL_STEP = 3   # Messages moved per mouse wheel notch
+
+# A message is a tuple (kind, sender, text, timestamp), kind being
+# "user" for our own messages, "other" or "system". A file's message has
+# an Attachment as a fifth item.
+USER, OTHER, SYSTEM = "user", "other", "system"
+
+class Attachment:
+    """
+    A file shown in a bubble. path is None until it is on disk, file is
+    what to fetch meanwhile; image is its thumbnail once one is made.
+    """
+
+    def __init__(self, path=None, file=None):
+        self.path = path
+        self.file = file
+        self.image = None
+        self.fetching = False
+
+class MessageBubble(ctk.CTkFrame):
+    """A reusable bubble, show() points it at a different message"""
+
+    def __init__(self, master, colors, fonts, on_open=None):
+        super().__init__(master, fg_color="transparent")
+        self.colors = colors
+        self.fonts = fonts
+        self.on_open = on_open
+        self.message = None
+
+        self.name_label = ctk.CTkLabel(self, font=fonts["name"], text_color=colors["text_secondary"])
+        self.container = ctk.CTkFrame(self, corner_radius=18)
+        self.image_label = ctk.CTkLabel(self.container, text="")
+        self.text_label = ctk.CTkLabel(self.container, wraplength=350, justify="left")
+        self.time_label = ctk.CTkLabel(self.container, font=fonts["time"])
+        for widget in (self.container, self.image_label, self.text_label):
+            widget.bind("<Button-1>", self.clicked)
+
+    def clicked(self, event):
+        attachment = self.message[4] if self.message is not None and len(self.message) > 4 else None
+        if attachment is not None and self.on_open is not None:
+            self.on_open(attachment)
+
+    def show(self, message):
+        if message is self.message:
+            return
+        self.message = message
+        kind, sender, text, timestamp = message[:4]
+        attachment = message[4] if len(message) > 4 else None
+        colors = self.colors
+
+        for widget in (self.name_label, self.container, self.image_label, self.text_label, self.time_label):
+            widget.pack_forget()
+
+        if kind == SYSTEM:
+            self.container.configure(fg_color=colors["bg_secondary"], corner_radius=10)
+            self.container.pack(anchor="center")
+            self.text_label.configure(text=text, font=self.fonts["system"], text_color=colors["text_secondary"])
+            self.text_label.pack(padx=15, pady=5)
+            return
+
+        is_user = kind == USER
+        if not is_user:
+            self.name_label.configure(text=sender)
+            self.name_label.pack(anchor="w", padx=(10, 0), pady=(0, 2))
+
+        self.container.configure(fg_color=colors["user_bubble"] if is_user else colors["other_bubble"],
+                                 corner_radius=18)
+        self.container.pack(side="right" if is_user else "left", anchor="e" if is_user else "w")
+        if attachment is not None and attachment.image is not None:
+            self.image_label.configure(image=attachment.image)
+            self.image_label.pack(padx=8, pady=(8, 0))
+        self.text_label.configure(text=text, font=self.fonts["body"],
+                                  text_color="#ffffff" if is_user else colors["text_primary"])
+        self.text_label.pack(padx=15, pady=10)
+        self.time_label.configure(text=timestamp,
+                                  text_color="#d0d0d0" if is_user else colors["text_secondary"])
+        self.time_label.pack(padx=10, pady=(0, 5), anchor="se")
+
+class ChatView(ctk.CTkFrame):
+    """
+    Scrollable list of messages backed by self.messages. on_top(), if
+    given, is called once the view reaches the oldest loaded message, to
+    prepend() older ones; on_bottom() likewise at the newest, to append()
+    newer ones when the view shows a stretch of the past. on_open(attachment)
+    is called when a file's bubble is clicked.
+    """
+
+    def __init__(self, master, colors, pool_size=POOL_SIZE, on_top=None, on_bottom=None, on_open=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.messages = []
+        self.view_end = 0  # One past the newest message on screen
+        self.on_top = on_top
+        self.on_bottom = on_bottom
+        self.top_pending = False
+        self.bottom_pending = False
+
+        # Created once and shared by every bubble
+        self.fonts = {
+            "name": ctk.CTkFont(family="Segoe UI", size=12),
+            "body": ctk.CTkFont(family="Segoe UI", size=14),
+            "time": ctk.CTkFont(family="Segoe UI", size=10),
+            "system": ctk.CTkFont(family="Segoe UI", size=12),
+        }
+
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.viewport = ctk.CTkFrame(self, fg_color="transparent")
+        self.viewport.pack(side="left", fill="both", expand=True)
+        # Bubbles past the top edge get clipped instead of growing the frame
+        self.viewport.pack_propagate(False)
+
+        self.bubbles = [MessageBubble(self.viewport, colors, self.fonts, on_open) for _ in range(pool_size)]
+
+        self.bind_all("<MouseWheel>", self.on_mousewheel, add="+")
+        self.bind_all("<Button-4>", self.on_mousewheel, add="+")
+        self.bind_all("<Button-5>", self.on_mousewheel, add="+")
+
+    def add(self, message):
+        self.extend((message,))
+
+    def extend(self, messages):
+        """Appends messages, following them if the view was at the bottom"""
+        at_bottom = self.view_end == len(self.messages)
+        self.messages.extend(messages)
+        if at_bottom:
+            self.view_end = len(self.messages)
+        self.render()
+
+    def prepend(self, messages):
+        """Inserts older messages above the loaded ones, the view stays where it is"""
+        self.messages[:0] = messages
+        self.view_end += len(messages)
+        self.render()
+
+    def append(self, messages):
+        """Adds newer messages below the loaded ones, the view stays where it is"""
+        self.messages.extend(messages)
+        self.render()
+
+    def reset(self, messages=()):
+        """Replaces everything, showing the newest message"""
+        self.messages = list(messages)
+        self.view_end = len(self.messages)
+        self.render()
+
+    def refresh(self):
+        """Redraws the bubbles on screen, after something they show changed"""
+        for bubble in self.bubbles:
+            bubble.message = None
+        self.render()
+
+    def scroll_to(self, index):
+        """Brings messages[index] to the bottom of the view"""
+        self.view_end = index + 1
+        self.render()
+
+    def scroll_by(self, count):
+        self.view_end += count
+        self.render()
+
+    def render(self):
+        total = len(self.messages)
+        self.view_end = max(min(self.view_end, total), min(total, len(self.bubbles)))
+
+        for i, bubble in enumerate(self.bubbles):
+            index = self.view_end - 1 - i
+            if index >= 0:
+                bubble.show(self.messages[index])
+                # Unused bubbles are always the topmost ones, so re-packing keeps the order
+                if not bubble.winfo_manager():
+                    bubble.pack(side="bottom", fill="x", pady=5, padx=10)
+            elif bubble.winfo_manager():
+                bubble.pack_forget()
+
+        if total:
+            shown = min(self.view_end, len(self.bubbles))
+            self.scrollbar.set((self.view_end - shown) / total, self.view_end / total)
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+        # The oldest message is on screen, ask for more once the UI is idle
+        if self.on_top is not None and self.view_end <= len(self.bubbles) and not self.top_pending:
+            self.top_pending = True
+            self.after_idle(self.load_older)
+        if self.on_bottom is not None and self.view_end == total and not self.bottom_pending:
+            self.bottom_pending = True
+            self.after_idle(self.load_newer)
+
+    # The view may have moved on since these were scheduled
+    def load_older(self):
+        self.top_pending = False
+        if self.view_end <= len(self.bubbles):
+            self.on_top()
+
+    def load_newer(self):
+        self.bottom_pending = False
+        if self.view_end == len(self.messages):
+            self.on_bottom()
+
+    def on_scrollbar(self, *args):
+        if args[0] == "moveto":
+            shown = min(len(self.messages), len(self.bubbles))
+            self.view_end = round(float(args[1]) * len(self.messages)) + shown
+            self.render()
+        elif args[0] == "scroll":
+            step = len(self.bubbles) if args[2] == "pages" else WHEEL_STEP
+            self.scroll_by(int(args[1]) * step)
+
+    def on_mousewheel(self, event):
+        # bind_all sees every wheel event in the app, only react to our own
+        if not str(event.widget).startswith(str(self)):
+            return
+        if event.num == 4 or event.delta > 0:
+            self.scroll_by(-WHEEL_STEP)
+        else:
+            self.scroll_by(WHEEL_STEP)
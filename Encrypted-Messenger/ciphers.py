@@ -0,0 +1,150 @@
+"""
+Cipher suites for message payloads.
+
+Every suite turns plaintext into a raw binary token whose first byte says
+which suite made it, so a receiver can open any token it gets no matter
+what the sender negotiated:
+
+  fernet             0x80 (Fernet's own version byte), kept for older clients
+  aes-gcm            0x01 | 12-byte nonce | ciphertext + 16-byte tag
+  chacha20-poly1305  0x02 | 12-byte nonce | ciphertext + 16-byte tag
+
+The AEAD suites authenticate the suite byte as associated data. Their keys
+are derived from the shared secret with HKDF, one per suite.
+
+Each sender negotiates its suite, but everyone in the room has to open
+its tokens, and clients from before the negotiation only read Fernet. So
+servers stick to Fernet until the operator lists the AEAD suites, once
+every client can read them.
+
+The server only negotiates, it never encrypts, so this module imports
+without the cryptography package; the suites themselves need it.
+"""
+
+import base64
+import os
+
+try:
+    from cryptography.fernet import Fernet
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:  # Server side, or cryptography not installed
+    Fernet = AESGCM = ChaCha20Poly1305 = None
+
+NONCE_SIZE = 12
+
+# Most preferred first
+PREFERENCE = ("aes-gcm", "chacha20-poly1305", "fernet")
+FALLBACK = "fernet"
+
+def negotiate(offered, preference=PREFERENCE):
+    """Picks the first suite in preference the peer offered"""
+    for name in preference:
+        if name in offered:
+            return name
+    return FALLBACK
+
+class CipherSuite:
+    name = None
+    suite_id = None
+
+    def encrypt(self, plaintext):
+        raise NotImplementedError
+
+    def decrypt(self, token):
+        raise NotImplementedError
+
+class FernetSuite(CipherSuite):
+    name = "fernet"
+    suite_id = 0x80
+
+    def __init__(self, key):
+        self._fernet = Fernet(key)
+
+    def encrypt(self, plaintext):
+        return base64.urlsafe_b64decode(self._fernet.encrypt(plaintext))
+
+    def decrypt(self, token):
+        return self._fernet.decrypt(base64.urlsafe_b64encode(token))
+
+class AEADSuite(CipherSuite):
+    algorithm = None
+
+    def __init__(self, key):
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                    info=b"secure-messenger " + self.name.encode())
+        self._aead = self.algorithm(hkdf.derive(base64.urlsafe_b64decode(key)))
+        self._header = bytes((self.suite_id,))
+
+    def encrypt(self, plaintext):
+        nonce = os.urandom(NONCE_SIZE)
+        return self._header + nonce + self._aead.encrypt(nonce, plaintext, self._header)
+
+    def decrypt(self, token):
+        token = memoryview(token)
+        return self._aead.decrypt(token[1:1 + NONCE_SIZE], token[1 + NONCE_SIZE:], token[:1])
+
+class AESGCMSuite(AEADSuite):
+    name = "aes-gcm"
+    suite_id = 0x01
+    algorithm = AESGCM
+
+class ChaCha20Poly1305Suite(AEADSuite):
+    name = "chacha20-poly1305"
+    suite_id = 0x02
+    algorithm = ChaCha20Poly1305
+
+SUITES = {cls.name: cls for cls in (FernetSuite, AESGCMSuite, ChaCha20Poly1305Suite)}
+
+def available_suites():
+    """Names of the suites this process can run, in preference order"""
+    if Fernet is None:
+        return []
+    names = []
+    for name in PREFERENCE:
+        try:
+            # ChaCha20 isn't in every OpenSSL build
+            SUITES[name](base64.urlsafe_b64encode(bytes(32)))
+        except Exception:
+            continue
+        names.append(name)
+    return names
+
+class Keyring:
+    """
+    Every available suite keyed from one shared secret. Encrypts with the
+    negotiated suite, decrypts whatever suite a token names.
+    """
+
+    def __init__(self, key, suite=FALLBACK):
+        self.suites = {}
+        for name in available_suites():
+            instance = SUITES[name](key)
+            self.suites[instance.suite_id] = instance
+        self.select(suite)
+
+    def select(self, name):
+        for suite in self.suites.values():
+            if suite.name == name:
+                self.active = suite
+                return
+        raise ValueError(f"cipher suite {name} isn't available")
+
+    def encrypt(self, plaintext):
+        return self.active.encrypt(plaintext)
+
+    def decrypt(self, token):
+        suite = self.suites.get(token[0]) if token else None
+        if suite is None:
+            raise ValueError("unknown cipher suite")
+        return suite.decrypt(token)
+
+    # JSON can't carry bytes, there tokens travel as urlsafe base64. A Fernet
+    # token comes out as the usual Fernet string, so older clients can read it.
+
+    def encrypt_text(self, plaintext):
+        return base64.urlsafe_b64encode(self.encrypt(plaintext)).decode()
+
+    def decrypt_text(self, data):
+        return self.decrypt(base64.urlsafe_b64decode(data))
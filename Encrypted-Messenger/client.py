@@ -1,19 +1,25 @@
-import socket
 import threading
-import json
+import queue
 import customtkinter as ctk
-from cryptography.fernet import Fernet
+from tkinter import filedialog
 from datetime import datetime
-from PIL import Image, ImageTk
 import os
+import subprocess
+import sys
 from typing import Optional
 import time
+from chatview import ChatView, Attachment, USER, OTHER, SYSTEM
 
 # Init
 ctk.set_appearance_mode("system")  # Use system theme by default, with toggle option
 ctk.set_default_color_theme("blue")
 
 # Constants
+UI_TICK_MS = 50  # How often the UI thread applies messages received in the meantime
+SNIPPET_LENGTH = 70  # Characters of a message shown per search result
+DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), "Downloads", "Secure Messenger")
+AUTO_FETCH_BYTES = 2 * 1024 * 1024  # Images up to this size are fetched for a thumbnail, other files on a click
+
 THEME_COLORS = {
     "dark": {
         "bg_primary": "#121212",
@@ -39,23 +45,79 @@ THEME_COLORS = {
     }
 }
 
+def import_session_modules():
+    """
+    Imports what only the chat needs: asyncio, the network client,
+    cryptography, SQLite and the thumbnails. Left out of the module imports
+    so the login screen comes up without waiting for them; build.py checks
+    it stays that way.
+    """
+    global asyncio, ChatClient, MESSAGE, DIRECT, FILE, Keyring, available_suites
+    global HistoryCache, PAGE_SIZE, default_path, local_key, SearchIndex, Upload, ThumbnailPool, is_image
+    import asyncio
+    from chatclient import ChatClient, MESSAGE, DIRECT, FILE
+    from ciphers import Keyring, available_suites
+    from historycache import HistoryCache, PAGE_SIZE, default_path, local_key
+    from searchindex import SearchIndex
+    from filetransfer import Upload
+    from thumbnails import ThumbnailPool, is_image
+
+def format_size(size):
+    for unit in ("bytes", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def open_file(path):
+    """Opens a file with whatever the system opens that kind of file with"""
+    if sys.platform == "win32":
+        os.startfile(path)
+    else:
+        subprocess.Popen(["open" if sys.platform == "darwin" else "xdg-open", path])
+
+def format_time(at):
+    """HH:MM for today, with the date for anything older"""
+    moment = datetime.fromtimestamp(at)
+    if moment.date() == datetime.now().date():
+        return moment.strftime("%H:%M")
+    return moment.strftime("%d %b %H:%M")
+
 class MessageApp(ctk.CTk):
     def __init__(self):
         super().__init__()
         self.title("Secure Messenger")
         self.geometry("600x750")
         self.minsize(500, 600)
+        self.init_state()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         
-        # App state
+        # Create login screen first
+        self.create_login_screen()
+        
+        # Get the chat's imports out of the way while the user types
+        self.after_idle(lambda: threading.Thread(target=import_session_modules, daemon=True).start())
+    
+    def init_state(self):
+        """Everything but the widgets, so the networking can also run without a window"""
         self.theme = "dark"  # Fixed dark theme
         self.username = ""
-        self.users_online = []
-        self.client = None
-        self.cipher = None
+        self.room = "lobby"
+        self.users_online = []  # Sorted, kept up to date from the server's presence diffs
+        self.presence = queue.SimpleQueue()  # (joined, left) diffs from the network thread
+        self.client = None  # ChatClient, does all the network work
+        self.loop = None  # Event loop the client runs on, in its own thread
         self.status = "disconnected"
-        
-        # Create login screen first
-        self.create_login_screen()
+        self.inbox = queue.SimpleQueue()  # (history id, message) from the network thread, drained by the UI tick
+        self.ui_tick = None
+        self.history = None  # HistoryCache of this user on this server
+        self.oldest_id = None  # Cache id of the oldest message loaded into the view
+        self.history_done = True  # Nothing older left in the cache for this room
+        self.newest_id = 0  # Cache id of the newest message the view loaded from the cache
+        self.live = True  # The view runs up to the present, False after jumping to a search result
+        self.index = None  # SearchIndex over the history
+        self.transfers_done = queue.SimpleQueue()  # (attachment, name, future) of finished transfers
+        self.thumbnails = None  # ThumbnailPool, once logged in
         
     def create_login_screen(self):
         # Clear any existing widgets
@@ -143,27 +205,49 @@ class MessageApp(ctk.CTk):
             return
             
         try:
-            port = int(port)
-            self.username = username
-            
-            # Initialize encryption
-            aes_key = b'SXGguPKB6mbAFrfEKLE6uJko4Xu2DkLkPe2VJ8cAFeA='
-            self.cipher = Fernet(aes_key)
-            
-            # Create socket and connect
-            self.client = socket.socket()
-            self.client.connect((server, port))
-            self.client.send(json.dumps({"username": username}).encode())
+            self.log_in(username, server, int(port))
             
             # If connection successful, switch to chat screen
             self.create_chat_interface()
             
-            # Start listening for messages
-            threading.Thread(target=self.receive_messages, daemon=True).start()
-            
         except Exception as e:
             self.show_error(f"Connection failed: {str(e)}")
     
+    def log_in(self, username, server, port):
+        """Opens the history and connects, raises if the server can't be reached"""
+        # Usually done by now, started when the login screen came up
+        import_session_modules()
+        self.username = username
+        
+        # Network and decryption run on an event loop in the background
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        
+        # Connect, the client keeps reconnecting on its own after this. Messages
+        # (the welcome's notice, for one) arrive before connect() returns, so
+        # they are handled with the client they came from, not self.client.
+        aes_key = b'SXGguPKB6mbAFrfEKLE6uJko4Xu2DkLkPe2VJ8cAFeA='
+        client = ChatClient(server, port, username, aes_key, room=self.room,
+                            workers=None, on_message=lambda message: self.on_message(client, message),
+                            on_presence=lambda joined, left: self.presence.put((joined, left)))
+            
+        # Local history, the server only needs to send what came after it
+        if self.history is not None:
+            self.history.close()
+        self.history = HistoryCache(default_path(username, server, port),
+                                    Keyring(local_key(), available_suites()[0]))
+        client.last_seq.update(self.history.last_seqs())
+        if self.thumbnails is None:
+            self.thumbnails = ThumbnailPool()
+        
+        # Searchable right away for new messages, the older ones get indexed in the background
+        self.index = SearchIndex()
+        threading.Thread(target=self.index.build, args=(self.history.scan(self.history.first_id),),
+                         daemon=True).start()
+        self.run(client.connect()).result()
+        self.client = client
+    
     def show_error(self, message):
         error_window = ctk.CTkToplevel(self)
         error_window.title("Error")
@@ -191,8 +275,8 @@ class MessageApp(ctk.CTk):
         for widget in self.winfo_children():
             widget.destroy()
             
-        # Update window title with username
-        self.title(f"Secure Messenger - {self.username}")
+        # Update window title with username and room
+        self.title(f"Secure Messenger - {self.username} #{self.room}")
         self.status = "connected"
         
         # Main content frame
@@ -214,18 +298,66 @@ class MessageApp(ctk.CTk):
         self.status_frame = ctk.CTkFrame(header_frame, fg_color="#22c55e", width=12, height=12, corner_radius=6)
         self.status_frame.pack(side="left", padx=(10, 0))
         
+        # Messages applied by the last UI tick
+        self.batch_label = ctk.CTkLabel(header_frame, text="",
+                                      font=ctk.CTkFont(family="Segoe UI", size=11),
+                                      text_color=THEME_COLORS[self.theme]["text_secondary"])
+        self.batch_label.pack(side="left", padx=(10, 0))
+        
+        # Files on their way up or down
+        self.transfer_label = ctk.CTkLabel(header_frame, text="",
+                                         font=ctk.CTkFont(family="Segoe UI", size=11),
+                                         text_color=THEME_COLORS[self.theme]["text_secondary"])
+        self.transfer_label.pack(side="left", padx=(10, 0))
+        
+        # Room switcher
+        self.room_entry = ctk.CTkEntry(header_frame, placeholder_text="Room", width=140, height=32,
+                                     font=ctk.CTkFont(family="Segoe UI", size=13), corner_radius=10)
+        self.room_entry.pack(side="right", padx=(0, 20))
+        self.room_entry.insert(0, self.room)
+        self.room_entry.bind("<Return>", lambda e: self.switch_room())
+        
+        room_label = ctk.CTkLabel(header_frame, text="Room",
+                                font=ctk.CTkFont(family="Segoe UI", size=13),
+                                text_color=THEME_COLORS[self.theme]["text_secondary"])
+        room_label.pack(side="right", padx=(0, 8))
+        
+        # Search over the local history
+        self.search_entry = ctk.CTkEntry(header_frame, placeholder_text="Search", width=140, height=32,
+                                       font=ctk.CTkFont(family="Segoe UI", size=13), corner_radius=10)
+        self.search_entry.pack(side="right", padx=(0, 16))
+        self.search_entry.bind("<Return>", lambda e: self.search())
+        
         # Chat container - will hold messages and sidebar
         chat_container = ctk.CTkFrame(main_frame, fg_color="transparent")
         chat_container.pack(fill="both", expand=True, padx=0, pady=0)
         
+        # Online users sidebar
+        sidebar = ctk.CTkFrame(chat_container, width=160, fg_color=THEME_COLORS[self.theme]["bg_secondary"],
+                             corner_radius=0)
+        sidebar.pack(side="right", fill="y")
+        sidebar.pack_propagate(False)
+        
+        self.online_label = ctk.CTkLabel(sidebar, text="Online",
+                                       font=ctk.CTkFont(family="Segoe UI", size=13, weight="bold"))
+        self.online_label.pack(anchor="w", padx=12, pady=(12, 4))
+        
+        # One text widget rather than a label per user, the list can get long
+        self.online_list = ctk.CTkTextbox(sidebar, font=ctk.CTkFont(family="Segoe UI", size=13),
+                                        fg_color="transparent", activate_scrollbars=True, wrap="none")
+        self.online_list.pack(fill="both", expand=True, padx=(6, 0), pady=(0, 10))
+        self.show_users_online()
+        
         # Create chat area
         chat_area = ctk.CTkFrame(chat_container, fg_color=THEME_COLORS[self.theme]["bg_primary"], corner_radius=0)
         chat_area.pack(side="left", fill="both", expand=True)
         
-        # Scrollable message area
-        self.messages_frame = ctk.CTkScrollableFrame(chat_area, fg_color="transparent", 
-                                                  corner_radius=0)
-        self.messages_frame.pack(fill="both", expand=True, padx=10, pady=10)
+        # Message area, only draws the messages currently in view
+        self.chat_view = ChatView(chat_area, THEME_COLORS[self.theme], on_top=self.load_older,
+                                  on_bottom=self.load_newer, on_open=self.open_attachment,
+                                  fg_color="transparent", corner_radius=0)
+        self.chat_view.pack(fill="both", expand=True, padx=10, pady=10)
+        self.load_history()
         
         # Input area frame
         input_area = ctk.CTkFrame(chat_area, height=80, fg_color=THEME_COLORS[self.theme]["bg_secondary"],
@@ -249,6 +381,13 @@ class MessageApp(ctk.CTk):
                                command=self.send_message)
         send_btn.pack(side="right", padx=(0, 20), pady=15)
         
+        # Attach button
+        attach_btn = ctk.CTkButton(input_area, text="📎", width=40, height=40,
+                                 corner_radius=20, fg_color=THEME_COLORS[self.theme]["input_bg"],
+                                 hover_color=THEME_COLORS[self.theme]["bg_primary"],
+                                 command=self.send_file)
+        attach_btn.pack(side="right", padx=(0, 8), pady=15)
+        
         # Welcome message
         self.add_system_message(f"Welcome to Secure Messenger, {self.username}!")
         self.add_system_message("Your messages are encrypted end-to-end.")
@@ -256,117 +395,328 @@ class MessageApp(ctk.CTk):
         # Focus the message entry
         self.message_entry.focus()
         
+        # Start applying incoming messages
+        if self.ui_tick is not None:
+            self.after_cancel(self.ui_tick)
+        self.ui_tick = self.after(UI_TICK_MS, self.drain_inbox)
+    
+    def drain_inbox(self):
+        """Applies everything the network thread queued since the last tick in one pass"""
+        batch = self.take_inbox()
+        if batch:
+            # One layout pass and one scroll for the whole batch
+            self.chat_view.extend(batch)
+            self.batch_label.configure(text=f"{len(batch)} msg/tick")
+        
+        # Presence diffs, folded together and redrawn once
+        online = None
+        while True:
+            try:
+                joined, left = self.presence.get_nowait()
+            except queue.Empty:
+                break
+            if online is None:
+                online = set(self.users_online)
+            online.update(joined)
+            online.difference_update(left)
+        if online is not None:
+            self.users_online = sorted(online)
+            self.show_users_online()
+        self.update_transfers()
+        
+        status = "connected" if self.client.connected else "disconnected"
+        if status != self.status:
+            self.status = status
+            self.status_frame.configure(fg_color="#22c55e" if status == "connected" else "#ef4444")
+        
+        self.ui_tick = self.after(UI_TICK_MS, self.drain_inbox)
+        
+    def update_transfers(self):
+        """Shows transfer progress, handles finished transfers and thumbnails"""
+        while True:
+            try:
+                attachment, name, future = self.transfers_done.get_nowait()
+            except queue.Empty:
+                break
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                attachment.fetching = False  # A click tries again
+                self.add_system_message(f"Transfer of {name} failed: {future.exception()}")
+                continue
+            if attachment.path is not None:
+                continue  # Sent, its thumbnail was made right away
+            attachment.path = future.result()
+            if is_image(attachment.path):
+                self.thumbnails.submit(attachment, attachment.path)
+        
+        thumbnails = False
+        while True:
+            try:
+                attachment, image = self.thumbnails.results.get_nowait()
+            except queue.Empty:
+                break
+            if image is not None:
+                attachment.image = ctk.CTkImage(light_image=image, dark_image=image, size=image.size)
+                thumbnails = True
+        if thumbnails:
+            self.chat_view.refresh()
+        
+        transfers = [f"{'↑' if isinstance(t, Upload) else '↓'} {t.name} {t.progress:.0%}"
+                     for t in list(self.client.transfers.values())]
+        self.transfer_label.configure(text="  ".join(transfers))
+    
+    def take_inbox(self):
+        """
+        The queued messages the view doesn't have yet. Only cache loads move
+        newest_id: our own messages take ids too, and may take them after a
+        message still waiting here.
+        """
+        batch = []
+        while True:
+            try:
+                message_id, message = self.inbox.get_nowait()
+            except queue.Empty:
+                return batch
+            # Already loaded from the cache, or the view is in the past and it'll come from there
+            if message_id is not None and (not self.live or message_id <= self.newest_id):
+                continue
+            batch.append(message)
+    
+    def send_file(self):
+        """Asks for a file and shares it with the room"""
+        path = filedialog.askopenfilename(parent=self, title="Send a file")
+        if not path:
+            return
+        name = os.path.basename(path)
+        text = f"📎 {name} ({format_size(os.path.getsize(path))})"
+        if not self.live:
+            self.load_history()
+        attachment = Attachment(path)
+        if is_image(path):
+            self.thumbnails.submit(attachment, path)
+        at = time.time()
+        self.chat_view.add((USER, self.username, text, format_time(at), attachment))
+        self.remember(self.room, USER, self.username, text, at)
+        # Runs on the network loop, the UI hears back once it's done
+        future = self.run(self.client.send_file(path))
+        future.add_done_callback(lambda f: self.transfers_done.put((attachment, name, f)))
+    
+    def open_attachment(self, attachment):
+        """A file's bubble was clicked: opens the file once we have it, fetches it otherwise"""
+        if attachment.path is not None:
+            open_file(attachment.path)
+        elif attachment.file is not None and not attachment.fetching:
+            attachment.fetching = True
+            future = self.run(self.client.download(attachment.file, DOWNLOAD_DIR))
+            future.add_done_callback(lambda f: self.transfers_done.put((attachment, attachment.file.name, f)))
+    
+    def show_users_online(self):
+        self.online_label.configure(text=f"Online ({len(self.users_online)})")
+        self.online_list.configure(state="normal")
+        self.online_list.delete("1.0", "end")
+        self.online_list.insert("1.0", "\n".join(self.users_online))
+        self.online_list.configure(state="disabled")
+    
     def add_message_bubble(self, text, timestamp, is_user=False):
         """Adds a message bubble to the chat"""
-        colors = THEME_COLORS[self.theme]
-        
-        # Create a frame for this message
-        bubble_frame = ctk.CTkFrame(self.messages_frame, fg_color="transparent")
-        bubble_frame.pack(fill="x", pady=5, padx=10, anchor="e" if is_user else "w")
-        
-        # Message frame - different colors for user vs others
-        msg_bg = colors["user_bubble"] if is_user else colors["other_bubble"]
-        text_color = "#ffffff" if is_user else colors["text_primary"]
-        
-        # Add username label if not user's message
-        if not is_user:
-            name_label = ctk.CTkLabel(bubble_frame, 
-                                    text=text.split(":")[0] if ":" in text else "Unknown",
-                                    font=ctk.CTkFont(family="Segoe UI", size=12),
-                                    text_color=colors["text_secondary"])
-            name_label.pack(anchor="w", padx=(10, 0), pady=(0, 2))
-            
-            # Extract the actual message if it contains a username
-            if ":" in text:
-                text = ":".join(text.split(":")[1:]).strip()
-        
-        # Message content
-        message_container = ctk.CTkFrame(bubble_frame, fg_color=msg_bg, corner_radius=18)
-        message_container.pack(side="right" if is_user else "left", anchor="e" if is_user else "w")
-        
-        # Message text
-        message_text = ctk.CTkLabel(message_container, text=text, 
-                                  font=ctk.CTkFont(family="Segoe UI", size=14),
-                                  text_color=text_color, 
-                                  wraplength=350, 
-                                  justify="left")
-        message_text.pack(padx=15, pady=10)
-        
-        # Timestamp
-        time_label = ctk.CTkLabel(message_container, text=timestamp,
-                                font=ctk.CTkFont(family="Segoe UI", size=10),
-                                text_color="#d0d0d0" if is_user else colors["text_secondary"])
-        time_label.pack(padx=10, pady=(0, 5), anchor="se")
-        
-        # Scroll to bottom
-        self.messages_frame._parent_canvas.yview_moveto(1.0)
+        if is_user:
+            self.chat_view.add((USER, self.username, text, timestamp))
+            return
+        
+        # Split off the sender if the message carries one
+        if ":" in text:
+            sender, text = text.split(":", 1)
+            text = text.strip()
+        else:
+            sender = "Unknown"
+        self.chat_view.add((OTHER, sender, text, timestamp))
     
     def add_system_message(self, text):
         """Adds a system message to the chat"""
-        colors = THEME_COLORS[self.theme]
-        
-        # Create a frame for this message
-        system_frame = ctk.CTkFrame(self.messages_frame, fg_color="transparent")
-        system_frame.pack(fill="x", pady=5)
-        
-        # System message container
-        system_container = ctk.CTkFrame(system_frame, fg_color=colors["bg_secondary"], 
-                                      corner_radius=10)
-        system_container.pack(anchor="center")
-        
-        # System message text
-        system_text = ctk.CTkLabel(system_container, text=text,
-                                 font=ctk.CTkFont(family="Segoe UI", size=12),
-                                 text_color=colors["text_secondary"])
-        system_text.pack(padx=15, pady=5)
-        
-        # Scroll to bottom
-        self.messages_frame._parent_canvas.yview_moveto(1.0)
+        self.chat_view.add((SYSTEM, "", text, ""))
+    
+    def switch_room(self):
+        """Leaves the current room and joins the one typed in the header"""
+        room = self.room_entry.get().strip()
+        if not room or room == self.room:
+            return
+        try:
+            self.run(self.client.switch_room(room)).result()
+            self.room = room
+            self.title(f"Secure Messenger - {self.username} #{room}")
+            self.load_history()
+            self.add_system_message(f"You joined #{room}")
+        except Exception as e:
+            self.add_system_message(f"Error switching room: {str(e)}")
+    
+    def load_history(self):
+        """Shows the newest cached page of the current room"""
+        page = self.history.page(self.room)
+        self.oldest_id = page[0][0] if page else None
+        self.history_done = len(page) < PAGE_SIZE
+        self.newest_id = page[-1][0] if page else 0
+        self.live = True
+        self.chat_view.reset(self.page_messages(page))
+    
+    def load_older(self):
+        """The view reached the top, prepends the cached page before it"""
+        if self.history_done:
+            return
+        page = self.history.page(self.room, before=self.oldest_id)
+        self.history_done = len(page) < PAGE_SIZE
+        if page:
+            self.oldest_id = page[0][0]
+            self.chat_view.prepend(self.page_messages(page))
+    
+    def load_newer(self):
+        """The view reached the bottom of a stretch of the past, appends the cached page after it"""
+        if self.live:
+            return
+        self.history.flush()
+        page = self.history.page_after(self.room, self.newest_id)
+        self.live = len(page) < PAGE_SIZE
+        if page:
+            self.newest_id = page[-1][0]
+            self.chat_view.append(self.page_messages(page))
+    
+    def search(self):
+        """Searches the local history, lists the results in a window of their own"""
+        query = self.search_entry.get().strip()
+        if not query:
+            return
+        self.history.flush()
+        started = time.perf_counter()
+        hits = self.index.search(query, lambda ids: {message_id: message[3]
+                                                     for message_id, message in self.history.get(ids).items()})
+        found = self.history.get(message_id for message_id, _, _ in hits)
+        elapsed = (time.perf_counter() - started) * 1000
+        
+        window = ctk.CTkToplevel(self)
+        window.title(f"Search: {query}")
+        window.geometry("480x520")
+        summary = f"{len(found)} results in {elapsed:.0f} ms"
+        if not self.index.ready:
+            summary += ", older history is still being indexed"
+        ctk.CTkLabel(window, text=summary, font=ctk.CTkFont(family="Segoe UI", size=12),
+                     text_color=THEME_COLORS[self.theme]["text_secondary"]).pack(anchor="w", padx=15, pady=(12, 4))
+        
+        results = ctk.CTkScrollableFrame(window, fg_color="transparent")
+        results.pack(fill="both", expand=True, padx=10, pady=(0, 10))
+        for message_id, room, _ in hits:
+            if message_id not in found:
+                continue
+            _, kind, sender, text, at = found[message_id]
+            line = f"#{room}  {sender}: {text}"
+            if len(line) > SNIPPET_LENGTH:
+                line = line[:SNIPPET_LENGTH - 1] + "…"
+            ctk.CTkButton(results, text=f"{format_time(at)}  {line}", anchor="w", height=28,
+                          font=ctk.CTkFont(family="Segoe UI", size=13), fg_color="transparent",
+                          text_color=THEME_COLORS[self.theme]["text_primary"],
+                          hover_color=THEME_COLORS[self.theme]["bg_secondary"],
+                          command=lambda room=room, message_id=message_id: self.jump_to(room, message_id)
+                          ).pack(fill="x")
+    
+    def jump_to(self, room, message_id):
+        """Shows the stretch of room's history around a message, the message at the bottom of the view"""
+        if room != self.room:
+            self.room_entry.delete(0, "end")
+            self.room_entry.insert(0, room)
+            self.switch_room()
+            if room != self.room:
+                return
+        self.history.flush()
+        older = self.history.page(room, before=message_id + 1)
+        newer = self.history.page_after(room, message_id)
+        self.oldest_id = older[0][0] if older else message_id
+        self.history_done = len(older) < PAGE_SIZE
+        self.newest_id = newer[-1][0] if newer else message_id
+        self.live = len(newer) < PAGE_SIZE
+        self.chat_view.reset(self.page_messages(older + newer))
+        self.chat_view.scroll_to(len(older) - 1)
+    
+    @staticmethod
+    def page_messages(page):
+        return [(kind, sender, text, format_time(at)) for _, kind, sender, text, at in page]
+    
+    def on_close(self):
+        if self.history is not None:
+            self.history.close()
+        if self.thumbnails is not None:
+            self.thumbnails.close()
+        self.destroy()
     
     # Theme and emoji methods removed
     
+    def run(self, coro):
+        """Runs a client coroutine on the network loop, returns a concurrent future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+    
     def send_message(self):
         """Sends a message to the server"""
         msg = self.message_entry.get().strip()
         if msg:
             try:
-                enc_msg = self.cipher.encrypt(msg.encode()).decode()
-                payload = {"from": self.username, "data": enc_msg}
-                self.client.send(json.dumps(payload).encode())
+                # "/msg name text" goes to one user only
+                parts = msg.split(" ", 2)
+                if parts[0] == "/msg" and len(parts) == 3:
+                    self.run(self.client.send_direct(parts[1], parts[2])).result()
+                    msg = f"(to {parts[1]}) {parts[2]}"
+                else:
+                    self.run(self.client.send(msg)).result()
+                
+                # Back to the present if the view was showing a search result
+                if not self.live:
+                    self.load_history()
                 
                 # Display in chat
-                current_time = datetime.now().strftime("%H:%M")
-                self.add_message_bubble(msg, current_time, is_user=True)
+                at = time.time()
+                self.add_message_bubble(msg, format_time(at), is_user=True)
+                self.remember(self.room, USER, self.username, msg, at)
                 
                 # Clear input
                 self.message_entry.delete(0, "end")
             except Exception as e:
                 self.add_system_message(f"Error sending message: {str(e)}")
     
-    def receive_messages(self):
-        """Receives messages from the server in a separate thread"""
-        while True:
-            try:
-                data = self.client.recv(4096)
-                if not data:
-                    break
-                    
-                msg = json.loads(data.decode())
-                sender = msg["from"]
-                dec_msg = self.cipher.decrypt(msg["data"].encode()).decode()
-                
-                # Format message with sender name if it's not a system message
-                display_msg = f"{sender}: {dec_msg}" if sender != "SYSTEM" else dec_msg
-                
-                # Update UI in main thread
-                current_time = datetime.now().strftime("%H:%M")
-                self.after(0, lambda: self.add_message_bubble(display_msg, current_time, is_user=False))
-                
-            except Exception as e:
-                self.after(0, lambda: self.add_system_message(f"Connection error: {str(e)}"))
-                self.status = "disconnected"
-                self.after(0, lambda: self.status_frame.configure(fg_color="#ef4444"))
-                break
+    def remember(self, room, kind, sender, text, at, seq=None):
+        """Caches a message and indexes it for search, returns its history id"""
+        message_id = self.history.add(room, kind, sender, text, at, seq)
+        self.index.add(message_id, room, text)
+        return message_id
+    
+    def on_message(self, client, message):
+        """Called on the network loop with each of client's messages, hands them to the UI thread"""
+        at = time.time()
+        if message.kind == DIRECT:
+            # Kept with the room it showed up in
+            sender = f"{message.sender} (direct)"
+            message_id = self.remember(client.room, OTHER, sender, message.text, at)
+            self.inbox.put((message_id, (OTHER, sender, message.text, format_time(at))))
+            return
+        if message.kind == FILE:
+            text = f"📎 {message.text} ({format_size(message.file.size)})"
+            message_id = self.remember(message.room, OTHER, message.sender, text, at, message.seq)
+            if message.room != client.room:
+                return
+            # Fetched once clicked, only small images come right away for their thumbnail
+            attachment = Attachment(file=message.file)
+            if is_image(message.file.name) and message.file.size <= AUTO_FETCH_BYTES:
+                attachment.fetching = True
+                download = asyncio.ensure_future(client.download(message.file, DOWNLOAD_DIR))
+                download.add_done_callback(lambda f: self.transfers_done.put((attachment, message.text, f)))
+            self.inbox.put((message_id, (OTHER, message.sender, text, format_time(at), attachment)))
+            return
+        message_id = None
+        if message.kind == MESSAGE:
+            message_id = self.remember(message.room, OTHER, message.sender, message.text, at, message.seq)
+        # Still in flight from a room we just left
+        if message.room != client.room:
+            return
+        if message.kind == MESSAGE:
+            self.inbox.put((message_id, (OTHER, message.sender, message.text, format_time(at))))
+        else:
+            self.inbox.put((None, (SYSTEM, "", message.text, "")))
 
 if __name__ == "__main__":
     app = MessageApp()
@@ -0,0 +1,56 @@
+"""
+Decrypt/verify worker pool for the client.
+
+The socket reader hands over parsed messages in batches and goes straight
+back to reading. Each sender is pinned to one worker, so a sender's
+messages come out in the order they went in while different senders are
+decrypted in parallel. Tokens that fail to verify or decode are counted
+and dropped instead of taking the connection down.
+"""
+
+import os
+import queue
+import threading
+import zlib
+
+class DecryptPool:
+    """
+    decrypt(token) returns the plaintext or raises. deliver(results, failed)
+    is called from a worker thread with a list of (message, plaintext)
+    pairs and the number of messages of the batch that were dropped.
+    """
+
+    def __init__(self, decrypt, deliver, workers=None):
+        self.decrypt = decrypt
+        self.deliver = deliver
+        self._queues = [queue.SimpleQueue() for _ in range(workers or min(4, os.cpu_count() or 1))]
+        for q in self._queues:
+            threading.Thread(target=self._run, args=(q,), daemon=True).start()
+
+    def submit(self, messages):
+        """Queues a batch of message dicts, each with "from" and "data" """
+        shards = {}
+        for msg in messages:
+            # crc32 rather than hash() so a sender lands on the same worker every run
+            worker = zlib.crc32(msg["from"].encode()) % len(self._queues)
+            shards.setdefault(worker, []).append(msg)
+        for worker, batch in shards.items():
+            self._queues[worker].put(batch)
+
+    def close(self):
+        for q in self._queues:
+            q.put(None)
+
+    def _run(self, q):
+        while True:
+            batch = q.get()
+            if batch is None:
+                return
+            results = []
+            failed = 0
+            for msg in batch:
+                try:
+                    results.append((msg, self.decrypt(msg["data"])))
+                except Exception:
+                    failed += 1
+            self.deliver(results, failed)
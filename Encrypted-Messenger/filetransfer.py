@@ -0,0 +1,209 @@
+"""
+File and image transfer for the client.
+
+A file goes up to the server's spool (see spool.py) in CHUNK_SIZE pieces,
+each encrypted on its own, and is then announced to the room with a FILE
+message carrying its name, size and SHA-256. Receivers fetch it from the
+spool straight into a .part file, so neither end holds more than a few
+chunks of it in memory.
+
+Both directions are flow controlled per transfer: an upload keeps at most
+UPLOAD_WINDOW chunks unacknowledged, and the server runs a download at
+most DOWNLOAD_WINDOW chunks ahead of what was written to disk. Chat
+messages share the connection and wait behind a window of chunks at
+most, never behind the whole file.
+
+Transfers pick up where they left off after a disconnect: an upload from
+the last chunk the spool stored, a download from the last one on disk.
+The .part file is named after the transfer, so a download even survives
+a restart of the client.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+CHUNK_SIZE = 64 * 1024
+UPLOAD_WINDOW = 8     # Chunks sent ahead of the server's acknowledgements
+DOWNLOAD_WINDOW = 8   # Chunks the server may send ahead of ours
+REPLY_TIMEOUT = 30    # Seconds without news from the server before a transfer asks again
+
+# What a FILE message announces, id being the transfer id in the spool
+FileInfo = namedtuple("FileInfo", "id name size chunks sha256")
+
+class TransferError(Exception):
+    """Raised when the server refuses a transfer or a file fails verification"""
+
+def chunk_count(size):
+    # An empty file is still one (empty) chunk
+    return max(1, -(-size // CHUNK_SIZE))
+
+def encode_info(info):
+    return json.dumps(info._asdict())
+
+def decode_info(text):
+    """FileInfo from a FILE message, raises ValueError if it makes no sense"""
+    try:
+        fields = json.loads(text)
+        info = FileInfo(int(fields["id"]), str(fields["name"]), int(fields["size"]),
+                        int(fields["chunks"]), str(fields["sha256"]))
+    except (KeyError, TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"malformed file details: {e}") from None
+    if info.size < 0 or info.chunks != chunk_count(info.size):
+        raise ValueError("malformed file details")
+    return info
+
+def unique_path(directory, name):
+    """A free path in directory for a file called name, "photo (2).jpg" if photo.jpg is taken"""
+    # Names come from other users, never let them pick the directory
+    name = os.path.basename(name.replace("\\", "/")).strip() or "file"
+    stem, ext = os.path.splitext(name)
+    path = os.path.join(directory, name)
+    n = 1
+    while os.path.exists(path):
+        n += 1
+        path = os.path.join(directory, f"{stem} ({n}){ext}")
+    return path
+
+class Transfer:
+    """
+    State shared by uploads and downloads. done counts the chunks the
+    server acknowledged, or for a download that were written to disk.
+    update() and chunk_received() run on the event loop as the server's
+    replies come in and wake whoever waits().
+    """
+
+    def __init__(self, transfer_id, name, size):
+        self.id = transfer_id
+        self.name = name
+        self.size = size
+        self.chunks = chunk_count(size)
+        self.done = 0
+        self.ready = False  # The server answered this connection's request
+        self._event = asyncio.Event()
+        self._lost = False
+        self._error = None
+
+    @property
+    def progress(self):
+        return self.done / self.chunks
+
+    def restart(self):
+        """Called on each (re)connection before the request goes out"""
+        self.ready = False
+        self._lost = False
+
+    def interrupt(self):
+        """The connection went, whoever waits gets a ConnectionError"""
+        self._lost = True
+        self._event.set()
+
+    def fail(self, reason):
+        self._error = reason
+        self._event.set()
+
+    async def wait(self):
+        """Waits for news from the server, raises asyncio.TimeoutError if none comes in REPLY_TIMEOUT"""
+        await asyncio.wait_for(self._event.wait(), REPLY_TIMEOUT)
+        self._event.clear()
+        if self._error is not None:
+            raise TransferError(self._error)
+        if self._lost:
+            raise ConnectionError("connection lost during transfer")
+
+class Upload(Transfer):
+    def __init__(self, path, name=None):
+        super().__init__(int.from_bytes(os.urandom(8), "big"), name or os.path.basename(path),
+                         os.path.getsize(path))
+        self.path = path
+        self.sent = 0  # Next chunk to send
+        self._hash = hashlib.sha256()
+        self._hashed = 0  # Chunks fed to the hash, a resume may send some of them again
+
+    def request(self):
+        return {"type": "upload", "id": self.id, "size": self.size, "chunks": self.chunks}
+
+    def update(self, msg):
+        if msg["type"] == "upload-error":
+            self.fail(msg.get("reason", "refused"))
+            return
+        self.done = msg["chunks"]
+        if msg["type"] == "upload-ready":
+            # Whatever was in flight when the connection went is sent again
+            self.sent = self.done
+            self.ready = True
+        self._event.set()
+
+    def read(self, file, index):
+        file.seek(index * CHUNK_SIZE)
+        chunk = file.read(CHUNK_SIZE)
+        if index == self._hashed:
+            self._hash.update(chunk)
+            self._hashed += 1
+        return chunk
+
+    def info(self, file):
+        # The spool may have had the rest from an earlier attempt
+        while self._hashed < self.chunks:
+            self.read(file, self._hashed)
+        return FileInfo(self.id, self.name, self.size, self.chunks, self._hash.hexdigest())
+
+class Download(Transfer):
+    def __init__(self, info, directory):
+        super().__init__(info.id, info.name, info.size)
+        self.info = info
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.part_path = os.path.join(directory, f".{info.id:016x}.part")
+        self.file = open(self.part_path, "a+b")
+        self._hash = hashlib.sha256()
+        # Keep the whole chunks of an earlier attempt
+        self.done = min(self.file.seek(0, os.SEEK_END) // CHUNK_SIZE, self.chunks - 1)
+        self.file.truncate(self.done * CHUNK_SIZE)
+        self.file.seek(0)
+        for _ in range(self.done):
+            self._hash.update(self.file.read(CHUNK_SIZE))
+
+    def request(self):
+        return {"type": "download", "id": self.id, "from": self.done, "window": DOWNLOAD_WINDOW}
+
+    def update(self, msg):
+        if msg["type"] == "download-error":
+            self.fail(msg.get("reason", "refused"))
+        elif msg["chunks"] != self.chunks:
+            self.fail("file on the server doesn't match its announcement")
+        else:
+            self.ready = True
+            self._event.set()
+
+    def chunk_received(self, index, token, cipher):
+        """Decrypts a chunk and appends it to the .part file"""
+        if index != self.done:
+            return  # Still in flight from before a resume
+        try:
+            chunk = cipher.decrypt(token)
+        except Exception:
+            self.fail("chunk failed verification")
+            return
+        if len(chunk) != min(CHUNK_SIZE, self.size - index * CHUNK_SIZE):
+            self.fail("chunk of the wrong size")
+            return
+        self.file.write(chunk)
+        self._hash.update(chunk)
+        self.done += 1
+        self._event.set()
+
+    def finish(self):
+        """Checks the file against its announcement and moves it in place, returns its path"""
+        self.file.close()
+        if self._hash.hexdigest() != self.info.sha256:
+            os.remove(self.part_path)
+            raise TransferError("file doesn't match its checksum")
+        path = unique_path(self.directory, self.name)
+        os.replace(self.part_path, path)
+        return path
+
+    def close(self):
+        self.file.close()
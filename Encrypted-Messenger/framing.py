@@ -0,0 +1,115 @@
+"""
+Length-prefixed framing shared by the server and the client.
+
+Every message on the wire is a 4-byte big-endian length followed by that
+many payload bytes. FrameDecoder parses frames straight out of a reusable
+receive buffer, so one recv can carry many frames (or a fraction of one)
+without the payload being copied.
+"""
+
+import struct
+
+HEADER = struct.Struct("!I")
+MAX_FRAME = 16 * 1024 * 1024  # Refuse anything larger, it's a broken or hostile peer
+MIN_READ = 4096
+
+class FrameError(Exception):
+    """Raised when the peer sends a frame we can't accept."""
+
+def encode_frame(payload):
+    """Prefix a payload with its length"""
+    if len(payload) > MAX_FRAME:
+        raise FrameError(f"frame of {len(payload)} bytes exceeds {MAX_FRAME}")
+    return HEADER.pack(len(payload)) + payload
+
+def iter_frames(buffer):
+    """Yields each complete frame, length prefix included, from a buffer of whole frames"""
+    view = memoryview(buffer)
+    pos = 0
+    while pos + HEADER.size <= len(view):
+        (length,) = HEADER.unpack_from(view, pos)
+        end = pos + HEADER.size + length
+        yield view[pos:end]
+        pos = end
+
+class FrameDecoder:
+    """
+    Incremental decoder over a bytearray receive buffer.
+
+    Callers write into get_buffer() (recv_into, or asyncio's BufferedProtocol),
+    report the byte count with advance(), then iterate frames(). The frames
+    are memoryviews into the buffer and stay valid until the next
+    get_buffer() call.
+    """
+
+    def __init__(self, size=64 * 1024, max_frame=MAX_FRAME):
+        self._size = size
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # First unparsed byte
+        self._end = 0    # One past the last received byte
+        self.max_frame = max_frame
+
+    def get_buffer(self, sizehint=-1):
+        """Returns a writable view over the free tail of the buffer"""
+        self._reserve(max(sizehint, MIN_READ))
+        return self._view[self._end:]
+
+    def advance(self, nbytes):
+        self._end += nbytes
+
+    def feed(self, data):
+        """Copies data in, for callers that already hold received bytes"""
+        n = len(data)
+        self.get_buffer(n)[:n] = data
+        self.advance(n)
+
+    def recv_into(self, sock):
+        """Reads once from a blocking socket, returns 0 on EOF"""
+        n = sock.recv_into(self.get_buffer())
+        self.advance(n)
+        return n
+
+    def frames(self):
+        """Yields every complete frame currently buffered"""
+        view = self._view
+        while self._end - self._start >= HEADER.size:
+            (length,) = HEADER.unpack_from(view, self._start)
+            if length > self.max_frame:
+                raise FrameError(f"frame of {length} bytes exceeds {self.max_frame}")
+            begin = self._start + HEADER.size
+            if self._end - begin < length:
+                break
+            self._start = begin + length
+            yield view[begin:self._start]
+
+        if self._start == self._end:
+            self._start = self._end = 0
+            # Give back memory an oversized frame made us grow into
+            if len(self._buf) > self._size:
+                self._buf = bytearray(self._size)
+                self._view = memoryview(self._buf)
+
+    def _reserve(self, need):
+        # Room for one more read, not for the frame's declared length: that
+        # comes from the peer, the buffer only grows with bytes that arrive
+        pending = self._end - self._start
+        if len(self._buf) - self._end >= need:
+            return
+
+        if pending + need <= len(self._buf):
+            # Slide the partial frame to the front. This only ever moves a
+            # tail fragment, and the source overlaps the target, so go via bytes.
+            self._buf[:pending] = bytes(self._view[self._start:self._end])
+        else:
+            # Allocate instead of resizing in place: views handed out earlier
+            # still pin the old buffer. Doubling keeps the copies of a large
+            # frame linear in its size.
+            size = len(self._buf)
+            while size < pending + need:
+                size *= 2
+            buf = bytearray(size)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start, self._end = 0, pending
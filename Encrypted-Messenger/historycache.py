@@ -0,0 +1,242 @@
+"""
+Local history cache for the client.
+
+Messages are kept in SQLite, one database per user and server, so the
+chat comes back instantly after a restart and can be scrolled back
+offline. The database runs in WAL mode: a writer thread inserts in
+batches while the UI thread reads pages without waiting for it.
+
+Message text is stored encrypted under a key of this install's own (see
+local_key()), not the chat key that ships with the client, so a copy of
+the database gives nothing away; whoever can read the user's files can
+read the history too. The newest seq per room is what the client sends as
+"since" on connect, so the server only replays what's missing.
+
+Ids are handed out by add() rather than by SQLite, so a message can be
+indexed for search and placed in the view before the writer gets to it.
+"""
+
+import base64
+import itertools
+import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+PAGE_SIZE = 50        # Messages per page loaded into the view
+BATCH_SIZE = 500      # Rows per write transaction at most
+FLUSH_INTERVAL = 0.5  # Seconds a write waits for others to batch with
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    room TEXT NOT NULL,
+    seq INTEGER,
+    kind TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    body BLOB NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_room ON messages (room, id);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_seq ON messages (room, seq) WHERE seq IS NOT NULL;
+"""
+
+def default_dir():
+    return os.path.join(os.path.expanduser("~"), ".secure-messenger")
+
+def default_path(username, server, port):
+    """~/.secure-messenger/<user>@<server>_<port>.db"""
+    name = re.sub(r"[^\w.@-]", "_", f"{username}@{server}_{port}")
+    return os.path.join(default_dir(), name + ".db")
+
+KEY_SIZE = 32  # Bytes of key material, stored urlsafe base64 encoded
+
+def local_key(directory=None):
+    """
+    This install's cache key, from directory/key, made on first use readable
+    by the user alone. The file is written in full before it takes the name,
+    so a crash leaves either no key or a whole one. An empty file is what an
+    interrupted write left behind before that and counts as missing; any
+    other key of the wrong size raises ValueError rather than being replaced,
+    the history it encrypted may still be worth saving.
+    """
+    directory = directory or default_dir()
+    path = os.path.join(directory, "key")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    try:
+        with open(path, "rb") as f:
+            key = f.read().strip()
+    except FileNotFoundError:
+        key = b""
+    if key:
+        try:
+            valid = len(base64.urlsafe_b64decode(key)) == KEY_SIZE
+        except ValueError:
+            valid = False
+        if not valid:
+            raise ValueError(f"{path} doesn't hold a {KEY_SIZE}-byte key, move it aside to start a new history")
+        return key
+
+    key = base64.urlsafe_b64encode(os.urandom(KEY_SIZE))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".key-")  # Readable by the user alone
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return key
+
+class HistoryCache:
+    """
+    add() may be called from any thread and never blocks on disk. page(),
+    page_after(), get() and last_seqs() read, and belong to the thread that
+    opened the cache. scan() may run anywhere.
+    """
+
+    def __init__(self, path, cipher):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.cipher = cipher
+        self.db = self._connect()
+        self.db.executescript(SCHEMA)
+        # Ids from here on are this session's
+        self.first_id = (self.db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0) + 1
+        self._ids = itertools.count(self.first_id)
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps the database consistent; only the last batches can be lost on power failure
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def add(self, room, kind, sender, text, at=None, seq=None):
+        """Queues a message for the writer thread, returns its id"""
+        body = self.cipher.encrypt(text.encode())
+        message_id = next(self._ids)
+        self._queue.put((message_id, room, seq, kind, sender, body, at or time.time()))
+        return message_id
+
+    def flush(self):
+        """Waits until everything queued so far is in the database"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def _decrypt(self, body):
+        try:
+            return self.cipher.decrypt(body).decode()
+        except Exception:
+            return None  # Written under a different key
+
+    def page(self, room, before=None, limit=PAGE_SIZE):
+        """
+        Up to limit messages of room older than id before (newest when None),
+        oldest first, as (id, kind, sender, text, at).
+        """
+        if before is None:
+            before = 1 << 62
+        rows = self.db.execute(
+            "SELECT id, kind, sender, body, at FROM messages WHERE room = ? AND id < ? "
+            "ORDER BY id DESC LIMIT ?", (room, before, limit)).fetchall()
+        return self._page(reversed(rows))
+
+    def page_after(self, room, after, limit=PAGE_SIZE):
+        """Up to limit messages of room newer than id after, oldest first"""
+        rows = self.db.execute(
+            "SELECT id, kind, sender, body, at FROM messages WHERE room = ? AND id > ? "
+            "ORDER BY id LIMIT ?", (room, after, limit))
+        return self._page(rows)
+
+    def _page(self, rows):
+        page = []
+        for id, kind, sender, body, at in rows:
+            text = self._decrypt(body)
+            if text is not None:
+                page.append((id, kind, sender, text, at))
+        return page
+
+    def get(self, ids):
+        """Id -> (room, kind, sender, text, at) for those of ids that are stored"""
+        ids = list(ids)
+        found = {}
+        # SQLite takes a limited number of parameters per statement
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self.db.execute(
+                f"SELECT id, room, kind, sender, body, at FROM messages WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk)
+            for id, room, kind, sender, body, at in rows:
+                text = self._decrypt(body)
+                if text is not None:
+                    found[id] = (room, kind, sender, text, at)
+        return found
+
+    def scan(self, before):
+        """
+        (id, room, text) of every message older than id before, oldest first.
+        Reads on a connection of its own, opened by whichever thread iterates.
+        """
+        db = self._connect()
+        try:
+            for id, room, body in db.execute("SELECT id, room, body FROM messages WHERE id < ? ORDER BY id",
+                                             (before,)):
+                text = self._decrypt(body)
+                if text is not None:
+                    yield id, room, text
+        finally:
+            db.close()
+
+    def last_seqs(self):
+        """Room -> newest history sequence number stored"""
+        return dict(self.db.execute("SELECT room, MAX(seq) FROM messages WHERE seq IS NOT NULL GROUP BY room"))
+
+    def close(self):
+        """Writes what is still queued and closes the database"""
+        self._queue.put(None)
+        self._writer.join()
+        self.db.close()
+
+    def _run(self):
+        db = self._connect()
+        running = True
+        while running:
+            batch = []
+            flushed = None
+            deadline = None
+            while len(batch) < BATCH_SIZE:
+                # Block for the first item, then wait for more only until the deadline
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                if isinstance(item, threading.Event):
+                    flushed = item
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + FLUSH_INTERVAL
+            if batch:
+                with db:
+                    # A replayed message that is already stored keeps its row
+                    db.executemany("INSERT OR IGNORE INTO messages (id, room, seq, kind, sender, body, at) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            if flushed is not None:
+                flushed.set()
+        db.close()
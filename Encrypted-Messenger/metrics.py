@@ -0,0 +1,220 @@
+"""
+Server metrics, a stats endpoint and a sampling profiler.
+
+Counters and histograms are plain attribute updates, cheap enough for the
+message path. Gauges are callbacks read only when someone scrapes. The
+stats endpoint is a tiny HTTP server meant for localhost:
+
+  GET /metrics                  everything, Prometheus text format
+  GET /profile/start?hz=100     start sampling the event loop thread
+  GET /profile/stop             stop, returns the samples as folded stacks
+
+Folded stacks ("outer;inner;leaf count" per line) feed straight into
+flamegraph.pl or speedscope.
+"""
+
+import asyncio
+import bisect
+import collections
+import sys
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+# Seconds, from a few microseconds up to a stalled loop
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+PROFILE_HZ = 100
+MAX_PROFILE_HZ = 1000
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+class Gauge:
+    """read() returns a number, or a list of (labels, number) for one line each"""
+    kind = "gauge"
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        value = self.read()
+        if isinstance(value, list):
+            for labels, v in value:
+                yield self.name, labels, v
+        else:
+            yield self.name, None, value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield self.name + "_bucket", {"le": repr(bound)}, total
+        yield self.name + "_bucket", {"le": "+Inf"}, self.count
+        yield self.name + "_sum", None, self.sum
+        yield self.name + "_count", None, self.count
+
+class Registry:
+    def __init__(self, prefix="", labels=None):
+        self.prefix = prefix
+        self.labels = labels or {}  # Added to every sample, e.g. the worker id
+        self.metrics = []
+
+    def counter(self, name, help, labels=None):
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(self.prefix + name, help, read))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        described = set()
+        for metric in self.metrics:
+            # Labelled counters of one family share their HELP and TYPE lines
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                labels = {**self.labels, **labels} if labels else self.labels
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+class SamplingProfiler:
+    """
+    Samples one thread's stack from a background thread. Costs nothing
+    while stopped and only a stack walk per sample while running.
+    """
+
+    def __init__(self, thread_id=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._stop is not None
+
+    def start(self, hz=PROFILE_HZ):
+        if self.running:
+            return
+        # A Counter of its own per run, nothing of an earlier run can write to it
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(1 / hz, self._stop, self.stacks), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and returns the samples as folded stacks"""
+        if self.running:
+            self._stop.set()
+            # The sampler wakes at once, at most one sample is left before it's done with the Counter
+            self._thread.join()
+            self._stop = self._thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def _run(self, interval, stop, stacks):
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+class StatsServer:
+    """Answers the stats endpoint's HTTP requests on the server's event loop"""
+
+    def __init__(self, registry, profiler):
+        self.registry = registry
+        self.profiler = profiler
+
+    async def start(self, host, port):
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # Headers carry nothing we need
+            while (await reader.readline()).strip():
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] != "GET":
+                status, body = "405 Method Not Allowed", "GET only\n"
+            else:
+                status, body = self.route(urlsplit(parts[1]))
+            body = body.encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, url):
+        if url.path == "/metrics":
+            return "200 OK", self.registry.render()
+        if url.path == "/profile/start":
+            try:
+                hz = float(parse_qs(url.query).get("hz", [PROFILE_HZ])[0])
+            except ValueError:
+                return "400 Bad Request", "hz must be a number\n"
+            self.profiler.start(min(max(hz, 1), MAX_PROFILE_HZ))
+            return "200 OK", "profiling\n"
+        if url.path == "/profile/stop":
+            if not self.profiler.running:
+                return "409 Conflict", "profiler isn't running\n"
+            return "200 OK", self.profiler.stop()
+        return "404 Not Found", "try /metrics, /profile/start or /profile/stop\n"
@@ -0,0 +1,147 @@
+"""
+Optional compression of message plaintext, applied before encryption.
+
+A compressed plaintext starts with one codec byte:
+
+  0x00  stored as is (too short to be worth it, or didn't shrink)
+  0x01  raw deflate
+  0x02  raw deflate primed with DICTIONARY
+  0x03  zstd
+  0x04  zstd with DICTIONARY
+
+Plain text never starts with those control bytes, so a receiver can still
+read messages from clients that don't compress at all. Chat lines are too
+short for a compressor to learn much from, so the codecs are primed with a
+shared dictionary of common chat text; that is what makes short messages
+shrink. zstd is used when the zstandard package is installed.
+
+DICTIONARY is written by hand, not produced by train_dictionary(): there
+is no corpus of real chat to train on that could be shipped with the
+code, and a dictionary trained on made-up text would only look more
+principled. It is part of the wire format, every client and server has to
+prime with the same bytes, so it can't be retrained in place either.
+train_dictionary() is there for building its successor from real traffic,
+which would need a new codec byte for old and new peers to tell them apart.
+
+The codec is negotiated per sender, but every receiver has to undo it.
+zlib comes with Python, zstd only with the optional zstandard package,
+so servers should only allow zstd once every client has it installed.
+"""
+
+import collections
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+STORED, DEFLATE, DEFLATE_DICT, ZSTD, ZSTD_DICT = range(5)
+
+MIN_SIZE = 24             # Below this the codec byte costs more than compression saves
+ZSTD_MIN_SIZE = 256       # Below this zstd's frame header outweighs its edge over deflate
+MAX_PLAINTEXT = 1 << 20   # Refuse to inflate a message past this, it's a bomb
+LEVEL = 6
+CODECS = ("zstd", "zlib")
+
+# Hand-written, see above. Most useful strings go last, deflate reaches back to them cheaply
+DICTIONARY = (
+    "https://www. .com .org .net ?! ... :) :D ;) <3 lol haha hahaha omg btw idk imo tbh brb "
+    "thx thanks thank you please sorry okay ok yes yeah yep no nope sure maybe "
+    "good morning good night good luck have a nice day see you later talk to you later "
+    "what do you think how are you doing i'm fine i am not sure i don't know i think "
+    "can you could you would you do you want to let me know let's meet tomorrow today "
+    "tonight this weekend next week right now in a minute on my way just a sec "
+    "the meeting the project the file the link the message the server the client "
+    "sounds good that's great that's right that is what about where are you when will "
+    "I will I'll I've I'd we're they're you're it's there is there are "
+    "and the of to in is that for it with as on at by from this be have not but "
+).encode()
+
+def available_codecs():
+    """Codec names this process can run, most preferred first"""
+    return ["zstd", "zlib"] if zstandard is not None else ["zlib"]
+
+def negotiate(offered, allowed):
+    """Picks the first allowed codec the peer offered, None means no compression"""
+    for name in allowed:
+        if name in offered:
+            return name
+    return None
+
+class Compressor:
+    """Compresses outgoing plaintext with the negotiated codec, or not at all"""
+
+    def __init__(self, codec=None, threshold=MIN_SIZE):
+        self.codec = codec
+        self.threshold = threshold
+        if codec == "zstd":
+            self._zstd = zstandard.ZstdCompressor(
+                level=3, dict_data=zstandard.ZstdCompressionDict(DICTIONARY),
+                write_content_size=False, write_checksum=False, write_dict_id=False)
+
+    def compress(self, plaintext):
+        if self.codec is None:
+            return plaintext
+        if len(plaintext) < self.threshold:
+            return bytes((STORED,)) + plaintext
+
+        if self.codec == "zstd" and len(plaintext) >= ZSTD_MIN_SIZE:
+            tag, packed = ZSTD_DICT, self._zstd.compress(plaintext)
+        else:
+            deflate = zlib.compressobj(LEVEL, zlib.DEFLATED, -15, zdict=DICTIONARY)
+            tag, packed = DEFLATE_DICT, deflate.compress(plaintext) + deflate.flush()
+
+        if len(packed) >= len(plaintext):
+            return bytes((STORED,)) + plaintext
+        return bytes((tag,)) + packed
+
+def decompress(data):
+    """Undoes compress() for any codec, untagged plaintext comes back as is"""
+    if not data or data[0] > ZSTD_DICT:
+        return data
+    tag, body = data[0], data[1:]
+
+    if tag == STORED:
+        return body
+    if tag in (DEFLATE, DEFLATE_DICT):
+        if tag == DEFLATE_DICT:
+            inflate = zlib.decompressobj(-15, zdict=DICTIONARY)
+        else:
+            inflate = zlib.decompressobj(-15)
+        plaintext = inflate.decompress(body, MAX_PLAINTEXT)
+        if inflate.unconsumed_tail:
+            raise ValueError("compressed message too large")
+        return plaintext
+    if zstandard is None:
+        raise ValueError("message is zstd compressed but zstandard isn't installed")
+    if tag == ZSTD_DICT:
+        inflate = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(DICTIONARY))
+    else:
+        inflate = zstandard.ZstdDecompressor()
+    # Frames are written without a content size; read one byte past the cap
+    # and no further, a few compressed bytes can inflate to gigabytes
+    with inflate.stream_reader(body) as reader:
+        plaintext = reader.read(MAX_PLAINTEXT + 1)
+    if len(plaintext) > MAX_PLAINTEXT:
+        raise ValueError("compressed message too large")
+    return plaintext
+
+def train_dictionary(samples, size=2048):
+    """
+    Builds a dictionary from sample messages (bytes), for maintainers
+    preparing a successor to DICTIONARY. Peers must agree on the one they
+    prime with, so a new dictionary needs a codec byte of its own.
+    """
+    if zstandard is not None and len(samples) >= 64:
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    # Fallback: the most frequent words, rarest first so common ones end up nearest
+    counts = collections.Counter(word for sample in samples for word in sample.split())
+    words = []
+    total = 0
+    for word, _ in counts.most_common():
+        if total + len(word) + 1 > size:
+            break
+        words.append(word)
+        total += len(word) + 1
+    return b" ".join(reversed(words)) + b" "
@@ -0,0 +1,276 @@
+"""
+Append-only message log used by the server for history replay.
+
+Each room gets its own directory of segment files. A segment holds relayed
+frames exactly as they went out on the wire, back to back, so replaying
+"everything after seq N" is a matter of finding N's byte offset and
+handing the client a slice of the mmapped file. A sparse index, written
+next to every segment, maps one sequence number per INDEX_INTERVAL bytes
+to its offset; the last few steps are walked using the length prefixes.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from framing import HEADER
+
+INDEX_ENTRY = struct.Struct("!QQ")  # seq, byte offset
+INDEX_INTERVAL = 4096
+SEGMENT_BYTES = 64 * 1024 * 1024
+MAX_OPEN_LOGS = 256  # Each open log holds two files, the least recently used close first
+
+class Segment:
+    """One log file plus its sparse index. Sequence numbers start at base_seq."""
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        name = os.path.join(directory, f"{base_seq:020d}")
+        self.log_path = name + ".log"
+        self.idx_path = name + ".idx"
+        self.seqs = []      # Indexed sequence numbers, ascending
+        self.offsets = []   # Byte offset of each indexed seq
+        self.size = 0
+        self.next_seq = base_seq
+        self._indexed_at = -INDEX_INTERVAL
+        self._log = None
+        self._idx = None
+        self._map = None
+
+    def load(self):
+        """Reads the index back and recovers anything written after its last entry"""
+        if os.path.exists(self.idx_path):
+            with open(self.idx_path, "rb") as f:
+                data = f.read()
+            for pos in range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size):
+                seq, offset = INDEX_ENTRY.unpack_from(data, pos)
+                self.seqs.append(seq)
+                self.offsets.append(offset)
+        seq, offset = (self.seqs[-1], self.offsets[-1]) if self.seqs else (self.base_seq, 0)
+        self._indexed_at = offset if self.seqs else -INDEX_INTERVAL
+
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        pos = 0
+        while pos + HEADER.size <= len(data):
+            (length,) = HEADER.unpack_from(data, pos)
+            if pos + HEADER.size + length > len(data):
+                break
+            pos += HEADER.size + length
+            seq += 1
+        self.size = offset + pos
+        self.next_seq = seq
+        # Drop a frame cut short by a crash so appends start on a boundary
+        if offset + len(data) != self.size:
+            os.truncate(self.log_path, self.size)
+
+    def open_for_append(self):
+        self._log = open(self.log_path, "ab", buffering=0)
+        self._idx = open(self.idx_path, "ab", buffering=0)
+
+    def append(self, frame):
+        seq = self.next_seq
+        if self.size - self._indexed_at >= INDEX_INTERVAL:
+            self.seqs.append(seq)
+            self.offsets.append(self.size)
+            self._idx.write(INDEX_ENTRY.pack(seq, self.size))
+            self._indexed_at = self.size
+        self._log.write(frame)
+        self.size += len(frame)
+        self.next_seq += 1
+        return seq
+
+    def read_from(self, seq):
+        """Returns a view of every frame from seq to the end of the segment"""
+        view = self._view()
+        i = bisect.bisect_right(self.seqs, seq) - 1
+        cur, pos = (self.seqs[i], self.offsets[i]) if i >= 0 else (self.base_seq, 0)
+        while cur < seq:
+            (length,) = HEADER.unpack_from(view, pos)
+            pos += HEADER.size + length
+            cur += 1
+        return view[pos:self.size]
+
+    def _view(self):
+        # The active segment keeps growing, map it again once it has outgrown the last map
+        if self._map is None or len(self._map) < self.size:
+            self._release()
+            with open(self.log_path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def _release(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # A replay still holds a view, the map goes away with it
+            self._map = None
+
+    def close(self):
+        for f in (self._log, self._idx):
+            if f is not None:
+                f.close()
+        self._log = self._idx = None
+        self._release()
+
+    def remove(self):
+        self.close()
+        for path in (self.log_path, self.idx_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+class MessageLog:
+    """
+    Segmented log for one room. Old segments are deleted once the log is
+    over retention_bytes, or once they are older than retention_seconds.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, retention_bytes=None, retention_seconds=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        os.makedirs(directory, exist_ok=True)
+
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.segments = []
+        for base in bases:
+            segment = Segment(directory, base)
+            segment.load()
+            self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(directory, 1))
+        self.segments[-1].open_for_append()
+        self.enforce_retention()
+
+    @property
+    def next_seq(self):
+        return self.segments[-1].next_seq
+
+    @property
+    def first_seq(self):
+        return self.segments[0].base_seq
+
+    def append(self, frame):
+        """Appends one encoded frame and returns its sequence number"""
+        active = self.segments[-1]
+        if active.size and active.size + len(frame) > self.segment_bytes:
+            active.close()
+            active = Segment(self.directory, active.next_seq)
+            active.open_for_append()
+            self.segments.append(active)
+            self.enforce_retention()
+        return active.append(frame)
+
+    def read_after(self, seq):
+        """
+        Returns memoryviews that together hold every retained frame with a
+        sequence number above seq, ready to be written to a socket as is.
+        """
+        start = max(seq + 1, self.first_seq)
+        if start >= self.next_seq:
+            return []
+        bases = [s.base_seq for s in self.segments]
+        i = bisect.bisect_right(bases, start) - 1
+        views = [self.segments[i].read_from(start)]
+        views.extend(s.read_from(s.base_seq) for s in self.segments[i + 1:] if s.size)
+        return [v for v in views if len(v)]
+
+    def enforce_retention(self):
+        # Never drop the active segment
+        now = time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.retention_bytes is not None and \
+                sum(s.size for s in self.segments) > self.retention_bytes
+            too_old = self.retention_seconds is not None and \
+                now - os.path.getmtime(oldest.log_path) > self.retention_seconds
+            if not (too_big or too_old):
+                break
+            oldest.remove()
+            self.segments.pop(0)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+class LogStore:
+    """
+    Opens one MessageLog per room on first use, keeping at most max_open
+    of them open. Also remembers every username seen, so logged sender ids
+    can still be resolved after a restart.
+    """
+
+    def __init__(self, directory, max_open=MAX_OPEN_LOGS, **options):
+        self.directory = directory
+        self.max_open = max_open
+        self.options = options
+        self.logs = OrderedDict()  # Room -> MessageLog, least recently used first
+        os.makedirs(directory, exist_ok=True)
+        self.names_path = os.path.join(directory, "users")
+
+    def load_names(self):
+        if not os.path.exists(self.names_path):
+            return []
+        with open(self.names_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def add_name(self, username):
+        with open(self.names_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(username) + "\n")
+
+    def get(self, room):
+        """The room's log, created if the room has none yet"""
+        log = self.logs.get(room)
+        if log is not None:
+            self.logs.move_to_end(room)
+            return log
+        return self._open(room, self._path(room))
+
+    def find(self, room):
+        """The room's log, or None if nothing was ever logged there"""
+        log = self.logs.get(room)
+        if log is not None:
+            self.logs.move_to_end(room)
+            return log
+        path = self._path(room)
+        if not os.path.isdir(path):
+            return None
+        return self._open(room, path)
+
+    def expire(self):
+        """
+        Applies age retention to every room. Logs only check it on segment
+        rollover, which never comes for a room that went quiet.
+        """
+        if self.options.get("retention_seconds") is None:
+            return
+        open_paths = {log.directory for log in self.logs.values()}
+        for log in list(self.logs.values()):
+            log.enforce_retention()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path in open_paths or not os.path.isdir(path):
+                continue
+            MessageLog(path, **self.options).close()  # Opening a log enforces retention
+
+    def _path(self, room):
+        # Room names come from clients, keep them out of the path as text
+        return os.path.join(self.directory, room.encode().hex() or "_")
+
+    def _open(self, room, path):
+        log = self.logs[room] = MessageLog(path, **self.options)
+        while len(self.logs) > self.max_open:
+            self.logs.popitem(last=False)[1].close()
+        return log
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
@@ -0,0 +1,230 @@
+"""
+Relay between forked server workers.
+
+Every worker accepts clients on the same port (SO_REUSEPORT) and holds a
+Unix-domain socket to each of its siblings. Workers tell each other which
+users and rooms they host, so a broadcast is forwarded once to each worker
+with members in the room and never to the others. Session tickets are
+shared too, so a client can resume on whichever worker it lands on.
+"""
+
+import asyncio
+import base64
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+from framing import FrameDecoder, encode_frame
+
+class PeerLink(asyncio.BufferedProtocol):
+    """Socket to one sibling worker"""
+
+    def __init__(self, relay, peer_id):
+        self.relay = relay
+        self.peer_id = peer_id
+        self.decoder = FrameDecoder()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        for frame in self.decoder.frames():
+            self.relay.frame_received(self.peer_id, frame)
+
+    def connection_lost(self, exc):
+        self.relay.peer_lost(self.peer_id)
+
+    def send(self, frame):
+        if not self.transport.is_closing():
+            self.transport.write(frame)
+
+class WorkerRelay:
+    """
+    Pub/sub between workers. deliver(room, sender, frame) hands a relayed
+    client frame to this worker's local members of the room, on_user(username,
+    online) hears about every user that comes or goes on another worker and
+    on_direct(recipient, sender, frame) gets direct messages for local users.
+    Tickets other workers issue or use are kept in sessions, a SessionCache.
+    """
+
+    def __init__(self, worker_id, peer_sockets, deliver, on_user=None, on_direct=None, sessions=None):
+        self.worker_id = worker_id
+        self.peer_sockets = peer_sockets
+        self.deliver = deliver
+        self.on_user = on_user
+        self.on_direct = on_direct
+        self.sessions = sessions
+        self.links = {}         # Worker id -> PeerLink
+        self.routes = {}        # Username -> id of the worker the user is connected to
+        self.room_workers = {}  # Room name -> ids of other workers with members in it
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for peer_id, sock in self.peer_sockets.items():
+            _, link = await loop.connect_accepted_socket(lambda p=peer_id: PeerLink(self, p), sock)
+            self.links[peer_id] = link
+
+    def route(self, username):
+        """Returns the worker id hosting username, or None if nobody has it"""
+        return self.routes.get(username)
+
+    def user_online(self, username):
+        self.routes[username] = self.worker_id
+        self._announce({"op": "user", "user": username, "online": True})
+
+    def user_offline(self, username):
+        if self.routes.get(username) == self.worker_id:
+            del self.routes[username]
+        self._announce({"op": "user", "user": username, "online": False})
+
+    def room_joined(self, room):
+        """Called when the first local member joins a room"""
+        self._announce({"op": "room", "room": room, "joined": True})
+
+    def room_left(self, room):
+        """Called when the last local member leaves a room"""
+        self._announce({"op": "room", "room": room, "joined": False})
+
+    def publish(self, room, sender, frame):
+        """Forwards an encoded client frame to every other worker hosting the room"""
+        peers = self.room_workers.get(room)
+        if not peers:
+            return
+        # The client frame rides along untouched after a one-line header
+        head = json.dumps({"op": "message", "room": room, "from": sender}).encode()
+        relayed = encode_frame(head + b"\n" + frame)
+        for peer_id in peers:
+            self.links[peer_id].send(relayed)
+
+    def send_direct(self, recipient, sender, frame):
+        """Forwards a direct message to the worker hosting recipient, False if none does"""
+        peer_id = self.routes.get(recipient)
+        link = self.links.get(peer_id)
+        if link is None:
+            return False
+        head = json.dumps({"op": "direct", "to": recipient, "from": sender}).encode()
+        link.send(encode_frame(head + b"\n" + frame))
+        return True
+
+    def share_ticket(self, ticket, secret, username, lifetime):
+        self._announce({"op": "ticket", "ticket": base64.b64encode(ticket).decode(),
+                        "secret": base64.b64encode(secret).decode(), "user": username, "lifetime": lifetime})
+
+    def ticket_used(self, ticket):
+        """Tickets are good for one resumption, wherever it happens"""
+        self._announce({"op": "ticket-used", "ticket": base64.b64encode(ticket).decode()})
+
+    def frame_received(self, peer_id, frame):
+        head, _, body = bytes(frame).partition(b"\n")
+        event = json.loads(head)
+        op = event["op"]
+        if op == "message":
+            self.deliver(event["room"], event["from"], body)
+        elif op == "direct":
+            if self.on_direct:
+                self.on_direct(event["to"], event["from"], body)
+        elif op == "user":
+            user = event["user"]
+            if event["online"]:
+                self.routes[user] = peer_id
+                if self.on_user:
+                    self.on_user(user, True)
+            elif self.routes.get(user) == peer_id:
+                del self.routes[user]
+                if self.on_user:
+                    self.on_user(user, False)
+        elif op == "room":
+            room = event["room"]
+            if event["joined"]:
+                self.room_workers.setdefault(room, set()).add(peer_id)
+            else:
+                self._forget_room(room, peer_id)
+        elif op == "ticket":
+            if self.sessions is not None:
+                self.sessions.put(base64.b64decode(event["ticket"]), base64.b64decode(event["secret"]),
+                                  event["user"], event["lifetime"])
+        elif op == "ticket-used":
+            if self.sessions is not None:
+                self.sessions.discard(base64.b64decode(event["ticket"]))
+
+    def peer_lost(self, peer_id):
+        print(f"Lost relay link to worker {peer_id}.")
+        self.links.pop(peer_id, None)
+        for user in [u for u, w in self.routes.items() if w == peer_id]:
+            del self.routes[user]
+            if self.on_user:
+                self.on_user(user, False)
+        for room in list(self.room_workers):
+            self._forget_room(room, peer_id)
+
+    def _forget_room(self, room, peer_id):
+        workers = self.room_workers.get(room)
+        if workers is not None:
+            workers.discard(peer_id)
+            if not workers:
+                del self.room_workers[room]
+
+    def _announce(self, event):
+        frame = encode_frame(json.dumps(event).encode())
+        for link in self.links.values():
+            link.send(frame)
+
+def spawn_workers(count, run_worker):
+    """
+    Forks count workers connected pairwise by Unix-domain sockets and waits
+    for them. run_worker(worker_id, peer_sockets) runs in each child, with
+    peer_sockets mapping every sibling's id to this worker's end of the link.
+    """
+    ends = {}
+    for i in range(count):
+        for j in range(i + 1, count):
+            ends[i, j], ends[j, i] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    pids = []
+    for worker_id in range(count):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                peers = {}
+                for (me, peer), sock in ends.items():
+                    if me == worker_id:
+                        peers[peer] = sock
+                    else:
+                        sock.close()
+                run_worker(worker_id, peers)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        pids.append(pid)
+
+    # The children hold their own copies now
+    for sock in ends.values():
+        sock.close()
+
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
@@ -0,0 +1,200 @@
+"""
+Full-text search over the local history.
+
+An inverted index kept in memory: every word maps to the sorted ids (the
+history cache's row ids) of the messages containing it. It is built from
+the cache once, on a background thread, and then updated per message as
+they arrive, so a query never decrypts the whole history. The index isn't
+written to disk, the history stays encrypted there.
+
+Queries:
+
+  cat food          messages with both words
+  foo*              words starting with foo
+  "see you later"   the words next to each other, in that order
+
+Results are ranked BM25 style: rare words count more, short messages rank
+above long ones, newer wins ties. For words found in a huge number of
+messages only the newest CANDIDATES of them are ranked, which keeps every
+query in the milliseconds.
+"""
+
+import bisect
+import math
+import re
+import threading
+from array import array
+
+WORD = re.compile(r"\w+")
+QUERY = re.compile(r'"([^"]*)"|(\S+)')
+
+RESULTS = 50
+MAX_EXPANSIONS = 64   # Words a prefix may stand for, the first ones alphabetically
+VERIFY_LIMIT = 2000   # Phrase candidates checked against the message text, best ranked first
+CANDIDATES = 5000     # Messages of the rarest query term that get ranked, newest first
+K1, B = 1.2, 0.75     # BM25 parameters
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+def parse_query(query):
+    """Returns (terms, phrases); terms are (word, is_prefix), phrases lists of words"""
+    terms = []
+    phrases = []
+    for phrase, word in QUERY.findall(query):
+        if phrase:
+            words = tokenize(phrase)
+            terms.extend((w, False) for w in words)
+            if len(words) > 1:
+                phrases.append(words)
+        else:
+            words = tokenize(word)
+            # Only the last word of foo-ba* is a prefix
+            prefix = word.endswith("*")
+            terms.extend((w, prefix and i == len(words) - 1) for i, w in enumerate(words))
+    return terms, phrases
+
+def contains_phrase(words, phrase):
+    n = len(phrase)
+    return any(words[i:i + n] == phrase for i in range(len(words) - n + 1))
+
+class SearchIndex:
+    """add() may run on any thread while search() runs on another"""
+
+    def __init__(self):
+        self.postings = {}  # Word -> array of message ids, ascending
+        self.vocabulary = []  # Every word, sorted, for prefix lookups
+        self.lengths = array("H")  # Message id -> words in it, 0 for ids not indexed
+        self.rooms = {}  # Message id -> room
+        self.total_length = 0
+        self.ready = False  # Set once the existing history is in
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def add(self, message_id, room, text):
+        with self._lock:
+            for word in self._add(self.postings, message_id, room, text):
+                bisect.insort(self.vocabulary, word)
+
+    def build(self, messages):
+        """
+        Indexes (id, room, text) of the existing history, all older than any
+        add()ed so far. Runs on its own thread, queries keep working meanwhile.
+        """
+        postings = {}
+        count = 0
+        for message_id, room, text in messages:
+            with self._lock:
+                self._add(postings, message_id, room, text)
+            count += 1
+        with self._lock:
+            # Older ids go in front, the arrays stay sorted
+            for word, ids in postings.items():
+                live = self.postings.get(word)
+                if live is not None:
+                    ids.extend(live)
+                self.postings[word] = ids
+            self.vocabulary = sorted(self.postings)
+            self.ready = True
+        return count
+
+    def _add(self, postings, message_id, room, text):
+        """Adds to postings, returns the words it had never seen"""
+        words = tokenize(text)
+        if not words:
+            return []
+        new = []
+        for word in set(words):
+            ids = postings.get(word)
+            if ids is None:
+                ids = postings[word] = array("I")
+                new.append(word)
+            ids.append(message_id)
+        if message_id >= len(self.lengths):
+            self.lengths.frombytes(bytes(2 * (message_id + 1024 - len(self.lengths))))
+        self.lengths[message_id] = min(len(words), 0xFFFF)
+        self.rooms[message_id] = room
+        self.total_length += len(words)
+        return new
+
+    def expand(self, word, prefix):
+        """The indexed words a query term stands for"""
+        if not prefix:
+            return [word] if word in self.postings else []
+        start = bisect.bisect_left(self.vocabulary, word)
+        words = []
+        for candidate in self.vocabulary[start:start + MAX_EXPANSIONS]:
+            if not candidate.startswith(word):
+                break
+            if candidate in self.postings:
+                words.append(candidate)
+        return words
+
+    def search(self, query, texts=None, limit=RESULTS):
+        """
+        Returns [(message id, room, score)], best first. texts(ids) -> {id: text}
+        is needed to check phrases; without it phrases match as plain words.
+        """
+        terms, phrases = parse_query(query)
+        if not terms:
+            return []
+        with self._lock:
+            ranked = self._rank(terms)
+            hits = [(message_id, self.rooms[message_id], score) for score, message_id in ranked]
+        if phrases and texts is not None:
+            hits = hits[:VERIFY_LIMIT]
+            found = texts([message_id for message_id, _, _ in hits])
+            hits = [hit for hit in hits if hit[0] in found and
+                    all(contains_phrase(tokenize(found[hit[0]]), phrase) for phrase in phrases)]
+        return hits[:limit]
+
+    def _rank(self, terms):
+        count = len(self.rooms)
+        average = self.total_length / count if count else 1
+        # Each term becomes a group of (postings, idf), one per word it expands to
+        groups = []
+        for word, prefix in terms:
+            group = [(self.postings[w], math.log(1 + (count - len(self.postings[w]) + 0.5) /
+                                                 (len(self.postings[w]) + 0.5)))
+                     for w in self.expand(word, prefix)]
+            if not group:
+                return []
+            groups.append(group)
+
+        # Walk the newest messages of the rarest group, probe the others with binary searches
+        groups.sort(key=lambda group: sum(len(ids) for ids, _ in group))
+        candidates = {}
+        cutoff = self._cutoff(groups[0])
+        for ids, idf in groups[0]:
+            for message_id in ids[bisect.bisect_left(ids, cutoff):]:
+                if candidates.get(message_id, 0) < idf:
+                    candidates[message_id] = idf
+
+        ranked = []
+        for message_id, weight in candidates.items():
+            for group in groups[1:]:
+                for ids, idf in group:
+                    i = bisect.bisect_left(ids, message_id)
+                    if i < len(ids) and ids[i] == message_id:
+                        weight += idf
+                        break
+                else:
+                    break
+            else:
+                norm = K1 * (1 - B + B * self.lengths[message_id] / average)
+                ranked.append((weight * (K1 + 1) / (1 + norm), message_id))
+        ranked.sort(reverse=True)
+        return ranked
+
+    def _cutoff(self, group):
+        """The lowest id that leaves about CANDIDATES of the group's ids at or above it"""
+        low, high = 0, len(self.lengths)
+        while low < high:
+            middle = (low + high) // 2
+            if sum(len(ids) - bisect.bisect_left(ids, middle) for ids, _ in group) > CANDIDATES:
+                low = middle + 1
+            else:
+                high = middle
+        return low
@@ -1,41 +1,749 @@
 # ================= SERVER =================
 # server.py
-import socket, threading, json
+import asyncio, argparse, base64, json, math, os, socket, time
+from collections import deque
+from functools import partial
+from ciphers import FALLBACK, SUITES, negotiate
+from framing import MAX_FRAME, FrameDecoder, encode_frame, iter_frames
+from metrics import Registry, SamplingProfiler, StatsServer
+from msglog import LogStore, SEGMENT_BYTES
+import msgcompress
+from relay import WorkerRelay, spawn_workers
+import session
+from spool import Spool, SpoolError
+from timerwheel import TimerWheel
+import wire
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HOST = "0.0.0.0"
+PORT = 5555
+BACKLOG = 4096
+RECV_BUFFER = 4096  # Per connection, grows only while a large frame is in flight
+LOGIN_MAX_FRAME = 16 * 1024  # Largest frame taken before the hello, the hello is far smaller
+WRITE_BUFFER_HIGH = 64 * 1024  # Transport buffer size at which we start queueing instead
+REPLAY_CHUNK = 256 * 1024  # History is written in slices this big so flow control can step in
+TICK = 1.0  # Seconds between housekeeping rounds: idle timeouts and presence diffs
+HEARTBEAT_MISSES = 3  # Heartbeats in a row a client may miss before it is dropped
+HEARTBEAT_MIN, HEARTBEAT_MAX = 1, 300  # Heartbeat intervals a client may ask for, in seconds
+DOWNLOAD_WINDOW = 8  # Chunks sent ahead of a download's acknowledgements, unless the client asks otherwise
+MAX_DOWNLOAD_WINDOW = 64
+SPOOL_SWEEP = 600  # Ticks between removals of expired spool files
+HISTORY_SWEEP = 600  # Ticks between age retention runs over every room's history
+CONTROL_QUEUE_SIZE = 1024  # Queued control replies at which a client counts as too slow
+
+# What to do with a client whose send queue is full:
+#   drop-oldest - discard the oldest queued message to make room
+#   disconnect  - drop the connection, the client can reconnect and catch up
+#   coalesce    - discard the whole backlog and tell the client how much it missed
+# Control replies (acks, names, presence, tickets) are never dropped, clients wait
+# on them; a client that lets CONTROL_QUEUE_SIZE of them pile up is disconnected
+SLOW_CONSUMER_POLICIES = ("drop-oldest", "disconnect", "coalesce")
+slow_consumer_policy = "drop-oldest"
+send_queue_size = 256
+cipher_preference = (FALLBACK,)  # Suites clients may encrypt with, only what every client reads unless enabled
+compression_allowed = ()  # Codecs clients may compress with, none unless enabled
+mailbox_size = 100  # Direct messages kept per offline user, the oldest go first
+max_file_mb = 100  # Largest file a client may upload
+spool_hours = 24  # How long uploaded files are kept
+
+DEFAULT_ROOM = "lobby"
 
 clients = {}
+rooms = {}  # Room name -> set of member connections
+relay = None  # WorkerRelay when running as one of several worker processes
+history = None  # LogStore when the server keeps message history
+spool = None  # Spool when the server takes file transfers
+sessions = None  # SessionCache of resumption tickets
+user_names = {}  # wire.name_id(username) -> username, for everyone seen so far
+mailboxes = {}  # Username -> deque of (sender, frame), direct messages waiting for them
+timers = TimerWheel()  # Idle timeouts of the clients that send heartbeats, in ticks
+presence_watchers = set()  # Connections that asked for presence updates
+presence_published = set()  # Usernames online, as far as the watchers have been told
+presence_changes = {}  # Username -> online, changes since the last diff went out
+PONG = encode_frame(json.dumps({"type": "pong"}).encode())
+
+# Metrics, served on --stats-port
+stats_host = "127.0.0.1"
+stats_port = None
+stats = Registry("messenger_")
+stats.gauge("connected_clients", "Clients that completed the handshake", lambda: len(clients))
+stats.gauge("rooms", "Rooms with at least one member here", lambda: len(rooms))
+stats.gauge("online_users", "Users online on any worker, as last published", lambda: len(presence_published))
+stats.gauge("idle_timers", "Clients whose heartbeats are being watched", lambda: len(timers))
+stats.gauge("send_queue_depth", "Messages queued per client, clients with an empty queue are left out",
+            lambda: [({"user": conn.username}, len(conn.outbox)) for conn in clients.values() if conn.outbox])
+stats.gauge("send_queue_depth_max", "Longest send queue of any client",
+            lambda: max((len(conn.outbox) for conn in clients.values()), default=0))
+accepted = stats.counter("accepted_connections_total", "Connections accepted")
+bytes_in = stats.counter("received_bytes_total", "Bytes read from clients")
+bytes_out = stats.counter("sent_bytes_total", "Bytes handed to client transports or queued for them")
+messages_in = stats.counter("received_messages_total", "Chat messages received from clients")
+messages_out = stats.counter("sent_messages_total", "Chat messages sent or queued to clients")
+messages_dropped = stats.counter("dropped_messages_total", "Messages discarded by the slow-consumer policy")
+fanout_time = stats.histogram("fanout_seconds", "Time to hand one message to every local member of its room")
+direct_outcomes = {outcome: stats.counter("direct_messages_total", "Direct messages by what became of them",
+                                         {"outcome": outcome})
+                   for outcome in ("delivered", "relayed", "stored", "dropped", "rejected")}
+stats.gauge("mailbox_messages", "Direct messages waiting for offline users",
+            lambda: sum(len(mailbox) for mailbox in mailboxes.values()))
+transfer_bytes = {direction: stats.counter("transfer_bytes_total", "File chunk bytes stored or sent",
+                                           {"direction": direction})
+                  for direction in ("upload", "download")}
+stats.gauge("active_transfers", "Uploads and downloads in progress",
+            lambda: sum(len(conn.uploads) + len(conn.downloads) for conn in clients.values()))
+handshakes = {kind: stats.counter("session_handshakes_total", "Session handshakes by kind", {"kind": kind})
+              for kind in ("full", "resumed")}
+stats.gauge("session_tickets", "Resumption tickets held", lambda: len(sessions) if sessions is not None else 0)
+errors = {kind: stats.counter("errors_total", "Connections closed because of an error", {"kind": kind})
+          for kind in ("protocol", "slow_consumer", "connection", "idle")}
+
+class Download:
+    """A spooled file going out to a client, at most window chunks ahead of its acknowledgements"""
+    __slots__ = ("file", "next", "acked", "window")
+
+    def __init__(self, file, start, window):
+        self.file = file
+        self.next = start
+        self.acked = start
+        self.window = window
+
+class ClientConnection(asyncio.BufferedProtocol):
+    """One connected client. All connections share a single event loop."""
+    __slots__ = ("transport", "username", "decoder", "outbox", "control", "paused", "skipped", "rooms", "replay",
+                 "room_ids", "wire", "last_seen", "idle_ticks", "uploads", "downloads", "link")
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.username = None
+        self.decoder = FrameDecoder(RECV_BUFFER, LOGIN_MAX_FRAME)
+        self.outbox = deque()
+        self.control = deque()  # Control replies waiting for the transport, ahead of the outbox
+        self.paused = False
+        self.skipped = 0
+        self.rooms = set()
+        self.replay = deque()
+        self.room_ids = {}  # wire.name_id(room) -> room, for the rooms we're in
+        self.wire = "json"  # Format we send this client messages in
+        self.last_seen = timers.now  # Tick we last heard from the client
+        self.idle_ticks = None  # Silence allowed before we drop it, None without heartbeats
+        self.uploads = {}  # Transfer id -> SpoolFile being written
+        self.downloads = {}  # Transfer id -> Download, sent round robin
+        self.link = None  # LinkCipher once the client has a session, every frame after the welcome is sealed
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        accepted.inc()
+
+    def get_buffer(self, sizehint):
+        return self.decoder.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        bytes_in.inc(nbytes)
+        self.last_seen = timers.now
+        try:
+            for frame in self.decoder.frames():
+                if self.link is not None:
+                    frame = self.link.open(frame)
+                self.frame_received(frame)
+        except Exception:
+            errors["protocol"].inc()
+            self.transport.close()
+
+    def frame_received(self, frame):
+        if self.username is None:
+            user = json.loads(str(frame, "utf-8"))
+            self.username = user["username"]
+            self.decoder.max_frame = MAX_FRAME
+            clients[self.username] = self
+            print(f"{self.username} connected.")
+            remember_user(self.username)
+            presence_changed(self.username, True)
+            if relay:
+                relay.user_online(self.username)
+            # Older clients don't offer suites and don't expect a reply
+            if "ciphers" in user:
+                if "binary" in user.get("formats", ()):
+                    self.wire = "binary"
+                welcome = {"type": "welcome", "cipher": negotiate(user["ciphers"], cipher_preference),
+                           "format": self.wire,
+                           "compression": msgcompress.negotiate(user.get("compression", ()),
+                                                                compression_allowed)}
+                if "heartbeat" in user:
+                    # Only clients that promise heartbeats can be timed out
+                    interval = min(max(float(user["heartbeat"]), HEARTBEAT_MIN), HEARTBEAT_MAX)
+                    self.idle_ticks = math.ceil(interval * HEARTBEAT_MISSES / TICK)
+                    timers.schedule(self, self.idle_ticks)
+                    welcome["heartbeat"] = interval
+                handshake = None
+                if sessions is not None and "session" in user:
+                    handshake = session.accept(user["session"], self.username, sessions)
+                if handshake is not None:
+                    welcome["session"] = handshake[0]
+                self.send_json(welcome)
+                if handshake is not None:
+                    self.start_session(user["session"], *handshake)
+            if user.get("presence"):
+                presence_watchers.add(self)
+                # The full list once, diffs from then on
+                self.send_json({"type": "presence", "online": sorted(presence_published)})
+            room = user.get("room", DEFAULT_ROOM)
+            join_room(self, room)
+            if "since" in user:
+                self.replay_history(room, user["since"])
+            deliver_mail(self.username)
+            return
+
+        if wire.is_binary(frame):
+            # Routed on the header alone, the body goes out untouched
+            kind, sender_id, target_id, seq, body = wire.unpack(frame)
+            if sender_id != wire.name_id(self.username):
+                return
+            if kind == wire.MESSAGE or kind == wire.FILE:
+                room = self.room_ids.get(target_id)
+                if room is not None:
+                    broadcast(room, self.username, body, kind)
+            elif kind == wire.CHUNK:
+                self.chunk_received(target_id, seq, body)
+            elif kind == wire.DIRECT:
+                recipient = user_names.get(target_id)
+                if recipient is not None:
+                    direct(self.username, recipient, body)
+                else:
+                    direct_outcomes["rejected"].inc()
+                    # The client knows the name behind the id, we never saw it
+                    self.send_json({"type": "undeliverable", "to": f"user-{target_id:016x}", "id": target_id,
+                                    "reason": "unknown user"})
+            return
 
-def broadcast(sender, message):
-    for user, conn in clients.items():
-        if user != sender:
-            try:
-                conn.send(json.dumps(message).encode())
-            except:
-                conn.close()
-                del clients[user]
-
-def handle_client(conn):
-    user = json.loads(conn.recv(1024).decode())
-    username = user["username"]
-    clients[username] = conn
-    print(f"{username} connected.")
-    
+        msg = json.loads(str(frame, "utf-8"))
+        kind = msg.get("type")
+        if kind == "join":
+            join_room(self, msg["room"])
+            if "since" in msg:
+                self.replay_history(msg["room"], msg["since"])
+        elif kind == "leave":
+            leave_room(self, msg["room"])
+        elif kind == "ping":
+            self.send_control(PONG)
+        elif kind == "direct":
+            if not direct(self.username, msg["to"], base64.urlsafe_b64decode(msg["data"])):
+                self.send_json({"type": "undeliverable", "to": msg["to"], "reason": "unknown user"})
+        elif kind == "who":
+            ids = msg["ids"]
+            self.send_json({"type": "names", "users": {str(i): user_names.get(i) for i in ids}})
+        elif kind == "upload":
+            self.start_upload(transfer_id(msg), msg["size"], msg["chunks"])
+        elif kind == "download":
+            self.start_download(transfer_id(msg), msg.get("from", 0), msg.get("window", DOWNLOAD_WINDOW))
+        elif kind == "download-ack":
+            download = self.downloads.get(transfer_id(msg))
+            if download is not None:
+                download.acked = max(download.acked, int(msg["chunks"]))
+                self.flush()
+        elif kind == "file":
+            if msg["room"] in self.rooms:
+                broadcast(msg["room"], self.username, base64.urlsafe_b64decode(msg["data"]), wire.FILE)
+        else:
+            room = msg.get("room", DEFAULT_ROOM)
+            # Only members get to post into a room
+            if room in self.rooms:
+                broadcast(room, self.username, base64.urlsafe_b64decode(msg["data"]))
+
+    def start_session(self, offer, reply, link, resumption):
+        """Seals everything after the welcome and hands the client a ticket for next time"""
+        self.link = link
+        if reply.get("resumed"):
+            handshakes["resumed"].inc()
+            if relay:
+                relay.ticket_used(session.decode(offer["ticket"], session.TICKET_SIZE))
+        else:
+            handshakes["full"].inc()
+        ticket = sessions.issue(resumption, self.username)
+        if relay:
+            relay.share_ticket(ticket, resumption, self.username, sessions.lifetime)
+        self.send_json({"type": "session-ticket", "ticket": session.encode(ticket), "lifetime": sessions.lifetime})
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            errors["connection"].inc()
+        timers.cancel(self)
+        presence_watchers.discard(self)
+        # Unfinished uploads stay in the spool to be resumed
+        for file in list(self.uploads.values()) + [d.file for d in self.downloads.values()]:
+            file.close()
+        self.uploads.clear()
+        self.downloads.clear()
+        for room in list(self.rooms):
+            leave_room(self, room)
+        # A reconnect under the same name may already have replaced us
+        if self.username is not None and clients.get(self.username) is self:
+            del clients[self.username]
+            print(f"{self.username} disconnected.")
+            presence_changed(self.username, False)
+            if relay:
+                relay.user_offline(self.username)
+
+    def idle_check(self):
+        """Runs when the idle timer fires, drops the client unless it was heard from meanwhile"""
+        idle = timers.now - self.last_seen
+        if idle < self.idle_ticks:
+            timers.schedule(self, self.idle_ticks - idle)
+            return
+        # Half-open connections never fail on their own, this is how they go
+        print(f"{self.username} timed out.")
+        errors["idle"].inc()
+        self.transport.abort()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def send(self, frame):
+        """Queues an encoded chat frame, never blocks on a slow reader"""
+        if self.transport.is_closing():
+            return
+        bytes_out.inc(len(frame))
+        if not self.paused and not self.control and not self.outbox and not self.skipped and not self.replay:
+            self.write(frame)
+            return
+
+        if len(self.outbox) >= send_queue_size:
+            if slow_consumer_policy == "disconnect":
+                self.too_slow()
+                return
+            if slow_consumer_policy == "coalesce":
+                messages_dropped.inc(len(self.outbox))
+                self.skipped += len(self.outbox)
+                self.outbox.clear()
+            else:
+                messages_dropped.inc()
+                self.outbox.popleft()
+        self.outbox.append(frame)
+
+    def send_control(self, frame):
+        """Queues an encoded control frame, the slow-consumer policy leaves these alone"""
+        if self.transport.is_closing():
+            return
+        bytes_out.inc(len(frame))
+        if not self.paused and not self.control:
+            self.write(frame)
+            return
+        if len(self.control) >= CONTROL_QUEUE_SIZE:
+            self.too_slow()
+            return
+        self.control.append(frame)
+
+    def send_json(self, message):
+        self.send_control(encode_frame(json.dumps(message).encode()))
+
+    def too_slow(self):
+        print(f"{self.username} too slow, disconnecting.")
+        errors["slow_consumer"].inc()
+        self.transport.abort()
+
+    def write(self, data):
+        """Hands whole frames to the transport, with a session each one is sealed on its own"""
+        if self.link is not None:
+            data = b"".join(map(self.link.seal, iter_frames(data)))
+        self.transport.write(data)
+
+    def start_upload(self, transfer_id, size, chunks):
+        """Opens or resumes an upload, tells the client how many chunks the spool already has"""
+        previous = self.uploads.pop(transfer_id, None)
+        if previous is not None:
+            previous.close()
+        if spool is None:
+            self.send_json({"type": "upload-error", "id": transfer_id, "reason": "the server doesn't take files"})
+            return
+        try:
+            upload = spool.open_upload(transfer_id, self.username, int(size), int(chunks))
+        except SpoolError as e:
+            self.send_json({"type": "upload-error", "id": transfer_id, "reason": str(e)})
+            return
+        if upload.complete:
+            spool.finish(upload)
+        else:
+            self.uploads[transfer_id] = upload
+        self.send_json({"type": "upload-ready", "id": transfer_id, "chunks": upload.received})
+
+    def chunk_received(self, transfer_id, index, body):
+        upload = self.uploads.get(transfer_id)
+        # Chunks still in flight from before a resume are already stored
+        if upload is None or index != upload.received:
+            return
+        try:
+            upload.append(body)
+        except SpoolError as e:
+            del self.uploads[transfer_id]
+            upload.close()
+            self.send_json({"type": "upload-error", "id": transfer_id, "reason": str(e)})
+            return
+        transfer_bytes["upload"].inc(len(body))
+        if upload.complete:
+            del self.uploads[transfer_id]
+            spool.finish(upload)
+        self.send_json({"type": "upload-ack", "id": transfer_id, "chunks": upload.received})
+
+    def start_download(self, transfer_id, start, window):
+        previous = self.downloads.pop(transfer_id, None)
+        if previous is not None:
+            previous.file.close()
+        if spool is None:
+            self.send_json({"type": "download-error", "id": transfer_id, "reason": "the server doesn't take files"})
+            return
+        try:
+            file = spool.open_download(transfer_id)
+        except SpoolError as e:
+            self.send_json({"type": "download-error", "id": transfer_id, "reason": str(e)})
+            return
+        self.downloads[transfer_id] = Download(file, min(max(int(start), 0), file.chunks),
+                                               min(max(int(window), 1), MAX_DOWNLOAD_WINDOW))
+        self.send_json({"type": "download-ready", "id": transfer_id, "chunks": file.chunks})
+        self.flush()
+
+    def send_chunks(self):
+        """
+        Writes a chunk of each download in turn until the transport pushes
+        back or every window is used up. Only runs with nothing else queued,
+        so chat traffic waits behind one buffer's worth of chunks at most.
+        """
+        while not self.paused:
+            sent = False
+            for transfer_id, download in list(self.downloads.items()):
+                if download.next == download.file.chunks:
+                    del self.downloads[transfer_id]
+                    download.file.close()
+                    continue
+                if download.next - download.acked >= download.window:
+                    continue
+                body = download.file.read(download.next)
+                frame = wire.pack(wire.CHUNK, 0, transfer_id, download.next, body)
+                download.next += 1
+                sent = True
+                bytes_out.inc(len(frame))
+                transfer_bytes["download"].inc(len(body))
+                self.write(frame)
+                if self.paused:
+                    break
+            if not sent:
+                break
+
+    def replay_history(self, room, since):
+        """Streams every logged frame of a room after seq since, ahead of live traffic"""
+        # Only rooms with history, replay requests name whatever room they like
+        log = history.find(room) if history is not None else None
+        if log is None:
+            return
+        for view in log.read_after(since):
+            if self.wire == "binary" and self.link is None:
+                bytes_out.inc(len(view))
+                for pos in range(0, len(view), REPLAY_CHUNK):
+                    self.replay.append(view[pos:pos + REPLAY_CHUNK])
+            else:
+                # JSON clients can't take the log as is, convert frame by frame; sealing goes by frames too
+                for frame in iter_frames(view):
+                    if self.wire != "binary":
+                        frame = wire.to_json_frame(frame, room, names=user_names)
+                    bytes_out.inc(len(frame))
+                    self.replay.append(frame)
+        self.flush()
+
+    def flush(self):
+        # transport.write calls pause_writing itself once the buffer fills up
+        while self.control and not self.paused:
+            self.write(self.control.popleft())
+        while self.replay and not self.paused:
+            self.write(self.replay.popleft())
+        if self.skipped and not self.paused:
+            notice = {"type": "skipped", "count": self.skipped}
+            self.skipped = 0
+            self.write(encode_frame(json.dumps(notice).encode()))
+        while self.outbox and not self.paused:
+            self.write(self.outbox.popleft())
+        if self.downloads and not self.paused:
+            self.send_chunks()
+
+def transfer_id(msg):
+    transfer_id = msg["id"]
+    if not isinstance(transfer_id, int) or not 0 <= transfer_id < 1 << 64:
+        raise ValueError("bad transfer id")
+    return transfer_id
+
+def remember_user(username):
+    user_id = wire.name_id(username)
+    if user_id not in user_names:
+        user_names[user_id] = username
+        if history is not None:
+            history.add_name(username)
+
+def user_seen(username, online):
+    """Relay callback for users coming and going on other workers"""
+    if online:
+        remember_user(username)
+        # Mail may have been left with us while they were away
+        deliver_mail(username)
+    presence_changed(username, online)
+
+def direct(sender, recipient, token):
+    """Sends an encrypted token to one user, False if nobody by that name was ever seen"""
+    if wire.name_id(recipient) not in user_names:
+        direct_outcomes["rejected"].inc()
+        return False
+    frame = wire.pack(wire.DIRECT, wire.name_id(sender), wire.name_id(recipient), 0, token)
+    deliver_direct(recipient, sender, frame)
+    return True
+
+def deliver_direct(recipient, sender, frame, forward=True):
+    """Hands a DIRECT frame to the recipient's connection, its worker, or its mailbox"""
+    conn = clients.get(recipient)
+    if conn is not None:
+        conn.send(frame if conn.wire == "binary" else wire.to_json_direct(frame, sender, recipient))
+        direct_outcomes["delivered"].inc()
+        return
+    # Frames from other workers aren't sent back, routes may be mid-update
+    if forward and relay and relay.send_direct(recipient, sender, frame):
+        direct_outcomes["relayed"].inc()
+        return
+    mailbox = mailboxes.get(recipient)
+    if mailbox is None:
+        mailbox = mailboxes[recipient] = deque(maxlen=mailbox_size)
+    if len(mailbox) == mailbox.maxlen:
+        direct_outcomes["dropped"].inc()
+    mailbox.append((sender, frame))
+    direct_outcomes["stored"].inc()
+
+def deliver_mail(username):
+    """Sends everything that waited for username, in a single write if they are connected here"""
+    mailbox = mailboxes.pop(username, None)
+    if not mailbox:
+        return
+    conn = clients.get(username)
+    if conn is None:
+        for sender, frame in mailbox:
+            deliver_direct(username, sender, frame)
+        return
+    if conn.wire == "binary":
+        frames = [frame for _, frame in mailbox]
+    else:
+        frames = [wire.to_json_direct(frame, sender, username) for sender, frame in mailbox]
+    conn.send(b"".join(frames))
+    direct_outcomes["delivered"].inc(len(frames))
+
+def presence_changed(username, online):
+    presence_changes[username] = online
+
+def publish_presence():
+    """Sends what changed since the last tick as one diff, encoded once for every watcher"""
+    if not presence_changes:
+        return
+    joined = [u for u, online in presence_changes.items() if online and u not in presence_published]
+    left = [u for u, online in presence_changes.items() if not online and u in presence_published]
+    presence_changes.clear()
+    presence_published.update(joined)
+    presence_published.difference_update(left)
+    if not (joined or left) or not presence_watchers:
+        return
+    frame = encode_frame(json.dumps({"type": "presence", "joined": joined, "left": left}).encode())
+    for conn in list(presence_watchers):
+        conn.send_control(frame)
+
+async def housekeeping():
+    """Once per TICK: expires idle clients, session tickets and publishes presence, now and then old spool files and history"""
     while True:
+        await asyncio.sleep(TICK)
+        for conn in timers.advance():
+            conn.idle_check()
+        publish_presence()
+        if sessions is not None:
+            sessions.expire()
+        if spool is not None and timers.now % SPOOL_SWEEP == 0:
+            spool.expire()
+        if history is not None and timers.now % HISTORY_SWEEP == 0:
+            history.expire()
+
+def join_room(conn, room):
+    members = rooms.get(room)
+    if members is None:
+        members = rooms[room] = set()
+        if relay:
+            relay.room_joined(room)
+    members.add(conn)
+    conn.rooms.add(room)
+    conn.room_ids[wire.name_id(room)] = room
+
+def leave_room(conn, room):
+    conn.rooms.discard(room)
+    conn.room_ids.pop(wire.name_id(room), None)
+    members = rooms.get(room)
+    if members is not None:
+        members.discard(conn)
+        if not members:
+            del rooms[room]
+            if relay:
+                relay.room_left(room)
+
+def broadcast(room, sender, token, kind=wire.MESSAGE):
+    """Sends an encrypted token to the room, it is framed once in the binary format"""
+    messages_in.inc()
+    seq = 0
+    log = None
+    if history is not None:
+        log = history.get(room)
+        seq = log.next_seq
+    frame = wire.pack(kind, wire.name_id(sender), wire.name_id(room), seq, token)
+    if log is not None:
+        log.append(frame)
+    deliver(room, sender, frame)
+    if relay:
+        relay.publish(room, sender, frame)
+
+def deliver(room, sender, frame):
+    """Sends a binary frame to this process's members of a room"""
+    start = time.perf_counter()
+    json_frame = None
+    sent = 0
+    for conn in list(rooms.get(room, ())):
+        if conn.username == sender:
+            continue
+        sent += 1
+        if conn.wire == "binary":
+            conn.send(frame)
+        else:
+            # Built at most once per message, and only if a JSON client is listening
+            if json_frame is None:
+                json_frame = wire.to_json_frame(frame, room, sender)
+            conn.send(json_frame)
+    messages_out.inc(sent)
+    fanout_time.observe(time.perf_counter() - start)
+
+def raise_fd_limit():
+    # Every idle connection holds a file descriptor, lift the soft cap to the hard one
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
         try:
-            msg = json.loads(conn.recv(4096).decode())
-            broadcast(username, msg)
-        except:
-            print(f"{username} disconnected.")
-            conn.close()
-            del clients[username]
-            break
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+async def serve(host, port):
+    loop = asyncio.get_running_loop()
+    if stats_port is not None:
+        # One endpoint per worker, next to each other
+        port_offset = relay.worker_id if relay else 0
+        stats_server = StatsServer(stats, SamplingProfiler())
+        await stats_server.start(stats_host, stats_port + port_offset)
+        print(f"Stats on http://{stats_host}:{stats_port + port_offset}/metrics")
+    if relay:
+        await relay.start()
+        # Each worker has its own listening socket, the kernel spreads accepts across them
+        server = await loop.create_server(ClientConnection, host, port, backlog=BACKLOG, reuse_port=True)
+        print(f"Worker {relay.worker_id} listening on port {port}")
+    else:
+        server = await loop.create_server(ClientConnection, host, port, backlog=BACKLOG)
+        print(f"Server listening on port {port}")
+    ticker = loop.create_task(housekeeping())  # Held so the task isn't garbage collected
+    async with server:
+        await server.serve_forever()
+
+def run_worker(host, port, worker_id, peer_sockets):
+    global relay
+    relay = WorkerRelay(worker_id, peer_sockets, deliver, on_user=user_seen,
+                        on_direct=partial(deliver_direct, forward=False), sessions=sessions)
+    stats.labels = {"worker": str(worker_id)}
+    asyncio.run(serve(host, port))
+
+def main():
+    global slow_consumer_policy, send_queue_size, history, cipher_preference, compression_allowed
+    global stats_host, stats_port, mailbox_size, spool, sessions
+
+    parser = argparse.ArgumentParser(description="Secure Messenger server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default=slow_consumer_policy,
+                        help="what to do when a client's send queue is full")
+    parser.add_argument("--queue-size", type=int, default=send_queue_size,
+                        help="messages queued per client before the slow-consumer policy applies")
+    parser.add_argument("--ciphers", default=",".join(cipher_preference),
+                        help="cipher suites clients may use, most preferred first; "
+                             "list aes-gcm and chacha20-poly1305 only once every client reads them")
+    parser.add_argument("--compression", default="",
+                        help="let clients compress messages with these codecs (zlib, zstd), only once every "
+                             "client understands them; zstd needs the zstandard package on every client")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port, one per core is a good start")
+    parser.add_argument("--mailbox-size", type=int, default=mailbox_size,
+                        help="direct messages kept for each offline user")
+    parser.add_argument("--stats-port", type=int,
+                        help="serve metrics and the profiler over HTTP on this port (worker N uses port + N)")
+    parser.add_argument("--stats-host", default=stats_host, help="address for the stats endpoint")
+    parser.add_argument("--spool-dir", help="take file transfers, keeping uploads in this directory")
+    parser.add_argument("--max-file-mb", type=int, default=max_file_mb, help="largest file a client may upload")
+    parser.add_argument("--spool-hours", type=float, default=spool_hours, help="how long uploaded files are kept")
+    parser.add_argument("--session-cache", type=int, default=session.CACHE_SIZE,
+                        help="session tickets kept for resumption, 0 to always do the full key exchange")
+    parser.add_argument("--session-hours", type=float, default=session.TICKET_LIFETIME / 3600,
+                        help="how long a session ticket can be resumed")
+    parser.add_argument("--log-dir", help="keep message history in this directory")
+    parser.add_argument("--segment-mb", type=int, default=SEGMENT_BYTES // (1024 * 1024),
+                        help="size of each history log segment")
+    parser.add_argument("--retention-mb", type=int, help="history kept per room before old segments go")
+    parser.add_argument("--retention-hours", type=float, help="age after which history segments go")
+    args = parser.parse_args()
+
+    slow_consumer_policy = args.slow_consumer
+    send_queue_size = args.queue_size
+    mailbox_size = args.mailbox_size
+    stats_host = args.stats_host
+    stats_port = args.stats_port
+    cipher_preference = tuple(name.strip() for name in args.ciphers.split(","))
+    for name in cipher_preference:
+        if name not in SUITES:
+            parser.error(f"unknown cipher suite {name}, choose from {', '.join(SUITES)}")
+    compression_allowed = tuple(name.strip() for name in args.compression.split(",") if name.strip())
+    for name in compression_allowed:
+        if name not in msgcompress.CODECS:
+            parser.error(f"unknown compression codec {name}, choose from {', '.join(msgcompress.CODECS)}")
 
-s = socket.socket()
-s.bind(("0.0.0.0", 5555))
-s.listen()
-print("Server listening on port 5555")
+    if session.available():
+        sessions = session.SessionCache(args.session_cache, args.session_hours * 3600)
+    if args.spool_dir:
+        # Workers share the directory, so this goes before they fork
+        spool = Spool(args.spool_dir, args.max_file_mb * 1024 * 1024, args.spool_hours * 3600)
 
-while True:
-    conn, addr = s.accept()
-    threading.Thread(target=handle_client, args=(conn,), daemon=True).start()
+    raise_fd_limit()
+    if args.workers > 1:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers needs a platform with fork() and SO_REUSEPORT")
+        if args.log_dir:
+            # Sequence numbers are handed out per process, workers would clash
+            parser.error("--log-dir can't be combined with --workers")
+        spawn_workers(args.workers, partial(run_worker, args.host, args.port))
+        return
 
+    if args.log_dir:
+        history = LogStore(
+            args.log_dir,
+            segment_bytes=args.segment_mb * 1024 * 1024,
+            retention_bytes=args.retention_mb * 1024 * 1024 if args.retention_mb else None,
+            retention_seconds=args.retention_hours * 3600 if args.retention_hours else None,
+        )
+        for name in history.load_names():
+            user_names[wire.name_id(name)] = name
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if history is not None:
+            history.close()
 
+if __name__ == "__main__":
+    main()
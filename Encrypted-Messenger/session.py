@@ -0,0 +1,204 @@
+"""
+Per-connection session keys between a client and the server.
+
+Messages are already encrypted end to end with the room's shared key, but
+everything around them (usernames, rooms, presence, file requests) went
+over the socket in the clear. A session seals every frame after the
+handshake with keys of its own, one per direction, in AES-GCM with a
+frame counter as the nonce, so frames can't be read, altered, replayed
+or reordered on the way.
+
+The handshake rides on the hello and welcome, so it costs no extra round
+trip:
+
+  full     The hello carries an X25519 key share, the welcome the
+           server's. Both sides derive the keys from the shared secret
+           with HKDF, along with a resumption secret.
+  resumed  The hello also carries a session ticket from an earlier
+           connection and a nonce. If the server still has the ticket it
+           derives the keys from the resumption secret and both nonces,
+           skipping the key exchange; otherwise it falls back to a full
+           handshake with the key share that came along.
+
+Right after the welcome, sealed already, the server hands out a new
+ticket. Tickets are used once and kept in a SessionCache, bounded in
+size and age.
+
+The key exchange isn't authenticated, there are no server certificates:
+sessions keep out eavesdroppers, not someone who can intercept and
+answer for the server. Message contents stay protected by the end-to-end
+key either way. Like ciphers.py, this imports without the cryptography
+package, the server then simply doesn't take sessions.
+"""
+
+import base64
+import os
+import time
+from collections import OrderedDict
+from framing import HEADER, FrameError
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:  # Server without cryptography installed
+    AESGCM = None
+
+KEY_SIZE = 32
+NONCE_SIZE = 16  # Resumption nonces, each side sends one
+TICKET_SIZE = 16
+CACHE_SIZE = 10000  # Tickets the server keeps, the least recently issued go first
+TICKET_LIFETIME = 24 * 3600  # Seconds a ticket stays good for
+
+def available():
+    return AESGCM is not None
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+def decode(text, size):
+    data = base64.urlsafe_b64decode(text)
+    if len(data) != size:
+        raise ValueError("malformed session field")
+    return data
+
+def public_bytes(key):
+    return key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+def derive(secret, salt, info):
+    """Client key, server key and the next resumption secret, from one secret"""
+    material = HKDF(algorithm=hashes.SHA256(), length=3 * KEY_SIZE, salt=salt,
+                    info=b"secure-messenger session " + info).derive(secret)
+    return material[:KEY_SIZE], material[KEY_SIZE:2 * KEY_SIZE], material[2 * KEY_SIZE:]
+
+class LinkCipher:
+    """
+    Seals outgoing frames and opens incoming ones. Frames have to be sealed
+    in the order they are written, the counters must line up on both ends.
+    """
+
+    def __init__(self, send_key, receive_key):
+        self._send = AESGCM(send_key)
+        self._receive = AESGCM(receive_key)
+        self._sent = 0
+        self._received = 0
+
+    def seal(self, frame):
+        """Takes an encoded frame, returns it encoded again with its payload sealed"""
+        nonce = self._sent.to_bytes(12, "big")
+        self._sent += 1
+        sealed = self._send.encrypt(nonce, memoryview(frame)[HEADER.size:], None)
+        return HEADER.pack(len(sealed)) + sealed
+
+    def open(self, payload):
+        """Takes a received frame payload, returns the payload it sealed"""
+        nonce = self._received.to_bytes(12, "big")
+        self._received += 1
+        try:
+            return self._receive.decrypt(nonce, payload, None)
+        except InvalidTag:
+            raise FrameError("frame failed verification") from None
+
+class ClientHandshake:
+    """The client's half: offer() goes into the hello, finish() takes the welcome's reply"""
+
+    def __init__(self, ticket=None):
+        self.ticket = ticket  # (ticket, resumption secret) from the last session, if any
+        self._key = X25519PrivateKey.generate()
+        self._public = public_bytes(self._key)
+        self._nonce = os.urandom(NONCE_SIZE)
+        self.resumed = False
+
+    def offer(self):
+        offer = {"key_share": encode(self._public)}
+        if self.ticket is not None:
+            offer["ticket"] = encode(self.ticket[0])
+            offer["nonce"] = encode(self._nonce)
+        return offer
+
+    def finish(self, reply):
+        """Returns the LinkCipher and resumption secret, or None if the server took no session"""
+        if reply is None:
+            return None
+        if reply.get("resumed"):
+            if self.ticket is None:
+                raise ValueError("server resumed a session we didn't offer")
+            salt = self._nonce + decode(reply["nonce"], NONCE_SIZE)
+            client_key, server_key, resumption = derive(self.ticket[1], salt, b"resumed")
+            self.resumed = True
+        else:
+            server_public = decode(reply["key_share"], KEY_SIZE)
+            shared = self._key.exchange(X25519PublicKey.from_public_bytes(server_public))
+            client_key, server_key, resumption = derive(shared, None, b"full" + self._public + server_public)
+        return LinkCipher(client_key, server_key), resumption
+
+def accept(offer, username, cache):
+    """
+    The server's half. Returns the reply for the welcome, the LinkCipher
+    and the resumption secret, or None if there is no session to be had.
+    """
+    if not available() or not isinstance(offer, dict):
+        return None
+    if "ticket" in offer:
+        secret = cache.take(decode(offer["ticket"], TICKET_SIZE), username)
+        if secret is not None:
+            nonce = os.urandom(NONCE_SIZE)
+            client_key, server_key, resumption = derive(secret, decode(offer["nonce"], NONCE_SIZE) + nonce,
+                                                        b"resumed")
+            return {"resumed": True, "nonce": encode(nonce)}, LinkCipher(server_key, client_key), resumption
+    client_public = decode(offer["key_share"], KEY_SIZE)
+    key = X25519PrivateKey.generate()
+    public = public_bytes(key)
+    shared = key.exchange(X25519PublicKey.from_public_bytes(client_public))
+    client_key, server_key, resumption = derive(shared, None, b"full" + client_public + public)
+    return {"key_share": encode(public)}, LinkCipher(server_key, client_key), resumption
+
+class SessionCache:
+    """
+    Resumption secrets by ticket, for the server. Every ticket lives the same
+    lifetime, so the least recently issued one is also the first to expire
+    and both evictions come off the front.
+    """
+
+    def __init__(self, size=CACHE_SIZE, lifetime=TICKET_LIFETIME):
+        self.size = size
+        self.lifetime = lifetime
+        self._tickets = OrderedDict()  # Ticket -> (resumption secret, username, expiry)
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def issue(self, secret, username):
+        """Stores a resumption secret under a new ticket and returns the ticket"""
+        ticket = os.urandom(TICKET_SIZE)
+        self.put(ticket, secret, username, self.lifetime)
+        return ticket
+
+    def put(self, ticket, secret, username, lifetime):
+        self._tickets[ticket] = (secret, username, time.monotonic() + lifetime)
+        while len(self._tickets) > self.size:
+            self._tickets.popitem(last=False)
+
+    def take(self, ticket, username):
+        """Removes a ticket and returns its secret, None if it is gone or someone else's"""
+        entry = self._tickets.pop(ticket, None)
+        if entry is None:
+            return None
+        secret, owner, expiry = entry
+        if owner != username or expiry < time.monotonic():
+            return None
+        return secret
+
+    def discard(self, ticket):
+        self._tickets.pop(ticket, None)
+
+    def expire(self):
+        now = time.monotonic()
+        while self._tickets:
+            ticket, (_, _, expiry) = next(iter(self._tickets.items()))
+            if expiry >= now:
+                break
+            del self._tickets[ticket]
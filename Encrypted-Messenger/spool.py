@@ -0,0 +1,159 @@
+"""
+File transfer spool for the server.
+
+Uploads are written to disk as they arrive, one file per transfer, and
+streamed back out chunk by chunk to whoever downloads them. The server
+never looks inside: chunks are encrypted end to end and stored as the
+sender's tokens, each length-prefixed like a frame (see framing.py),
+after a JSON header record naming the uploader and the chunk count.
+
+  <id>.part   upload in progress, resumable from its last whole chunk
+  <id>        complete, only read from then on
+
+Only the chunk offsets are kept in memory. Workers share the directory,
+so a file uploaded through one worker can be fetched through any other.
+Files go once they are older than the retention.
+"""
+
+import json
+import os
+import time
+from array import array
+from framing import HEADER, encode_frame
+
+CHUNK_OVERHEAD = 128  # Bytes encryption may add to a chunk, Fernet adds the most
+MIN_CHUNK = 1024  # Smallest chunk size an uploader may use, bounds the chunk count
+
+class SpoolError(Exception):
+    """Raised for a transfer the spool can't take or doesn't have"""
+
+class SpoolFile:
+    """One transfer's records, writable while the upload is in progress"""
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self.file = open(path, "r+b" if writable else "rb", buffering=0)
+        self.offsets = array("Q")  # Chunk index -> byte offset of its record
+        self.size = 0  # Bytes up to the end of the last whole record
+        try:
+            self._load()
+        except Exception:
+            self.file.close()
+            raise
+
+    @classmethod
+    def create(cls, path, owner, chunks, limit):
+        header = encode_frame(json.dumps({"owner": owner, "chunks": chunks, "limit": limit}).encode())
+        with open(path, "xb") as f:
+            f.write(header)
+        return cls(path, writable=True)
+
+    def _load(self):
+        end = os.fstat(self.file.fileno()).st_size
+        header = None
+        pos = 0
+        while pos + HEADER.size <= end:
+            (length,) = HEADER.unpack(self._read(pos, HEADER.size))
+            if pos + HEADER.size + length > end:
+                break
+            if header is None:
+                header = json.loads(self._read(pos + HEADER.size, length))
+                self.start = pos + HEADER.size + length  # Where the chunks begin
+            else:
+                self.offsets.append(pos)
+            pos += HEADER.size + length
+        if header is None:
+            raise SpoolError("spool file has no header")
+        self.owner = header["owner"]
+        self.chunks = header["chunks"]  # Chunks of the complete file
+        self.limit = header["limit"]  # Bytes the chunk records may take up
+        self.size = pos
+        # Drop a chunk cut short by a crash, the uploader sends it again
+        if self.writable and pos != end:
+            os.truncate(self.path, pos)
+
+    @property
+    def received(self):
+        return len(self.offsets)
+
+    @property
+    def complete(self):
+        return self.received == self.chunks
+
+    def append(self, body):
+        record = HEADER.pack(len(body)) + body
+        if self.complete or self.size - self.start + len(record) > self.limit:
+            raise SpoolError("upload larger than announced")
+        self.file.seek(self.size)
+        self.file.write(record)
+        self.offsets.append(self.size)
+        self.size += len(record)
+
+    def read(self, index):
+        offset = self.offsets[index]
+        (length,) = HEADER.unpack(self._read(offset, HEADER.size))
+        return self._read(offset + HEADER.size, length)
+
+    def _read(self, pos, size):
+        self.file.seek(pos)
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+class Spool:
+    def __init__(self, directory, max_file_bytes, retention_seconds=None):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.retention_seconds = retention_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, transfer_id):
+        return os.path.join(self.directory, f"{transfer_id:016x}")
+
+    def open_upload(self, transfer_id, owner, size, chunks):
+        """Starts an upload or picks up the one already under that id, returns its SpoolFile"""
+        if size > self.max_file_bytes:
+            raise SpoolError(f"file larger than {self.max_file_bytes} bytes")
+        if not 1 <= chunks <= size // MIN_CHUNK + 1:
+            raise SpoolError("bad chunk count")
+        path = self._path(transfer_id)
+        if os.path.exists(path):
+            upload = SpoolFile(path)  # Finished before the uploader heard back
+        elif os.path.exists(path + ".part"):
+            upload = SpoolFile(path + ".part", writable=True)
+        else:
+            limit = size + chunks * (HEADER.size + CHUNK_OVERHEAD)
+            try:
+                upload = SpoolFile.create(path + ".part", owner, chunks, limit)
+            except FileExistsError:
+                raise SpoolError("transfer id taken") from None
+        if upload.owner != owner or upload.chunks != chunks:
+            upload.close()
+            raise SpoolError("transfer id taken")
+        return upload
+
+    def finish(self, upload):
+        """Closes a complete upload and makes it available for download"""
+        upload.close()
+        if upload.writable:
+            os.replace(upload.path, upload.path[:-len(".part")])
+
+    def open_download(self, transfer_id):
+        try:
+            return SpoolFile(self._path(transfer_id))
+        except FileNotFoundError:
+            raise SpoolError("no such file") from None
+
+    def expire(self):
+        """Removes files, finished or not, older than the retention"""
+        if self.retention_seconds is None:
+            return
+        cutoff = time.time() - self.retention_seconds
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass  # Gone already, another worker got there first
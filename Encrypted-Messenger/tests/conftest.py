@@ -0,0 +1,57 @@
+"""
+Shared test setup. The modules live flat next to this directory, and
+tests that need a server start the real server.py on a free port.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+KEY = b"SXGguPKB6mbAFrfEKLE6uJko4Xu2DkLkPe2VJ8cAFeA="
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server didn't come up on port {port}")
+
+@pytest.fixture
+def server():
+    """start(*args) runs server.py with extra flags and returns its port"""
+    processes = []
+
+    def start(*args, port=None):
+        port = port or free_port()
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), "--host", "127.0.0.1",
+                                    "--port", str(port), *args],
+                                   cwd=ROOT, stdout=subprocess.DEVNULL)
+        processes.append(process)
+        wait_for_port(port)
+        return port
+
+    yield start
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
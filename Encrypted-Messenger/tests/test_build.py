@@ -0,0 +1,13 @@
+"""The build's startup import check"""
+
+import os
+
+import pytest
+
+pytest.importorskip("customtkinter")
+
+import build
+from conftest import ROOT
+
+def test_startup_check_passes_on_this_tree():
+    assert build.check_startup(os.path.join(ROOT, "client.py"), build.STARTUP_BUDGET_MS)
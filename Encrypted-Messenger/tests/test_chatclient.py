@@ -0,0 +1,275 @@
+"""ChatClient against a running server"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import urllib.request
+
+import pytest
+
+import chatclient
+import filetransfer
+from chatclient import ChatClient, MESSAGE, NOTICE
+from conftest import KEY, free_port
+from framing import HEADER, encode_frame
+
+async def wait_until(condition, timeout=5):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise TimeoutError("condition not met")
+        await asyncio.sleep(0.01)
+
+def texts(messages, kind=MESSAGE):
+    return [message.text for message in messages if message.kind == kind]
+
+def test_callback_errors_dont_stop_the_client(server, capsys):
+    port = server()
+
+    async def run():
+        received = []
+
+        def on_message(message):
+            received.append(message)
+            if message.text == "boom":
+                raise RuntimeError("bug in the callback")
+
+        alice = ChatClient("127.0.0.1", port, "alice", KEY)
+        bob = ChatClient("127.0.0.1", port, "bob", KEY, on_message=on_message)
+        await alice.connect()
+        await bob.connect()
+        await alice.send("boom")
+        await alice.send("still here")
+        await wait_until(lambda: "still here" in texts(received))
+        assert bob.connected
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(run())
+    assert "bug in the callback" in capsys.readouterr().err
+
+def test_malformed_frames_are_dropped():
+    async def run():
+        sender = ChatClient("127.0.0.1", 0, "bob", KEY)
+        frames = [
+            encode_frame(json.dumps({"type": "welcome", "cipher": "fernet"}).encode()),
+            encode_frame(json.dumps({"type": "names", "users": None}).encode()),
+            encode_frame(b"not json"),
+            sender._message_frame("hi", "lobby"),
+        ]
+
+        async def fake_server(reader, writer):
+            await reader.readexactly(HEADER.unpack(await reader.readexactly(HEADER.size))[0])
+            writer.write(b"".join(frames))
+            await writer.drain()
+            await reader.read()
+
+        listener = await asyncio.start_server(fake_server, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        received = []
+        client = ChatClient("127.0.0.1", port, "alice", KEY, on_message=received.append, reconnect=False)
+        await client.connect()
+        await wait_until(lambda: "hi" in texts(received))
+        assert client.failed == 2 and client.connected
+        await client.close()
+        listener.close()
+
+    asyncio.run(run())
+
+def test_catch_up_skips_own_messages(server, tmp_path):
+    port = server("--log-dir", str(tmp_path / "log"))
+
+    async def run():
+        alice = ChatClient("127.0.0.1", port, "alice", KEY)
+        bob = ChatClient("127.0.0.1", port, "bob", KEY)
+        await alice.connect()
+        await bob.connect()
+        for i in range(4):
+            await alice.send(f"alice {i}")
+        await bob.send("bob 0")
+        await asyncio.sleep(0.2)
+        await alice.close()
+        await bob.close()
+
+        received = []
+        alice = ChatClient("127.0.0.1", port, "alice", KEY, on_message=received.append)
+        alice.last_seq["lobby"] = 0  # Catch up from the start
+        await alice.connect()
+        await wait_until(lambda: alice.last_seq["lobby"] == 5)
+        await asyncio.sleep(0.1)
+        assert texts(received) == ["bob 0"]
+        await alice.close()
+
+    asyncio.run(run())
+
+def test_names_asked_again_until_answered(monkeypatch):
+    monkeypatch.setattr(chatclient, "NAME_TIMEOUT", 0.1)
+
+    async def run():
+        sender = ChatClient("127.0.0.1", 0, "bob", KEY)
+        sender.wire = "binary"
+        questions = []
+
+        async def read_frame(reader):
+            (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+            return json.loads(await reader.readexactly(length))
+
+        async def fake_server(reader, writer):
+            await read_frame(reader)
+            welcome = {"type": "welcome", "cipher": "fernet", "format": "binary"}
+            writer.write(encode_frame(json.dumps(welcome).encode()) + sender._message_frame("hi", "lobby"))
+            while True:
+                msg = await read_frame(reader)
+                if msg["type"] != "who":
+                    continue
+                questions.append(msg)
+                # The first answer goes missing
+                if len(questions) == 2:
+                    names = {"type": "names", "users": {str(i): "bob" for i in msg["ids"]}}
+                    writer.write(encode_frame(json.dumps(names).encode()))
+
+        listener = await asyncio.start_server(fake_server, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        received = []
+        client = ChatClient("127.0.0.1", port, "alice", KEY, on_message=received.append, reconnect=False)
+        await client.connect()
+        await wait_until(lambda: "hi" in texts(received))
+        assert len(questions) == 2 and received[-1].sender == "bob"
+        await client.close()
+        listener.close()
+
+    asyncio.run(run())
+
+def test_failed_connect_starts_no_decrypt_workers():
+    async def run():
+        threads = threading.active_count()
+        client = ChatClient("127.0.0.1", free_port(), "alice", KEY, workers=2)
+        with pytest.raises(OSError):
+            await client.connect()
+        assert client._pool is None
+        assert threading.active_count() == threads
+
+    asyncio.run(run())
+
+def test_direct_to_unknown_user(server):
+    stats_port = free_port()
+    port = server("--stats-port", str(stats_port))
+
+    async def run():
+        received = []
+        alice = ChatClient("127.0.0.1", port, "alice", KEY, on_message=received.append)
+        await alice.connect()
+        assert alice.wire == "binary"
+        await alice.send_direct("nobody", "hello?")
+        await wait_until(lambda: texts(received, NOTICE)[-1].startswith("Couldn't deliver"))
+        assert texts(received, NOTICE)[-1] == "Couldn't deliver to nobody: unknown user"
+        await alice.close()
+
+    asyncio.run(run())
+    with urllib.request.urlopen(f"http://127.0.0.1:{stats_port}/metrics", timeout=5) as response:
+        metrics = response.read().decode()
+    assert 'messenger_direct_messages_total{outcome="rejected"} 1' in metrics
+
+def test_handshake_failures(monkeypatch):
+    monkeypatch.setattr(chatclient, "HANDSHAKE_TIMEOUT", 0.2)
+
+    async def attempt(reply):
+        async def fake_server(reader, writer):
+            await reader.readexactly(HEADER.unpack(await reader.readexactly(HEADER.size))[0])
+            if reply is None:
+                writer.close()
+            elif reply:
+                writer.write(encode_frame(json.dumps(reply).encode()))
+            await reader.read()
+
+        listener = await asyncio.start_server(fake_server, "127.0.0.1", 0)
+        client = ChatClient("127.0.0.1", listener.sockets[0].getsockname()[1], "alice", KEY, reconnect=False)
+        try:
+            await client.connect()
+        except ConnectionError as e:
+            return str(e)
+        finally:
+            listener.close()
+
+    async def run():
+        assert await attempt({"type": "names"}) == "bad welcome: expected a welcome"
+        assert await attempt({}) == "no welcome from the server"
+        assert await attempt(None) == "server closed the connection during the handshake"
+
+    asyncio.run(run())
+
+def test_reconnects_after_the_server_hangs_up():
+    async def run():
+        connections = []
+
+        async def fake_server(reader, writer):
+            await reader.readexactly(HEADER.unpack(await reader.readexactly(HEADER.size))[0])
+            writer.write(encode_frame(json.dumps({"type": "welcome", "cipher": "fernet"}).encode()))
+            connections.append(writer)
+            if len(connections) == 1:
+                writer.close()
+            await reader.read()
+
+        listener = await asyncio.start_server(fake_server, "127.0.0.1", 0)
+        received = []
+        client = ChatClient("127.0.0.1", listener.sockets[0].getsockname()[1], "alice", KEY,
+                            on_message=received.append)
+        await client.connect()
+        await wait_until(lambda: "Reconnected" in texts(received, NOTICE))
+        assert "Disconnected from server" in texts(received, NOTICE)
+        assert client.connected and len(connections) == 2
+        await client.close()
+        listener.close()
+
+    asyncio.run(run())
+
+def test_transfers_resume_where_they_were_cut(server, tmp_path, monkeypatch):
+    port = server("--spool-dir", str(tmp_path / "spool"))
+    data = os.urandom(40 * filetransfer.CHUNK_SIZE + 123)
+    (tmp_path / "sent.bin").write_bytes(data)
+    clients = {}
+    resumed = {"upload": [], "download": []}
+
+    # Cut each transfer once, ten chunks in, and note where every attempt starts
+    upload_update = filetransfer.Upload.update
+    def update(upload, msg):
+        upload_update(upload, msg)
+        if msg["type"] == "upload-ready":
+            resumed["upload"].append(upload.done)
+        elif upload.done >= 10 and len(resumed["upload"]) == 1:
+            clients["alice"]._writer.transport.abort()
+    monkeypatch.setattr(filetransfer.Upload, "update", update)
+
+    download_request = filetransfer.Download.request
+    def request(download):
+        resumed["download"].append(download.done)
+        return download_request(download)
+    monkeypatch.setattr(filetransfer.Download, "request", request)
+
+    chunk_received = filetransfer.Download.chunk_received
+    def received(download, index, token, cipher):
+        chunk_received(download, index, token, cipher)
+        if download.done == 10 and len(resumed["download"]) == 1:
+            clients["bob"]._writer.transport.abort()
+    monkeypatch.setattr(filetransfer.Download, "chunk_received", received)
+
+    async def run():
+        for name in ("alice", "bob"):
+            clients[name] = ChatClient("127.0.0.1", port, name, KEY)
+            await clients[name].connect()
+        info = await clients["alice"].send_file(str(tmp_path / "sent.bin"))
+        path = await clients["bob"].download(info, str(tmp_path / "received"))
+        for client in clients.values():
+            await client.close()
+        return info, path
+
+    info, path = asyncio.run(run())
+    # The second attempts picked up from what had been acknowledged, not from zero
+    first, second = resumed["upload"]
+    assert first == 0 and 10 <= second < info.chunks
+    assert resumed["download"] == [0, 10]
+    assert info.sha256 == hashlib.sha256(data).hexdigest()
+    with open(path, "rb") as file:
+        assert file.read() == data
@@ -0,0 +1,113 @@
+"""MessageApp's networking, run without a window"""
+
+import asyncio
+import os
+import queue
+import time
+
+import pytest
+
+pytest.importorskip("customtkinter")
+pytest.importorskip("PIL")
+
+import client as gui
+from chatclient import ChatClient
+from chatview import OTHER, SYSTEM, USER
+from ciphers import Keyring
+from conftest import KEY
+from historycache import HistoryCache, local_key
+from searchindex import SearchIndex
+
+def drain(inbox):
+    items = []
+    while True:
+        try:
+            items.append(inbox.get_nowait())
+        except queue.Empty:
+            return items
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # The history cache goes under ~
+    monkeypatch.setenv("HOME", str(tmp_path))
+    app = gui.MessageApp.__new__(gui.MessageApp)
+    app.init_state()
+    yield app
+    if app.client is not None:
+        app.run(app.client.close()).result(10)
+    if app.history is not None:
+        app.history.close()
+    if app.thumbnails is not None:
+        app.thumbnails.close()
+    if app.loop is not None:
+        app.loop.call_soon_threadsafe(app.loop.stop)
+
+def test_log_in_handles_messages_during_connect(server, app):
+    port = server()
+    app.log_in("alice", "127.0.0.1", port)
+    assert app.client.connected
+    # The welcome's notice arrives while connect() is still running
+    notices = [message for _, message in drain(app.inbox) if message[0] == SYSTEM]
+    assert any(text.startswith("Encrypting with") for _, _, text, _ in notices)
+
+def test_files_are_fetched_on_click(server, app, tmp_path, monkeypatch):
+    port = server("--spool-dir", str(tmp_path / "spool"))
+    downloads = tmp_path / "downloads"
+    monkeypatch.setattr(gui, "DOWNLOAD_DIR", str(downloads))
+    app.log_in("alice", "127.0.0.1", port)
+    (tmp_path / "notes.bin").write_bytes(os.urandom(200 * 1024))
+    (tmp_path / "small.png").write_bytes(b"not much of an image")
+
+    async def share():
+        async with ChatClient("127.0.0.1", port, "bob", KEY) as bob:
+            await bob.send_file(str(tmp_path / "notes.bin"))
+            await bob.send_file(str(tmp_path / "small.png"))
+            await asyncio.sleep(0.2)
+
+    asyncio.run(share())
+    attachments = {}
+    deadline = time.monotonic() + 5
+    while len(attachments) < 2 and time.monotonic() < deadline:
+        for _, message in drain(app.inbox):
+            if len(message) > 4:
+                attachments[message[4].file.name] = message[4]
+        time.sleep(0.05)
+
+    # Small images come by themselves, anything else waits for a click
+    name, future = app.transfers_done.get(timeout=5)[1:]
+    assert name == "small.png" and future.result().endswith("small.png")
+    assert not attachments["notes.bin"].fetching
+    assert os.listdir(downloads) == ["small.png"]
+
+    app.open_attachment(attachments["notes.bin"])
+    name, future = app.transfers_done.get(timeout=5)[1:]
+    assert future.result() == str(downloads / "notes.bin")
+
+class ViewStub:
+    def __init__(self):
+        self.messages = []
+
+    def add(self, message):
+        self.messages.append(message)
+
+def test_own_messages_dont_hide_queued_ones(app, tmp_path):
+    # A peer's message gets its id on the network thread, then ours comes before the next tick
+    app.history = HistoryCache(str(tmp_path / "history.db"), Keyring(local_key(str(tmp_path))))
+    app.index = SearchIndex()
+    app.chat_view = ViewStub()
+    app.username = "alice"
+    message_id = app.remember("lobby", OTHER, "bob", "from bob", 1.0)
+    app.inbox.put((message_id, (OTHER, "bob", "from bob", "")))
+    app.remember("lobby", USER, "alice", "from alice", 2.0)
+    app.add_message_bubble("from alice", "", is_user=True)
+    assert [text for _, _, text, _ in app.take_inbox()] == ["from bob"]
+
+def test_messages_loaded_from_the_cache_arent_shown_twice(app, tmp_path):
+    app.history = HistoryCache(str(tmp_path / "history.db"), Keyring(local_key(str(tmp_path))))
+    app.index = SearchIndex()
+    first = app.remember("lobby", OTHER, "bob", "first", 1.0)
+    app.inbox.put((first, (OTHER, "bob", "first", "")))
+    second = app.remember("lobby", OTHER, "bob", "second", 2.0)
+    app.inbox.put((second, (OTHER, "bob", "second", "")))
+    app.newest_id = first  # A cache page had the first one
+    assert [text for _, _, text, _ in app.take_inbox()] == ["second"]
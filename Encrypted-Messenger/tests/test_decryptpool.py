@@ -0,0 +1,114 @@
+"""Decrypt pool ordering and failure counting, alone and behind a client"""
+
+import asyncio
+import random
+import threading
+import time
+
+from cryptography.fernet import Fernet
+
+from chatclient import ChatClient, MESSAGE, NOTICE
+from conftest import KEY
+from decryptpool import DecryptPool
+from test_server import RawClient
+
+SENDERS = ["alice", "bob", "carol", "dave", "erin"]
+
+class Collector:
+    """deliver() for a pool, gathers what the workers hand back"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = []
+        self.failed = 0
+        self.count = 0
+
+    def __call__(self, results, failed):
+        with self.lock:
+            self.results.extend(results)
+            self.failed += failed
+            self.count += len(results) + failed
+
+    def wait(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while self.count < count:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+def slow_decrypt(fernet):
+    def decrypt(token):
+        # Uneven work so the workers drift apart
+        time.sleep(random.random() / 1000)
+        return fernet.decrypt(token.encode()).decode()
+    return decrypt
+
+def test_each_sender_keeps_its_order():
+    fernet = Fernet(KEY)
+    collector = Collector()
+    pool = DecryptPool(slow_decrypt(fernet), collector, workers=3)
+    sent = 0
+    for batch in range(20):
+        messages = []
+        for i in range(10):
+            sender = random.choice(SENDERS)
+            messages.append({"from": sender, "data": fernet.encrypt(f"{sender} {batch * 10 + i}".encode()).decode()})
+        pool.submit(messages)
+        sent += len(messages)
+    collector.wait(sent)
+    pool.close()
+
+    assert collector.failed == 0 and len(collector.results) == sent
+    for sender in SENDERS:
+        numbers = [int(text.split()[1]) for msg, text in collector.results if msg["from"] == sender]
+        assert numbers == sorted(numbers)
+
+def test_tampered_tokens_are_counted_not_delivered():
+    fernet = Fernet(KEY)
+    collector = Collector()
+    pool = DecryptPool(slow_decrypt(fernet), collector, workers=2)
+    good = fernet.encrypt(b"fine").decode()
+    tampered = good[:-8] + ("A" if good[-8] != "A" else "B") + good[-7:]
+    pool.submit([{"from": "alice", "data": good}, {"from": "bob", "data": tampered},
+                 {"from": "alice", "data": good}, {"from": "bob", "data": "not a token"}])
+    collector.wait(4)
+    pool.close()
+
+    assert collector.failed == 2
+    assert [(msg["from"], text) for msg, text in collector.results] == [("alice", "fine"), ("alice", "fine")]
+
+def test_client_with_workers(server):
+    port = server()
+
+    async def run():
+        received = []
+        reader = ChatClient("127.0.0.1", port, "reader", KEY, workers=2, on_message=received.append)
+        await reader.connect()
+        senders = [ChatClient("127.0.0.1", port, name, KEY) for name in SENDERS[:3]]
+        for sender in senders:
+            await sender.connect()
+        forger = RawClient()
+        await forger.connect(port, {"username": "forger", "room": "lobby"})
+        await asyncio.sleep(0.1)
+
+        for i in range(30):
+            await senders[i % 3].send(f"{i}")
+            if i == 15:
+                forger.send({"room": "lobby", "data": Fernet.generate_key().decode()})
+                await forger.writer.drain()
+
+        deadline = asyncio.get_running_loop().time() + 5
+        while sum(message.kind == MESSAGE for message in received) < 30 or not reader.failed:
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.01)
+        for sender in senders:
+            numbers = [int(message.text) for message in received
+                       if message.kind == MESSAGE and message.sender == sender.username]
+            assert numbers == list(range(senders.index(sender), 30, 3))
+        assert reader.failed == 1
+        assert any(message.kind == NOTICE and "failed verification (1 so far)" in message.text for message in received)
+
+        forger.close()
+        for client in (reader, *senders):
+            await client.close()
+
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+"""Framing and the zero-copy frame decoder"""
+
+import random
+
+import pytest
+
+from framing import HEADER, MAX_FRAME, MIN_READ, FrameDecoder, FrameError, encode_frame, iter_frames
+
+def decode(decoder, data, sizes):
+    """Feeds data through get_buffer()/advance() in reads of the given sizes"""
+    frames = []
+    pos = 0
+    for size in sizes:
+        buffer = decoder.get_buffer(size)
+        n = min(size, len(buffer), len(data) - pos)
+        buffer[:n] = data[pos:pos + n]
+        pos += n
+        decoder.advance(n)
+        # Views are only good until the next get_buffer()
+        frames.extend(bytes(frame) for frame in decoder.frames())
+    assert pos == len(data)
+    return frames
+
+def test_split_reads():
+    rng = random.Random(1)
+    for _ in range(200):
+        payloads = [rng.randbytes(rng.choice((0, 1, 3, 100, 5000, 70000))) for _ in range(rng.randint(1, 20))]
+        data = b"".join(map(encode_frame, payloads))
+        sizes = []
+        while sum(sizes) < len(data):
+            sizes.append(rng.randint(1, 20000))
+        assert decode(FrameDecoder(size=1024), data, sizes) == payloads
+
+def test_buffer_shrinks_after_a_large_frame():
+    decoder = FrameDecoder(size=MIN_READ)
+    assert decode(decoder, encode_frame(bytes(100000)), [100004]) == [bytes(100000)]
+    assert len(decoder.get_buffer()) == MIN_READ
+
+def test_declared_length_is_not_allocated_up_front():
+    decoder = FrameDecoder(size=MIN_READ)
+    decode(decoder, HEADER.pack(MAX_FRAME) + bytes(5000), [4096, 908])
+    # Grows with what arrived, not with what the peer says is coming
+    assert len(decoder.get_buffer()) + 5004 <= 4 * MIN_READ
+
+def test_oversized_frames_are_refused():
+    decoder = FrameDecoder(max_frame=100)
+    decoder.feed(HEADER.pack(101))
+    with pytest.raises(FrameError):
+        list(decoder.frames())
+
+def test_iter_frames():
+    frames = [encode_frame(b"one"), encode_frame(b""), encode_frame(b"three")]
+    assert [bytes(f) for f in iter_frames(b"".join(frames))] == frames
@@ -0,0 +1,46 @@
+"""The client's local history cache"""
+
+import os
+import stat
+
+import pytest
+
+pytest.importorskip("cryptography")
+
+from ciphers import Keyring
+from historycache import HistoryCache, local_key
+
+def test_local_key_is_made_once_for_the_user_alone(tmp_path):
+    key = local_key(str(tmp_path))
+    assert local_key(str(tmp_path)) == key
+    assert stat.S_IMODE(os.stat(tmp_path / "key").st_mode) == 0o600
+    assert local_key(str(tmp_path / "elsewhere")) != key
+
+def test_local_key_survives_an_interrupted_write(tmp_path):
+    (tmp_path / "key").write_bytes(b"")
+    key = local_key(str(tmp_path))
+    assert len(key) == 44 and local_key(str(tmp_path)) == key
+    assert stat.S_IMODE(os.stat(tmp_path / "key").st_mode) == 0o600
+    assert os.listdir(tmp_path) == ["key"]
+
+@pytest.mark.parametrize("content", [b"c2hvcnQ=", b"not base64 at all!", b"A" * 43])
+def test_corrupt_local_key_is_refused_not_replaced(tmp_path, content):
+    (tmp_path / "key").write_bytes(content)
+    with pytest.raises(ValueError, match="key"):
+        local_key(str(tmp_path))
+    assert (tmp_path / "key").read_bytes() == content
+
+def test_cache_reads_back_only_under_its_key(tmp_path):
+    path = str(tmp_path / "history.db")
+    cache = HistoryCache(path, Keyring(local_key(str(tmp_path))))
+    cache.add("lobby", "other", "bob", "hello", at=1.0, seq=3)
+    cache.close()
+
+    cache = HistoryCache(path, Keyring(local_key(str(tmp_path))))
+    assert [text for _, _, _, text, _ in cache.page("lobby")] == ["hello"]
+    assert cache.last_seqs() == {"lobby": 3}
+    cache.close()
+
+    cache = HistoryCache(path, Keyring(local_key(str(tmp_path / "elsewhere"))))
+    assert cache.page("lobby") == []
+    cache.close()
@@ -0,0 +1,34 @@
+"""Metrics and the sampling profiler"""
+
+import threading
+
+from metrics import Registry, SamplingProfiler
+
+def test_render():
+    registry = Registry("test_", {"worker": "1"})
+    registry.counter("hits_total", "Hits").inc(3)
+    text = registry.render()
+    assert "# TYPE test_hits_total counter" in text
+    assert 'test_hits_total{worker="1"} 3' in text
+
+def test_profiler_restarts_while_sampling():
+    done = threading.Event()
+
+    def busy():
+        while not done.is_set():
+            sum(range(1000))
+
+    worker = threading.Thread(target=busy)
+    worker.start()
+    try:
+        profiler = SamplingProfiler(worker.ident)
+        for _ in range(20):
+            profiler.start(hz=2000)
+            done.wait(0.01)
+            folded = profiler.stop()
+            assert not profiler.running
+            assert folded == "".join(f"{stack} {count}\n" for stack, count in profiler.stacks.most_common())
+        assert "busy" in folded
+    finally:
+        done.set()
+        worker.join()
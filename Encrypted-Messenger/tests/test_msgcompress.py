@@ -0,0 +1,55 @@
+"""Compression round trips and the size cap"""
+
+import zlib
+
+import pytest
+
+import msgcompress
+from msgcompress import Compressor, MAX_PLAINTEXT, decompress
+
+CODECS = [name for name in ("zlib", "zstd") if name in msgcompress.available_codecs()]
+
+@pytest.mark.parametrize("codec", CODECS + [None])
+@pytest.mark.parametrize("text", [b"", b"hi", b"sounds good, see you tomorrow at the meeting " * 3,
+                                  "d\u00e9j\u00e0 vu \U0001f600".encode() * 100],
+                         ids=["empty", "short", "chat", "long"])
+def test_round_trip(codec, text):
+    assert decompress(Compressor(codec).compress(text)) == text
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_binary_round_trip(codec):
+    # Only compressed or stored plaintext may start with a codec byte
+    text = bytes(range(256)) * 8
+    assert decompress(Compressor(codec).compress(text)) == text
+
+def test_untagged_plaintext_passes_through():
+    assert decompress(b"plain text from an old client") == b"plain text from an old client"
+
+def test_deflate_bomb_is_refused():
+    deflate = zlib.compressobj(9, zlib.DEFLATED, -15)
+    bomb = bytes((msgcompress.DEFLATE,)) + deflate.compress(bytes(64 * MAX_PLAINTEXT)) + deflate.flush()
+    with pytest.raises(ValueError):
+        decompress(bomb)
+
+def test_zstd_bomb_is_refused():
+    zstandard = pytest.importorskip("zstandard")
+    packed = zstandard.ZstdCompressor(write_content_size=False).compress(bytes(256 * MAX_PLAINTEXT))
+    with pytest.raises(ValueError):
+        decompress(bytes((msgcompress.ZSTD,)) + packed)
+
+def test_zstd_up_to_the_cap():
+    pytest.importorskip("zstandard")
+    text = b"a" * MAX_PLAINTEXT
+    assert decompress(Compressor("zstd").compress(text)) == text
+
+def test_dictionary_is_pinned():
+    # Part of the wire format: changing it breaks DEFLATE_DICT and ZSTD_DICT between versions
+    assert zlib.crc32(msgcompress.DICTIONARY) == 0x8453e9b1
+
+def test_trained_dictionary_primes_deflate():
+    samples = [b"see you at the meeting tomorrow", b"sounds good, see you tomorrow"] * 10
+    dictionary = msgcompress.train_dictionary(samples, size=64)
+    assert len(dictionary) <= 64 and b"tomorrow" in dictionary
+    deflate = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=dictionary)
+    packed = deflate.compress(samples[0]) + deflate.flush()
+    assert zlib.decompressobj(-15, zdict=dictionary).decompress(packed) == samples[0]
@@ -0,0 +1,101 @@
+"""The server's history logs"""
+
+import os
+import time
+
+import pytest
+
+from framing import encode_frame
+from msglog import INDEX_INTERVAL, LogStore, MessageLog
+
+def frame(i):
+    return encode_frame(f"message {i}".encode())
+
+def frames(start, end):
+    return b"".join(frame(i) for i in range(start, end))
+
+def replay(log, since):
+    return b"".join(log.read_after(since))
+
+@pytest.mark.parametrize("segment_bytes", [64, 1024, 1 << 20])
+def test_read_after(tmp_path, segment_bytes):
+    log = MessageLog(str(tmp_path), segment_bytes=segment_bytes)
+    # Long enough to need the sparse index
+    count = 3 * INDEX_INTERVAL // len(frame(0))
+    assert [log.append(frame(i)) for i in range(count)] == list(range(1, count + 1))
+    for since in (0, 1, 17, count // 2, count - 1, count, count + 5):
+        assert replay(log, since) == frames(min(since, count), count)
+    log.close()
+
+def test_reopens_where_it_left_off(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=256)
+    for i in range(50):
+        log.append(frame(i))
+    log.close()
+
+    log = MessageLog(str(tmp_path), segment_bytes=256)
+    assert log.next_seq == 51
+    assert log.append(frame(50)) == 51
+    assert replay(log, 40) == frames(40, 51)
+    log.close()
+
+def test_a_torn_last_frame_is_dropped(tmp_path):
+    log = MessageLog(str(tmp_path))
+    for i in range(3):
+        log.append(frame(i))
+    path = log.segments[-1].log_path
+    log.close()
+    with open(path, "ab") as f:
+        f.write(frame(3)[:-2])  # Cut short by a crash
+
+    log = MessageLog(str(tmp_path))
+    assert log.next_seq == 4
+    log.append(frame(3))
+    assert replay(log, 0) == frames(0, 4)
+    log.close()
+
+def test_size_retention(tmp_path):
+    log = MessageLog(str(tmp_path), segment_bytes=64, retention_bytes=200)
+    for i in range(40):
+        log.append(frame(i))
+    assert log.first_seq > 1
+    assert sum(segment.size for segment in log.segments) <= 200 + 64
+    # What was dropped is simply not replayed
+    assert replay(log, 0) == frames(log.first_seq - 1, 40)
+    log.close()
+
+def test_find_does_not_create_logs(tmp_path):
+    store = LogStore(str(tmp_path))
+    assert store.find("nowhere") is None
+    assert os.listdir(tmp_path) == []
+    store.get("lobby").append(frame(1))
+    assert store.find("lobby") is store.get("lobby")
+    store.close()
+
+def test_open_logs_are_capped(tmp_path):
+    store = LogStore(str(tmp_path), max_open=2)
+    for room in ("a", "b", "c"):
+        store.get(room).append(frame(1))
+    assert list(store.logs) == ["b", "c"]
+    # A closed log opens again with its history intact
+    log = store.find("a")
+    assert log.next_seq == 2
+    assert list(store.logs) == ["c", "a"]
+    store.close()
+
+def test_expire_reaches_quiet_rooms(tmp_path):
+    store = LogStore(str(tmp_path), max_open=1, segment_bytes=64, retention_seconds=60)
+    for i in range(10):
+        store.get("quiet").append(frame(i))
+    segments = store.get("quiet").segments
+    assert len(segments) > 1
+    old = time.time() - 120
+    for segment in segments[:-1]:
+        os.utime(segment.log_path, (old, old))
+    store.get("busy")  # Closes the quiet room's log
+
+    store.expire()
+    log = store.find("quiet")
+    assert len(log.segments) == 1
+    assert b"".join(log.read_after(0)) == b"".join(frame(i) for i in range(log.first_seq - 1, 10))
+    store.close()
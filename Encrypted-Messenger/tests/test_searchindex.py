@@ -0,0 +1,49 @@
+"""Full-text search over the local history"""
+
+from searchindex import SearchIndex, parse_query
+
+TEXTS = {
+    1: "the cat sat on the mat",
+    2: "dogs and cats",
+    3: "see you later",
+    4: "later, you will see",
+    5: "cat food is on sale",
+}
+
+def index(ids=TEXTS):
+    index = SearchIndex()
+    index.build((i, "lobby", TEXTS[i]) for i in sorted(ids))
+    return index
+
+def ids(hits):
+    return sorted(message_id for message_id, _, _ in hits)
+
+def texts(wanted):
+    return {i: TEXTS[i] for i in wanted}
+
+def test_parse_query():
+    assert parse_query('cat foo-ba* "see you"') == (
+        [("cat", False), ("foo", False), ("ba", True), ("see", False), ("you", False)], [["see", "you"]])
+
+def test_words_prefixes_and_phrases():
+    search = index()
+    assert ids(search.search("cat")) == [1, 5]
+    assert ids(search.search("cat on")) == [1, 5]
+    assert ids(search.search("cat*")) == [1, 2, 5]
+    assert ids(search.search("nothing")) == []
+    # Without texts a phrase only needs its words
+    assert ids(search.search('"see you"')) == [3, 4]
+    assert ids(search.search('"see you"', texts)) == [3]
+
+def test_short_and_new_messages_rank_first():
+    search = index()
+    assert search.search("cat")[0][0] == 5  # Shorter
+    search.add(6, "lobby", "cat food is on sale")
+    assert search.search("food")[0][0] == 6  # Same text, newer
+
+def test_build_keeps_messages_added_meanwhile():
+    search = SearchIndex()
+    search.add(10, "other", "cat news")
+    search.build((i, "lobby", TEXTS[i]) for i in sorted(TEXTS))
+    assert ids(search.search("cat")) == [1, 5, 10]
+    assert [room for i, room, _ in search.search("news")] == ["other"]
@@ -0,0 +1,354 @@
+"""Server behaviour, seen from clients on the wire"""
+
+import asyncio
+import base64
+import json
+import os
+import re
+import socket
+import urllib.request
+
+import pytest
+
+from cryptography.fernet import Fernet
+
+from chatclient import DIRECT, ChatClient
+from conftest import KEY, free_port, wait_for_port
+from framing import HEADER, encode_frame
+
+class RawClient:
+    """A framed JSON client that speaks only what the first versions did"""
+
+    async def connect(self, port, hello, receive_buffer=None):
+        sock = socket.socket()
+        if receive_buffer is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        sock.connect(("127.0.0.1", port))
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.send(hello)
+        await self.writer.drain()
+
+    def send(self, message):
+        self.writer.write(encode_frame(json.dumps(message).encode()))
+
+    async def receive(self, timeout=5):
+        (length,) = HEADER.unpack(await asyncio.wait_for(self.reader.readexactly(HEADER.size), timeout))
+        return json.loads(await asyncio.wait_for(self.reader.readexactly(length), timeout))
+
+    async def receive_chat(self, timeout=5):
+        """Skips control messages"""
+        while True:
+            message = await self.receive(timeout)
+            if "data" in message:
+                return message
+
+    def close(self):
+        self.writer.close()
+
+def test_old_clients_read_new_clients_by_default(server):
+    port = server()
+
+    async def run():
+        old = RawClient()
+        await old.connect(port, {"username": "old", "room": "lobby"})
+        new = ChatClient("127.0.0.1", port, "new", KEY)
+        await new.connect()
+        await asyncio.sleep(0.1)
+        await new.send("hello old friend")
+        message = await old.receive_chat()
+        assert Fernet(KEY).decrypt(message["data"].encode()) == b"hello old friend"
+        await new.close()
+        old.close()
+
+    asyncio.run(run())
+
+def test_aead_suites_once_enabled(server):
+    port = server("--ciphers", "aes-gcm,fernet")
+
+    async def run():
+        client = ChatClient("127.0.0.1", port, "new", KEY)
+        await client.connect()
+        assert client.cipher.active.name == "aes-gcm"
+        await client.close()
+
+    asyncio.run(run())
+
+def test_control_replies_outlast_the_slow_consumer_policy(server):
+    port = server("--slow-consumer", "coalesce", "--queue-size", "4")
+    data = base64.urlsafe_b64encode(bytes(256 * 1024)).decode()
+
+    async def run():
+        slow = RawClient()
+        await slow.connect(port, {"username": "slow", "room": "lobby"}, receive_buffer=4096)
+        fast = RawClient()
+        await fast.connect(port, {"username": "fast", "room": "lobby"})
+
+        async def flood():
+            for _ in range(50):
+                fast.send({"room": "lobby", "data": data})
+                await fast.writer.drain()
+
+        # slow doesn't read meanwhile, so its queue overflows on both sides of the question
+        await flood()
+        await asyncio.sleep(0.5)
+        slow.send({"type": "who", "ids": [1]})
+        await slow.writer.drain()
+        await flood()
+        await asyncio.sleep(0.5)
+
+        kinds = set()
+        try:
+            while True:
+                kinds.add((await slow.receive(timeout=1)).get("type"))
+        except asyncio.TimeoutError:
+            pass
+        assert "skipped" in kinds
+        assert "names" in kinds
+        slow.close()
+        fast.close()
+
+    asyncio.run(run())
+
+def test_sessions_resume_with_their_ticket(server):
+    stats_port = free_port()
+    port = server("--stats-port", str(stats_port))
+
+    async def run():
+        received = []
+        alice = ChatClient("127.0.0.1", port, "alice", KEY, on_message=received.append)
+        bob = ChatClient("127.0.0.1", port, "bob", KEY)
+        await alice.connect()
+        await bob.connect()
+        assert alice._link is not None and not alice._handshake.resumed
+        deadline = asyncio.get_running_loop().time() + 5
+        while alice._ticket is None:
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.01)
+        ticket = alice._ticket
+
+        alice._writer.transport.abort()
+        while not any(message.text == "Reconnected" for message in received):
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.01)
+        assert alice._handshake.resumed
+        assert alice._handshake.ticket == ticket[:2]
+
+        # Sealed traffic flows under the resumed keys
+        await bob.send("still private")
+        while not any(message.text == "still private" for message in received):
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.01)
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(run())
+    with urllib.request.urlopen(f"http://127.0.0.1:{stats_port}/metrics", timeout=5) as response:
+        metrics = response.read().decode()
+    assert 'messenger_session_handshakes_total{kind="full"} 2' in metrics
+    assert 'messenger_session_handshakes_total{kind="resumed"} 1' in metrics
+
+def test_large_frames_only_after_the_hello(server):
+    port = server()
+
+    async def run():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(HEADER.pack(1024 * 1024) + bytes(1000))
+        assert await asyncio.wait_for(reader.read(), 5) == b""  # Closed on us
+        writer.close()
+
+        received = []
+        alice = ChatClient("127.0.0.1", port, "alice", KEY, on_message=received.append)
+        bob = ChatClient("127.0.0.1", port, "bob", KEY)
+        await alice.connect()
+        await bob.connect()
+        text = "long " * 50000
+        await bob.send(text)
+        deadline = asyncio.get_running_loop().time() + 5
+        while text not in [message.text for message in received]:
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.01)
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(run())
+
+def numbered(i, size=256 * 1024):
+    return base64.urlsafe_b64encode(i.to_bytes(4, "big") + bytes(size)).decode()
+
+def number(message):
+    return int.from_bytes(base64.urlsafe_b64decode(message["data"])[:4], "big")
+
+@pytest.mark.parametrize("policy", ["drop-oldest", "disconnect", "coalesce"])
+def test_slow_consumer_policies(server, policy):
+    port = server("--slow-consumer", policy, "--queue-size", "4")
+    count = 60
+
+    async def run():
+        slow = RawClient()
+        await slow.connect(port, {"username": "slow", "room": "lobby"}, receive_buffer=4096)
+        fast = RawClient()
+        await fast.connect(port, {"username": "fast", "room": "lobby"})
+        sender = RawClient()
+        await sender.connect(port, {"username": "sender", "room": "lobby"})
+        await asyncio.sleep(0.1)
+
+        # Paced by the fast client, which keeps up and gets everything whatever becomes of the slow one
+        for i in range(count):
+            sender.send({"room": "lobby", "data": numbered(i)})
+            await sender.writer.drain()
+            assert number(await fast.receive_chat()) == i
+
+        # Only now does the slow client start reading
+        numbers = []
+        kinds = set()
+        try:
+            while True:
+                message = await slow.receive(timeout=1)
+                kinds.add(message.get("type"))
+                if "data" in message:
+                    numbers.append(number(message))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            pass
+        if policy == "disconnect":
+            assert await slow.reader.read() == b""
+            assert numbers == sorted(numbers) and len(numbers) < count
+        else:
+            # Whatever was dropped, the newest messages made it
+            assert numbers[-1] == count - 1 and numbers == sorted(numbers) and len(numbers) < count
+            assert ("skipped" in kinds) == (policy == "coalesce")
+        for client in (slow, fast, sender):
+            client.close()
+
+    asyncio.run(run())
+
+def connected_clients(stats_port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{stats_port}/metrics", timeout=5) as response:
+        return int(re.search(r"^messenger_connected_clients\S* (\d+)$", response.read().decode(), re.M).group(1))
+
+@pytest.mark.skipif(not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"), reason="--workers needs fork()")
+def test_workers_relay_to_each_other(server):
+    stats_port = free_port()
+    port = server("--workers", "2", "--stats-port", str(stats_port))
+    wait_for_port(stats_port + 1)
+
+    async def run():
+        # The kernel picks the worker, keep connecting until each has a client
+        clients = []
+        by_worker = {}
+        while len(by_worker) < 2:
+            assert len(clients) < 32
+            client = RawClient()
+            client.name = f"user{len(clients)}"
+            await client.connect(port, {"username": client.name, "room": "lobby", "presence": True})
+            clients.append(client)
+            deadline = asyncio.get_running_loop().time() + 5
+            while True:
+                counts = [connected_clients(stats_port + worker) for worker in range(2)]
+                if sum(counts) == len(clients):
+                    break
+                assert asyncio.get_running_loop().time() < deadline
+                await asyncio.sleep(0.05)
+            for worker, count in enumerate(counts):
+                if count > sum(1 for c in clients[:-1] if c.worker == worker):
+                    client.worker = worker
+            by_worker.setdefault(client.worker, client)
+        first, second = by_worker[0], by_worker[1]
+
+        # Presence covers the users of both workers
+        online = set()
+        while online != {c.name for c in clients}:
+            message = await second.receive()
+            if message.get("type") == "presence":
+                online.update(message.get("online", []), message.get("joined", []))
+                online.difference_update(message.get("left", []))
+
+        first.send({"room": "lobby", "data": "aGVsbG8="})
+        await first.writer.drain()
+        message = await second.receive_chat()
+        assert (message["from"], message["data"]) == (first.name, "aGVsbG8=")
+
+        first.send({"type": "direct", "to": second.name, "data": "c2VjcmV0"})
+        await first.writer.drain()
+        while True:
+            message = await second.receive()
+            if message.get("type") == "direct":
+                break
+        assert (message["from"], message["to"], message["data"]) == (first.name, second.name, "c2VjcmV0")
+        for client in clients:
+            client.close()
+
+    asyncio.run(run())
+
+def test_silent_clients_are_dropped_and_watchers_get_diffs(server):
+    port = server()
+
+    async def run():
+        watcher = RawClient()
+        await watcher.connect(port, {"username": "watcher", "room": "lobby", "presence": True})
+        assert await watcher.receive() == {"type": "presence", "online": []}
+        silent = RawClient()
+        await silent.connect(port, {"username": "silent", "room": "lobby", "ciphers": ["fernet"], "heartbeat": 1})
+        assert (await silent.receive())["heartbeat"] == 1
+        beating = RawClient()
+        await beating.connect(port, {"username": "beating", "room": "lobby", "ciphers": ["fernet"], "heartbeat": 1})
+
+        async def beat():
+            while True:
+                await asyncio.sleep(0.5)
+                beating.send({"type": "ping"})
+
+        beater = asyncio.ensure_future(beat())
+        start = asyncio.get_running_loop().time()
+        # Three missed heartbeats, give or take a tick
+        assert await asyncio.wait_for(silent.reader.read(), 6) == b""
+        assert 2 <= asyncio.get_running_loop().time() - start
+
+        joined, left = set(), set()
+        while "silent" not in left:
+            message = await watcher.receive()
+            # Changes only, the full list went out once
+            assert set(message) == {"type", "joined", "left"}
+            joined.update(message["joined"])
+            left.update(message["left"])
+        assert joined == {"watcher", "silent", "beating"}
+        assert left == {"silent"}
+        beater.cancel()
+        for client in (watcher, silent, beating):
+            client.close()
+
+    asyncio.run(run())
+
+def test_mail_waits_for_offline_users(server):
+    stats_port = free_port()
+    port = server("--mailbox-size", "2", "--stats-port", str(stats_port))
+
+    async def run():
+        # Only users the server has seen can get mail
+        bob = ChatClient("127.0.0.1", port, "bob", KEY)
+        await bob.connect()
+        await bob.close()
+        alice = ChatClient("127.0.0.1", port, "alice", KEY)
+        await alice.connect()
+        for text in ("one", "two", "three"):
+            await alice.send_direct("bob", text)
+        await asyncio.sleep(0.2)
+
+        received = []
+        bob = ChatClient("127.0.0.1", port, "bob", KEY, on_message=received.append)
+        await bob.connect()
+        deadline = asyncio.get_running_loop().time() + 5
+        while len([m for m in received if m.kind == DIRECT]) < 2:
+            assert asyncio.get_running_loop().time() < deadline
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        # The mailbox is bounded, the oldest message made room
+        assert [(m.sender, m.text) for m in received if m.kind == DIRECT] == [("alice", "two"), ("alice", "three")]
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(run())
+    with urllib.request.urlopen(f"http://127.0.0.1:{stats_port}/metrics", timeout=5) as response:
+        metrics = response.read().decode()
+    assert 'messenger_direct_messages_total{outcome="stored"} 3' in metrics
+    assert 'messenger_direct_messages_total{outcome="dropped"} 1' in metrics
+    assert 'messenger_direct_messages_total{outcome="delivered"} 2' in metrics
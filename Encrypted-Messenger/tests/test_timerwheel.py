@@ -0,0 +1,38 @@
+"""The hierarchical timing wheel"""
+
+from timerwheel import TimerWheel
+
+def run(wheel, ticks):
+    """Tick -> keys that expired on it"""
+    expired = {}
+    for _ in range(ticks):
+        keys = wheel.advance()
+        if keys:
+            expired[wheel.now] = sorted(keys)
+    return expired
+
+def test_timers_expire_on_their_tick_at_every_level():
+    wheel = TimerWheel()
+    delays = [1, 2, 63, 64, 65, 127, 4095, 4096, 4097, 70000, 262144]
+    for delay in delays:
+        wheel.schedule(delay, delay)
+    assert len(wheel) == len(delays)
+    assert run(wheel, 300000) == {delay: [delay] for delay in delays}
+    assert len(wheel) == 0
+
+def test_schedule_from_later_ticks():
+    wheel = TimerWheel()
+    run(wheel, 4000)
+    wheel.schedule("a", 200)
+    wheel.schedule("b", 5000)
+    assert run(wheel, 6000) == {4200: ["a"], 9000: ["b"]}
+
+def test_reschedule_and_cancel():
+    wheel = TimerWheel()
+    wheel.schedule("a", 10)
+    wheel.schedule("a", 100)  # Re-arming replaces the old timer
+    wheel.schedule("b", 0)  # At least one tick
+    wheel.schedule("c", 50)
+    wheel.cancel("c")
+    wheel.cancel("missing")
+    assert run(wheel, 200) == {1: ["b"], 100: ["a"]}
@@ -0,0 +1,46 @@
+"""
+Image thumbnails for the client, made off the Tk thread.
+
+Decoding and scaling down a photo takes long enough to stall the UI, so
+ThumbnailPool does it on worker threads (Pillow lets go of the GIL while
+it decodes and resamples) and queues the results for the UI tick. Only
+wrapping them as Tk images is left to the Tk thread, as Tk requires.
+"""
+
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+THUMBNAIL_SIZE = (240, 240)
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"}
+
+def is_image(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+def make_thumbnail(path, size=THUMBNAIL_SIZE):
+    with Image.open(path) as image:
+        # A JPEG can be decoded straight at a fraction of its size, far cheaper than in full
+        image.draft("RGB", size)
+        image.thumbnail(size)
+        return image.convert("RGBA")
+
+class ThumbnailPool:
+    """submit() from the Tk thread, then drain results, (key, image or None) each"""
+
+    def __init__(self, workers=2):
+        self.results = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="thumbnail")
+
+    def submit(self, key, path):
+        self._executor.submit(self._run, key, path)
+
+    def _run(self, key, path):
+        try:
+            image = make_thumbnail(path)
+        except Exception:
+            image = None  # Not an image after all, or a broken one
+        self.results.put((key, image))
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,69 @@
+"""
+Hierarchical timing wheel.
+
+Timers are kept in levels of 64 slots. Level 0 holds what expires within
+the next 64 ticks, one slot per tick; each level above covers 64 times the
+span of the one below. Every tick looks at a single level-0 slot; when
+level 0 wraps around, one slot of the level above is spread out over the
+levels below. Scheduling, cancelling and ticking are O(1) no matter how
+many timers there are, plus the work for the timers that actually expire.
+
+Entries are keys (any hashable), a key has at most one timer at a time.
+The wheel has no clock of its own, whoever owns it calls advance() once per
+tick.
+"""
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+MASK = SLOTS - 1
+LEVELS = 4  # 64**4 ticks, 194 days at one tick a second
+
+class TimerWheel:
+    def __init__(self, levels=LEVELS):
+        self.levels = [[{} for _ in range(SLOTS)] for _ in range(levels)]
+        self.max_delay = (1 << (SLOT_BITS * levels)) - 1
+        self.now = 0  # Ticks since start
+        self.slots = {}  # Key -> slot dict it is in
+
+    def __len__(self):
+        return len(self.slots)
+
+    def schedule(self, key, delay):
+        """(Re)arms key to expire delay ticks from now, at least one"""
+        self.cancel(key)
+        self._place(key, self.now + min(max(int(delay), 1), self.max_delay))
+
+    def cancel(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def advance(self):
+        """Moves on by one tick, returns the keys that expired"""
+        self.now += 1
+        now = self.now
+        level = 1
+        # Each time a level wraps, pull the next slot of the level above down
+        while level < len(self.levels) and now & ((1 << (SLOT_BITS * level)) - 1) == 0:
+            slot = self.levels[level][(now >> (SLOT_BITS * level)) & MASK]
+            entries = list(slot.items())
+            slot.clear()
+            for key, expiry in entries:
+                self._place(key, expiry)
+            level += 1
+
+        slot = self.levels[0][now & MASK]
+        expired = list(slot)
+        slot.clear()
+        for key in expired:
+            del self.slots[key]
+        return expired
+
+    def _place(self, key, expiry):
+        delta = expiry - self.now
+        level = 0
+        while level < len(self.levels) - 1 and delta >= 1 << (SLOT_BITS * (level + 1)):
+            level += 1
+        slot = self.levels[level][(expiry >> (SLOT_BITS * level)) & MASK]
+        slot[key] = expiry
+        self.slots[key] = slot
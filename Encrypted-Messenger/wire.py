@@ -0,0 +1,94 @@
+"""
+Binary message format.
+
+A binary message is a normal length-prefixed frame (see framing.py) whose
+payload starts with a fixed header, followed by the opaque ciphertext:
+
+  version  u8   VERSION, never "{" so it can't be mistaken for JSON
+  type     u8   MESSAGE, DIRECT, FILE or CHUNK
+  sender   u64  name_id(username)
+  room     u64  name_id(room name), for DIRECT name_id(recipient),
+                for CHUNK the transfer id
+  seq      u64  history sequence number, 0 when the server keeps none;
+                for CHUNK the chunk's index in the file
+
+The frame's length prefix doubles as the message length. Ids are hashes of
+the names, so a client, the server and every worker agree on them without
+a registry; clients resolve sender ids to names by asking the server.
+
+FILE announces an uploaded file to a room, its body the encrypted file
+details, and travels like a MESSAGE. CHUNK carries one encrypted piece of
+a file to or from the server's spool (see filetransfer.py), it is always
+binary whatever format was negotiated.
+
+Control traffic (handshake, join/leave, notices) stays JSON. Both kinds of
+payload can share one connection, the first byte tells them apart.
+"""
+
+import base64
+import hashlib
+import json
+import struct
+from functools import lru_cache
+from framing import HEADER as LENGTH, encode_frame
+
+VERSION = 1
+HEADER = struct.Struct("!BBQQQ")
+
+# Message types
+MESSAGE = 1
+DIRECT = 2  # To one user, the room field holds the recipient's id
+FILE = 3  # A file in the spool, announced to a room
+CHUNK = 4  # A piece of a file being uploaded or downloaded
+
+# Formats a client may ask the server to send it, most preferred first
+FORMATS = ("binary", "json")
+
+@lru_cache(maxsize=65536)
+def name_id(name):
+    """64-bit id of a user or room name"""
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "big")
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] == VERSION
+
+def pack(kind, sender_id, room_id, seq, body):
+    """Builds a complete frame, length prefix included"""
+    return encode_frame(HEADER.pack(VERSION, kind, sender_id, room_id, seq) + body)
+
+def unpack(payload):
+    """Splits a frame payload into (type, sender id, room id, seq, body)"""
+    if len(payload) < HEADER.size:
+        raise ValueError("truncated binary message")
+    version, kind, sender_id, room_id, seq = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError(f"unsupported wire version {version}")
+    return kind, sender_id, room_id, seq, memoryview(payload)[HEADER.size:]
+
+def to_json_frame(frame, room, sender=None, names=None):
+    """
+    Re-encodes a binary MESSAGE or FILE frame for a client that negotiated
+    JSON. Without a sender, the sender id is looked up in names (id -> username).
+    """
+    payload = memoryview(frame)[LENGTH.size:]
+    if not is_binary(payload):
+        return bytes(frame)  # Already JSON
+    kind, sender_id, _, seq, body = unpack(payload)
+    if sender is None:
+        sender = names.get(sender_id) or f"user-{sender_id:016x}"
+    message = {"from": sender, "room": room, "data": base64.urlsafe_b64encode(body).decode()}
+    if kind == FILE:
+        message["type"] = "file"
+    if seq:
+        message["seq"] = seq
+    return encode_frame(json.dumps(message).encode())
+
+def to_json_direct(frame, sender, recipient):
+    """Re-encodes a binary DIRECT frame for a client that negotiated JSON"""
+    payload = memoryview(frame)[LENGTH.size:]
+    if not is_binary(payload):
+        return bytes(frame)
+    body = unpack(payload)[4]
+    message = {"type": "direct", "from": sender, "to": recipient,
+               "data": base64.urlsafe_b64encode(body).decode()}
+    return encode_frame(json.dumps(message).encode())